@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+# pylint: disable=consider-using-with,unspecified-encoding
+
+"""Benchmarks for ukify
+
+This is not run as part of the test suite. Use it to compare the performance of ukify before and after a
+change, e.g.:
+
+  src/ukify/test/bench_ukify.py startup --runs=20
+  src/ukify/test/bench_ukify.py --json pipeline --initrd-size=512 --kernel-size=32
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import pathlib
+import resource
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from pe_stub import make_stub
+
+UKIFY = pathlib.Path(__file__).parent.parent / 'ukify.py'
+
+
+def parse_importtime(stderr):
+    "Return a list of (module, self µs, cumulative µs) from the output of python -X importtime"
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, module = line.removeprefix('import time:').split('|')
+        modules += [(module[1:].rstrip(), int(self_us), int(cumulative_us))]
+    return modules
+
+
+def startup_commands(workdir):
+    "Prepare inputs and return a mapping of verb to ukify arguments"
+    stub = workdir / 'stub.efi'
+    make_stub(stub)
+    kernel = workdir / 'vmlinuz'
+    kernel.write_bytes(os.urandom(64 * 1024))
+    uki = workdir / 'uki.efi'
+
+    build = [
+        'build',
+        f'--stub={stub}',
+        f'--linux={kernel}',
+        '--uname=1.2.3',
+        '--os-release=ID=bench',
+        '--cmdline=quiet',
+        f'--output={uki}',
+    ]
+
+    return {
+        'help': ['--help'],
+        'build': build,
+        'inspect': ['inspect', str(uki)],
+    }
+
+
+def run_startup(opts):
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix='bench-ukify') as workdir:
+        commands = startup_commands(pathlib.Path(workdir))
+        env = dict(os.environ, PAGER='cat')
+
+        for verb, args in commands.items():
+            wall = []
+            imports = []
+            for _ in range(opts.runs):
+                start = time.monotonic()
+                p = subprocess.run([sys.executable, '-X', 'importtime', opts.ukify, *args],
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE,
+                                   text=True,
+                                   env=env,
+                                   check=True)
+                wall += [time.monotonic() - start]
+                imports += [parse_importtime(p.stderr)]
+
+            # The heaviest modules imported directly or indirectly by ukify itself in the last run
+            toplevel = sorted((m for m in imports[-1] if not m[0].startswith(' ')),
+                              key=lambda m: m[2], reverse=True)
+
+            results[verb] = {
+                'wall_ms': round(statistics.median(wall) * 1000, 1),
+                'import_ms': round(statistics.median(sum(m[1] for m in run) for run in imports) / 1000, 1),
+                'modules': len(imports[-1]),
+                'heaviest': {name: round(cumulative / 1000, 1) for name, _, cumulative in toplevel[:opts.top]},
+            }
+
+    if opts.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    for verb, r in results.items():
+        print(f"{verb}: {r['wall_ms']} ms wall, {r['import_ms']} ms in {r['modules']} imports")
+        for name, ms in r['heaviest'].items():
+            print(f'    {name}: {ms} ms')
+
+
+KERNEL_VERSION = '6.10.0-bench'
+KERNEL_BANNER = f'Linux version {KERNEL_VERSION} (bench@localhost) (gcc) #1 SMP PREEMPT_DYNAMIC\n\0'.encode()
+# The version string that the x86 boot header points to has no compiler information
+KERNEL_X86_VERSION = f'{KERNEL_VERSION} (bench@localhost) #1 SMP PREEMPT_DYNAMIC\0'.encode()
+
+# The compressors are called like the kernel build calls them, except that lz4 writes the frame format,
+# because ukify cannot decompress the legacy format that the kernel uses.
+COMPRESSORS = {
+    'gzip': (['gzip', '-n', '-9', '-c'], ['zlib']),
+    'zstd': (['zstd', '-19', '-q', '-c'], ['zstandard', 'zstd']),
+    'lz4': (['lz4', '-9', '-q', '-c'], ['lz4']),
+}
+
+
+def kernel_payload(size):
+    """Return size bytes of data that compresses roughly like a kernel image
+
+    Each page is a quarter random bytes and three quarters of a repeating pattern.
+    """
+    page = 4096
+    pattern = bytes(range(256)) * (page * 3 // 4 // 256)
+    return b''.join(os.urandom(page // 4) + pattern for _ in range(size // page))
+
+
+def write_elf_kernel(path, payload):
+    "Write a vmlinux-like ELF64 file with a 'Linux' version note, followed by the payload"
+    desc = KERNEL_VERSION.encode() + b'\0'
+    desc = desc.ljust((len(desc) + 3) // 4 * 4, b'\0')
+    notes = struct.pack('<III', 6, len(desc), 0x100) + b'Linux\0\0\0' + desc
+
+    ehdr = struct.pack('<HHIQQQIHHHHHH', 2, 62, 1, 0, 64, 0, 0, 64, 56, 1, 64, 0, 0)
+    phdr = struct.pack('<IIQQQQQQ', 4, 0, 64 + 56, 0, 0, len(notes), len(notes), 4)
+    ident = b'\x7fELF' + bytes([2, 1, 1]) + bytes(9)
+    path.write_bytes(ident + ehdr + phdr + notes + payload)
+
+
+def write_bzimage_kernel(path, payload):
+    "Write a file with an x86 real-mode kernel header that points at the version string"
+    header = bytearray(0x400)
+    header[:2] = b'MZ'
+    header[0x202:0x206] = b'HdrS'
+    header[0x20e:0x210] = struct.pack('<H', 0x200)
+    header += KERNEL_X86_VERSION
+    path.write_bytes(header + payload)
+
+
+def write_compressed_kernel(path, payload, command):
+    "Write the payload with the banner in the middle, compressed with command"
+    middle = len(payload) // 2
+    data = payload[:middle] + KERNEL_BANNER + payload[middle:]
+    with path.open('wb') as f:
+        subprocess.run(command, input=data, stdout=f, check=True)
+
+
+def write_initrds(workdir, count, total_size):
+    "Write count initrds of total_size bytes together, and return their paths"
+    block = os.urandom(1024 * 1024)
+    initrds = []
+    for i in range(count):
+        path = workdir / f'initrd{i}.cpio'
+        with path.open('wb') as f:
+            for _ in range(total_size // count // len(block)):
+                f.write(block)
+        initrds += [path]
+    return initrds
+
+
+def load_module(path):
+    "Import ukify from path, so that different versions can be benchmarked"
+    spec = importlib.util.spec_from_file_location('ukify', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['ukify'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_proc_io():
+    "Return the bytes read and written by the current process through system calls"
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return 0, 0
+    return int(fields['rchar']), int(fields['wchar'])
+
+
+def reset_peak_rss():
+    "Reset the high-water mark of the resident set size, so that it can be measured for one operation"
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    "Return the peak resident set size in bytes"
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(func, *args):
+    """Call func(*args) in a forked child and return its resource use
+
+    Running each operation in a fresh child keeps the measurements independent: memoized state in ukify
+    is not carried over from one operation to the next, and the peak RSS is that of one operation.
+    The output of the operation is discarded.
+    """
+    sys.stdout.flush()
+    r, w = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(r)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        try:
+            reset_peak_rss()
+            read0, written0 = read_proc_io()
+            usage0 = resource.getrusage(resource.RUSAGE_SELF)
+            start = time.monotonic()
+
+            func(*args)
+
+            wall = time.monotonic() - start
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            read, written = read_proc_io()
+            result = {
+                'wall': wall,
+                'cpu': (usage.ru_utime - usage0.ru_utime + usage.ru_stime - usage0.ru_stime +
+                        children.ru_utime + children.ru_stime),
+                'peak_rss': peak_rss(),
+                'read': read - read0,
+                'written': written - written0,
+            }
+        except BaseException as e:  # pylint: disable=broad-except
+            result = {'error': f'{type(e).__name__}: {e}'}
+        with os.fdopen(w, 'w') as f:
+            json.dump(result, f)
+        os._exit(0)
+
+    os.close(w)
+    with os.fdopen(r) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def pipeline_inputs(workdir, opts):
+    "Generate the synthetic inputs and return a mapping of kernel flavour to path, and the list of initrds"
+    stub = workdir / 'stub.efi'
+    make_stub(stub, text_size=opts.stub_size * 1024)
+
+    payload = kernel_payload(opts.kernel_size * 1024 * 1024)
+    kernels = {}
+
+    kernels['elf'] = workdir / 'vmlinux'
+    write_elf_kernel(kernels['elf'], payload)
+    kernels['bzimage'] = workdir / 'bzImage'
+    write_bzimage_kernel(kernels['bzimage'], payload)
+
+    for name, (command, modules) in COMPRESSORS.items():
+        if not shutil.which(command[0]):
+            print(f'{command[0]} is not installed, skipping {name} kernel', file=sys.stderr)
+            continue
+        if not any(importlib.util.find_spec(m) for m in modules):
+            print(f'{" or ".join(modules)} module is not available, skipping {name} kernel', file=sys.stderr)
+            continue
+        kernels[name] = workdir / f'vmlinux.{name}'
+        write_compressed_kernel(kernels[name], payload, command)
+
+    initrds = write_initrds(workdir, opts.initrds, opts.initrd_size * 1024 * 1024)
+    return stub, kernels, initrds
+
+
+def pipeline_operations(ukify, workdir, stub, kernels, initrds):
+    "Return a mapping of operation name to (function, arguments)"
+    uki = workdir / 'uki.efi'
+    output = workdir / 'out.efi'
+
+    def scrape(kernel):
+        if ukify.Uname.scrape(kernel) != KERNEL_VERSION:
+            raise ValueError(f'Version not found in {kernel}')
+
+    def build():
+        opts = ukify.parse_args([
+            'build',
+            f'--stub={stub}',
+            f'--linux={kernels["bzimage"]}',
+            *(f'--initrd={i}' for i in initrds),
+            f'--uname={KERNEL_VERSION}',
+            '--os-release=ID=bench',
+            '--cmdline=quiet',
+            f'--output={uki}',
+        ])
+        ukify.check_inputs(opts)
+        ukify.make_uki(opts)
+
+    def add_sections():
+        image = ukify.UKI(stub)
+        image.add_section(ukify.Section.create('.osrel', 'ID=bench\n', measure=True))
+        image.add_section(ukify.Section.create('.cmdline', 'quiet', measure=True))
+        image.add_section(ukify.Section.create('.uname', KERNEL_VERSION, measure=True))
+        image.add_section(ukify.Section.create('.initrd', ukify.ConcatenatedFiles(tuple(initrds)),
+                                               measure=True))
+        image.add_section(ukify.Section.create('.linux', kernels['bzimage'], measure=True))
+        ukify.pe_add_sections(image, output)
+
+    def sbat():
+        ukify.merge_sbat([stub, uki], ['sbat,1,SBAT Version,sbat,1,https://github.com/rhboot/shim/blob/main/SBAT.md'])
+
+    def inspect():
+        ukify.inspect_sections(ukify.parse_args(['inspect', str(uki), '--json=short']))
+
+    operations = {f'Uname.scrape[{name}]': (scrape, [kernel]) for name, kernel in kernels.items()}
+    # The image built by make_uki is the input of the operations that follow it
+    operations['make_uki'] = (build, [])
+    operations['pe_add_sections'] = (add_sections, [])
+    operations['merge_sbat'] = (sbat, [])
+    operations['inspect_sections'] = (inspect, [])
+    return operations
+
+
+def run_pipeline(opts):
+    ukify = load_module(opts.ukify)
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix='bench-ukify', dir=opts.workdir) as workdir:
+        workdir = pathlib.Path(workdir)
+        stub, kernels, initrds = pipeline_inputs(workdir, opts)
+        operations = pipeline_operations(ukify, workdir, stub, kernels, initrds)
+
+        for name, (func, args) in operations.items():
+            runs = [measure(func, *args) for _ in range(opts.runs)]
+            if errors := [r['error'] for r in runs if 'error' in r]:
+                results[name] = {'error': errors[0]}
+                continue
+
+            results[name] = {
+                'wall_ms': round(statistics.median(r['wall'] for r in runs) * 1000, 1),
+                'cpu_ms': round(statistics.median(r['cpu'] for r in runs) * 1000, 1),
+                'peak_rss_mib': round(max(r['peak_rss'] for r in runs) / 2**20, 1),
+                'read_mib': round(runs[-1]['read'] / 2**20, 1),
+                'written_mib': round(runs[-1]['written'] / 2**20, 1),
+            }
+
+    if opts.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    width = max(len(name) for name in results)
+    for name, r in results.items():
+        if 'error' in r:
+            print(f"{name:{width}}  failed: {r['error']}")
+            continue
+        print(f"{name:{width}}  {r['wall_ms']:9.1f} ms wall {r['cpu_ms']:9.1f} ms cpu "
+              f"{r['peak_rss_mib']:7.1f} MiB rss {r['read_mib']:8.1f} MiB read {r['written_mib']:8.1f} MiB written")
+
+
+def create_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--ukify',
+                   type=pathlib.Path,
+                   default=UKIFY,
+                   help='the ukify.py to benchmark')
+    p.add_argument('--json',
+                   action='store_true',
+                   help='print the results as JSON')
+
+    sub = p.add_subparsers(dest='benchmark', required=True)
+
+    startup = sub.add_parser('startup',
+                             help='startup time and imports per verb, as measured with python -X importtime')
+    startup.add_argument('--runs',
+                         type=int,
+                         default=5,
+                         help='number of runs per verb, the median is reported')
+    startup.add_argument('--top',
+                         type=int,
+                         default=5,
+                         help='number of the slowest imports to show per verb')
+    startup.set_defaults(func=run_startup)
+
+    pipeline = sub.add_parser('pipeline',
+                              help=('wall time, CPU time, peak RSS and I/O of the build steps, '
+                                    'on synthetic stubs, kernels and initrds'))
+    pipeline.add_argument('--runs',
+                          type=int,
+                          default=3,
+                          help='number of runs per operation, the median times are reported')
+    pipeline.add_argument('--stub-size',
+                          type=int,
+                          default=64,
+                          metavar='KiB',
+                          help='size of the .text section of the stub')
+    pipeline.add_argument('--kernel-size',
+                          type=int,
+                          default=16,
+                          metavar='MiB',
+                          help='size of the uncompressed kernels')
+    pipeline.add_argument('--initrd-size',
+                          type=int,
+                          default=256,
+                          metavar='MiB',
+                          help='total size of the initrds')
+    pipeline.add_argument('--initrds',
+                          type=int,
+                          default=4,
+                          help='number of initrds')
+    pipeline.add_argument('--workdir',
+                          type=pathlib.Path,
+                          help=('directory for the generated inputs and outputs, '
+                                'use a disk-backed file system to include real I/O'))
+    pipeline.set_defaults(func=run_pipeline)
+
+    return p
+
+
+def main():
+    opts = create_parser().parse_args()
+    opts.func(opts)
+
+
+if __name__ == '__main__':
+    main()
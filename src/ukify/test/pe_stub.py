@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+"""A minimal PE stub for the tests and benchmarks of ukify"""
+
+import struct
+
+
+def make_stub(path, machine=0x8664, text_size=0x1000, max_sections=32, pe_offset=0x40):
+    """Write a minimal PE32+ EFI application with one .text section
+
+    The header is large enough for max_sections section headers, so that ukify can add its sections. The
+    PE header is placed at pe_offset, after a DOS stub of zeros.
+    """
+    file_alignment = 0x200
+    section_alignment = 0x1000
+    size_of_headers = ((pe_offset + 4 + 20 + 240 + 40 * max_sections + file_alignment - 1)
+                       // file_alignment * file_alignment)
+    size_of_image = section_alignment + (text_size + section_alignment - 1) // section_alignment * section_alignment
+
+    dos = (b'MZ' + bytes(0x3a) + struct.pack('<I', pe_offset)).ljust(pe_offset, b'\0')
+    coff = struct.pack('<HHIIIHH',
+                       machine,
+                       1,                        # NumberOfSections
+                       0,                        # TimeDateStamp
+                       0, 0,                     # PointerToSymbolTable, NumberOfSymbols
+                       240,                      # SizeOfOptionalHeader
+                       0x0202 | 0x0020)          # EXECUTABLE_IMAGE, DEBUG_STRIPPED, LARGE_ADDRESS_AWARE
+    opt = struct.pack('<HBBIIIIIQIIHHHHHHIIIIHHQQQQII',
+                      0x20b,                     # PE32+
+                      0, 0,                      # linker version
+                      text_size, 0, 0,           # SizeOfCode, SizeOfInitializedData, SizeOfUninitializedData
+                      section_alignment,         # AddressOfEntryPoint
+                      section_alignment,         # BaseOfCode
+                      0,                         # ImageBase
+                      section_alignment,
+                      file_alignment,
+                      0, 0, 0, 0, 0, 0,          # OS, image and subsystem versions
+                      0,                         # Win32VersionValue
+                      size_of_image,
+                      size_of_headers,
+                      0,                         # CheckSum
+                      10,                        # IMAGE_SUBSYSTEM_EFI_APPLICATION
+                      0,                         # DllCharacteristics
+                      0, 0, 0, 0,                # stack and heap sizes
+                      0,                         # LoaderFlags
+                      16)                        # NumberOfRvaAndSizes
+    opt += bytes(16 * 8)
+    text = struct.pack('<8sIIIIIIHHI',
+                       b'.text',
+                       text_size,                # VirtualSize
+                       section_alignment,        # VirtualAddress
+                       text_size,                # SizeOfRawData
+                       size_of_headers,          # PointerToRawData
+                       0, 0, 0, 0,
+                       0x60000020)               # CODE, EXECUTE, READ
+
+    header = dos + b'PE\0\0' + coff + opt + text
+    path.write_bytes(header.ljust(size_of_headers, b'\0') + b'\xc3' * text_size)
@@ -6,7 +6,9 @@
 # pylint: disable=protected-access,redefined-outer-name
 
 import base64
+import hashlib
 import json
+import mmap
 import os
 import pathlib
 import re
@@ -34,6 +36,7 @@ except ImportError as e:
 # easier to import the file.
 sys.path.append(os.path.dirname(__file__) + '/..')
 import ukify
+from pe_stub import make_stub
 
 build_root = os.getenv('PROJECT_BUILD_ROOT')
 try:
@@ -60,6 +63,262 @@ def test_round_up():
     assert ukify.round_up(4096) == 4096
     assert ukify.round_up(4097) == 8192
 
+def test_copy_file_to_offset(tmp_path):
+    src = tmp_path / 'src'
+    src.write_bytes(b'0123456789' * 1000)
+
+    with open(tmp_path / 'dst', 'wb') as f:
+        f.write(b'HEADER')
+        ukify.copy_file_to_offset(src, f.fileno(), 512, 10000)
+
+    data = (tmp_path / 'dst').read_bytes()
+    assert data[:6] == b'HEADER'
+    assert data[6:512] == bytes(506)
+    assert data[512:] == src.read_bytes()
+
+    with open(tmp_path / 'dst', 'wb') as f:
+        with pytest.raises(ukify.PEError):
+            ukify.copy_file_to_offset(src, f.fileno(), 0, 10001)
+
+def test_pe_image(tmp_path):
+    stub = tmp_path / 'stub.efi'
+    make_stub(stub, max_sections=4)
+
+    image = ukify.PEImage.load(stub)
+    assert [s.name for s in image.sections] == ['.text']
+    assert image.FileAlignment == 0x200
+    assert image.directory(ukify.IMAGE_DIRECTORY_ENTRY_SECURITY) == (0, 0)
+    assert image.section_data(image.sections[0]) == b'\xc3' * 0x1000
+    assert stub.read_bytes().startswith(image.headers())
+
+    # The stub is parsed once, and changes are made to copies
+    assert ukify.load_pe(stub) is ukify.load_pe(stub)
+    assert ukify.load_stub(stub).data == stub.read_bytes()
+
+    uki = ukify.UKI(stub)
+    for name in ('.osrel', '.cmdline', '.uname'):
+        uki.add_section(ukify.Section.create(name, f'contents of {name}'))
+    output = tmp_path / 'uki.efi'
+    ukify.pe_add_sections(uki, output)
+    assert [s.name for s in ukify.load_stub(stub).sections] == ['.text']
+
+    pe = pefile.PE(output, fast_load=True)
+    assert not pe.get_warnings()
+    assert pe.FILE_HEADER.NumberOfSections == 4
+    for section, name in zip(pe.sections[1:], ('.osrel', '.cmdline', '.uname')):
+        assert section.Name.rstrip(b'\0').decode() == name
+        assert section.get_data(length=section.Misc_VirtualSize) == f'contents of {name}'.encode()
+    assert pe.OPTIONAL_HEADER.SizeOfImage == pe.sections[-1].VirtualAddress + 0x1000
+
+    # There is no room for another section header
+    uki.add_section(ukify.Section.create('.splash', 'x'))
+    with pytest.raises(ukify.PEError):
+        ukify.pe_add_sections(uki, output)
+
+    (tmp_path / 'junk').write_bytes(b'MZ' + bytes(100))
+    with pytest.raises(ukify.PEError):
+        ukify.PEImage.load(tmp_path / 'junk')
+
+    # The PE header and the section table may be past the first page
+    far = tmp_path / 'far.efi'
+    make_stub(far, max_sections=4, pe_offset=0x1ff0)
+    image = ukify.PEImage.load(far)
+    assert image.pe_offset == 0x1ff0
+    assert [s.name for s in image.sections] == ['.text']
+    assert image.section_data(image.sections[0]) == b'\xc3' * 0x1000
+    assert far.read_bytes().startswith(image.headers())
+
+def test_join_initrds(tmp_path):
+    initrds = []
+    for i, size in enumerate((5, 8, 1)):
+        initrd = tmp_path / f'initrd{i}'
+        initrd.write_bytes(bytes([ord('a') + i]) * size)
+        initrds += [initrd]
+
+    assert ukify.join_initrds([]) is None
+    assert ukify.join_initrds(initrds[:1]) == initrds[0]
+
+    joined = ukify.join_initrds(initrds)
+    assert isinstance(joined, ukify.ConcatenatedFiles)
+    assert joined.size() == 8 + 8 + 4
+
+    with open(tmp_path / 'out', 'wb') as f:
+        joined.copy_to_offset(f.fileno(), 4)
+    assert (tmp_path / 'out').read_bytes() == bytes(4) + b'aaaaa\0\0\0' + b'bbbbbbbb' + b'c\0\0\0'
+
+def test_file_slice(tmp_path):
+    data = os.urandom(3 * mmap.ALLOCATIONGRANULARITY)
+    f = tmp_path / 'f'
+    f.write_bytes(data)
+
+    offset = mmap.ALLOCATIONGRANULARITY + 100
+    piece = ukify.FileSlice(f, offset, 1000)
+    assert piece.size() == 1000
+    assert ukify.hash_content(piece, ['sha256']) == [hashlib.sha256(data[offset:offset + 1000]).digest()]
+
+    with open(tmp_path / 'out', 'wb') as out:
+        piece.write_to(out)
+        piece.copy_to_offset(out.fileno(), 1000)
+    assert (tmp_path / 'out').read_bytes() == data[offset:offset + 1000] * 2
+
+def test_scratch_file_and_replace_atomically(tmp_path):
+    tmp, path = ukify.scratch_file('test')
+    with tmp:
+        path.write_bytes(b'scratch')
+        assert path.read_bytes() == b'scratch'
+
+    output = tmp_path / 'output'
+    output.write_text('old')
+    with pytest.raises(RuntimeError):
+        with ukify.replace_atomically(output) as new:
+            new.write_text('partial')
+            raise RuntimeError
+    assert output.read_text() == 'old'
+
+    with ukify.replace_atomically(output, 0o755) as new:
+        new.write_text('new')
+        assert output.read_text() == 'old'
+    assert output.read_text() == 'new'
+    assert os.listdir(tmp_path) == ['output']
+    assert output.stat().st_mode & 0o100
+
+def test_parse_size():
+    assert ukify.parse_size('1234') == 1234
+    assert ukify.parse_size('4K') == 4096
+    assert ukify.parse_size('2G') == 2 * 1024**3
+    with pytest.raises(Exception):
+        ukify.parse_size('many')
+
+def test_build_cache(tmp_path):
+    input = tmp_path / 'input'
+    input.write_text('a')
+    calls = []
+
+    def func():
+        calls.append(1)
+        return f'result{len(calls)}'
+
+    cache = ukify.BuildCache(tmp_path / 'cache', 1024)
+    assert cache.text('kind', [input, 'opt'], func) == 'result1'
+    assert cache.text('kind', [input, 'opt'], func) == 'result1'
+    assert cache.text('kind', [input, 'opt2'], func) == 'result2'
+    assert cache.text('other', [input, 'opt'], func) == 'result3'
+
+    input.write_text('b')
+    assert cache.text('kind', [input, 'opt'], func) == 'result4'
+    assert len(calls) == 4
+
+    out = cache.file('file', [input], lambda path: path.write_bytes(b'x' * 2000))
+    assert out.read_bytes() == b'x' * 2000
+    assert cache.file('file', [input], lambda path: pytest.fail('not cached')) == out
+
+    # The large entry is the most recent one, so all the others are removed first
+    cache.evict()
+    assert not out.exists()
+    assert not list((tmp_path / 'cache').glob('??/*'))
+
+    # Without a cache directory, nothing is cached
+    cache = ukify.BuildCache(None, 0)
+    assert cache.text('kind', [input], func) == 'result5'
+    assert cache.text('kind', [input], func) == 'result6'
+    out = cache.file('file', [input], lambda path: path.write_bytes(b'y'))
+    assert out.read_bytes() == b'y'
+
+def test_pcr_calculate(tmp_path):
+    linux = tmp_path / 'linux'
+    linux.write_bytes(b'kernel' * 1000)
+    osrel = tmp_path / 'osrel'
+    osrel.write_text('ID=foobar\n')
+    cmdline = tmp_path / 'cmdline'
+    cmdline.write_text('')
+    (tmp_path / 'initrd1').write_bytes(b'abc')
+    (tmp_path / 'initrd2').write_bytes(b'defgh')
+    initrd = ukify.join_initrds([tmp_path / 'initrd1', tmp_path / 'initrd2'])
+
+    def extend(value, data):
+        return hashlib.sha256(value + hashlib.sha256(data).digest()).digest()
+
+    # The empty .cmdline is skipped, and the sections are measured in the stub's order
+    value = bytes(32)
+    for name, data in (('.linux', linux.read_bytes()),
+                       ('.osrel', osrel.read_bytes()),
+                       ('.initrd', b'abc\0defgh\0\0\0')):
+        value = extend(value, name.encode() + b'\0')
+        value = extend(value, data)
+    for word in ('enter-initrd', 'leave-initrd'):
+        value = extend(value, word.encode())
+
+    sections = {'.initrd': initrd, '.cmdline': cmdline, '.osrel': osrel, '.linux': linux}
+    text = ukify.pcr_calculate(sections, banks=['sha256'], phase_paths=['enter-initrd:leave-initrd'])
+    assert text == f'11:sha256={value.hex()}\n'
+
+    # Empty words are dropped from the phase paths before they are deduplicated
+    text = ukify.pcr_calculate(sections, banks=['sha256'],
+                               phase_paths=['enter-initrd::leave-initrd', ':enter-initrd:leave-initrd:'])
+    assert text == f'11:sha256={value.hex()}\n'
+
+    # The banks are normalized before they are sorted and deduplicated, sha1 comes before sha256
+    text = ukify.pcr_calculate(sections, banks=['sha256', 'SHA256'], phase_paths=['enter-initrd:leave-initrd'])
+    assert text == f'11:sha256={value.hex()}\n'
+    text = ukify.pcr_calculate(sections, banks=['SHA256', 'sha1'], phase_paths=['enter-initrd:leave-initrd'])
+    assert [line.split('=')[0] for line in text.splitlines()] == ['11:sha1', '11:sha256']
+
+    text = ukify.pcr_calculate(sections)
+    lines = text.splitlines()
+    assert len(lines) == 16
+    assert [line.split('=')[0] for line in lines[:4]] == ['11:sha1', '11:sha256', '11:sha384', '11:sha512']
+    assert lines[5] == f'11:sha256={value.hex()}'
+
+    with pytest.raises(ValueError):
+        ukify.pcr_calculate({'.osrel': osrel})
+
+def test_pcr_calculate_systemd_measure(tmp_path):
+    # systemd-measure is the reference implementation
+    measure_tool = systemd_measure()
+    if measure_tool is None:
+        pytest.skip('systemd-measure not found')
+
+    linux = tmp_path / 'linux'
+    linux.write_bytes(os.urandom(100000))
+    osrel = tmp_path / 'osrel'
+    osrel.write_text('ID=foobar\n')
+    cmdline = tmp_path / 'cmdline'
+    cmdline.write_text('')
+    (tmp_path / 'initrd1').write_bytes(b'abc')
+    (tmp_path / 'initrd2').write_bytes(b'defgh')
+    initrd = ukify.join_initrds([tmp_path / 'initrd1', tmp_path / 'initrd2'])
+    sections = {'.linux': linux, '.osrel': osrel, '.cmdline': cmdline, '.initrd': initrd}
+
+    joined = tmp_path / 'initrd'
+    with joined.open('wb') as f:
+        initrd.write_to(f)
+    out = subprocess.check_output([
+        measure_tool,
+        'calculate',
+        f'--linux={linux}',
+        f'--osrel={osrel}',
+        f'--cmdline={cmdline}',
+        f'--initrd={joined}',
+    ], text=True)
+    assert ukify.pcr_calculate(sections) == out
+
+    out = subprocess.check_output([
+        measure_tool,
+        'calculate',
+        f'--linux={linux}',
+        '--bank=sha256',
+        '--phase=enter-initrd:leave-initrd:sysinit:ready:shutdown',
+        '--phase=enter-initrd',
+        '--phase=enter-initrd::leave-initrd',
+        '--phase=:enter-initrd:',
+    ], text=True)
+    assert ukify.pcr_calculate({'.linux': linux},
+                               banks=['sha256'],
+                               phase_paths=['enter-initrd:leave-initrd:sysinit:ready:shutdown',
+                                            'enter-initrd',
+                                            'enter-initrd::leave-initrd',
+                                            ':enter-initrd:']) == out
+
 def test_namespace_creation():
     ns = ukify.create_parser().parse_args(())
     assert ns.linux is None
@@ -260,15 +519,52 @@ def test_parse_sections():
     assert len(opts.sections) == 2
 
     assert opts.sections[0].name == 'test'
-    assert isinstance(opts.sections[0].content, pathlib.Path)
-    assert opts.sections[0].tmpfile
+    assert opts.sections[0].content == ukify.MemoryContent(b'TESTTESTTEST')
     assert opts.sections[0].measure is False
 
     assert opts.sections[1].name == 'test2'
     assert opts.sections[1].content == pathlib.Path('FILE')
-    assert opts.sections[1].tmpfile is None
     assert opts.sections[1].measure is False
 
+def test_parse_profile_sections(tmp_path):
+    config = tmp_path / 'config.conf'
+    config.write_text(textwrap.dedent(
+        '''
+        [Profile:rescue]
+        Section = .cmdline:rescue
+                  .profile:@PROFILE
+        '''))
+
+    opts = ukify.parse_args(
+        ['build',
+         '--linux=/ARG1',
+         f'--config={config}',
+         '--profile-section=default:.cmdline:quiet',
+         '--profile-section=default:.osrel:@OSREL',
+         ])
+
+    assert list(opts.profiles) == ['default', 'rescue']
+
+    default = opts.profiles['default']
+    assert [s.name for s in default] == ['.profile', '.cmdline', '.osrel']
+    assert default[0].content == ukify.MemoryContent(b'ID=default\n')
+    assert default[0].measure is False
+    assert default[1].content == ukify.MemoryContent(b'quiet')
+    assert default[1].measure is True
+    assert default[2].content == pathlib.Path('OSREL')
+
+    rescue = opts.profiles['rescue']
+    assert [s.name for s in rescue] == ['.profile', '.cmdline']
+    assert rescue[0].content == pathlib.Path('PROFILE')
+
+    for spec in ('default:.linux:@LINUX', 'default:.sbat:foo', 'bad/id:.cmdline:foo', 'default:.cmdline'):
+        with pytest.raises(ValueError):
+            ukify.parse_args(['build', '--linux=/ARG1', f'--profile-section={spec}'])
+
+    with pytest.raises(ValueError, match='Duplicate'):
+        ukify.parse_args(['build', '--linux=/ARG1',
+                          '--profile-section=a:.cmdline:foo', '--profile-section=a:.cmdline:bar'])
+
 def test_config_priority(tmp_path):
     config = tmp_path / 'config1.conf'
     # config: use pesign and give certdir + certname
@@ -357,6 +653,64 @@ def test_config_priority(tmp_path):
     assert opts.output == pathlib.Path('OUTPUT')
     assert opts.measure is True
 
+def test_parse_manifest_json(tmp_path):
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps({
+        'one': {'Output': 'one.efi', 'Cmdline': 'a  b', 'Initrd': ['/i1', '/i2']},
+        'two': {'Output': 'two.efi', 'Uname': '1.2.3', 'SignKernel': False, 'SBAT': 'sbat,1,foo\nfoo,1\n'},
+    }))
+
+    opts = ukify.parse_args(['build-many', str(manifest),
+                             '--linux=/ARG1',
+                             '--initrd=/ARG2',
+                             '--cmdline=default',
+                             '--uname=4.5.6'])
+    assert opts.verb == 'build-many'
+    assert [image.image_name for image in opts.images] == ['one', 'two']
+
+    one, two = opts.images
+    assert one.verb == 'build'
+    assert one.output == pathlib.Path('one.efi')
+    assert one.linux == pathlib.Path('/ARG1')
+    assert one.initrd == [pathlib.Path('/i1'), pathlib.Path('/i2')]
+    assert one.cmdline == 'a b'
+    assert one.uname == '4.5.6'
+
+    assert two.output == pathlib.Path('two.efi')
+    assert two.initrd == [pathlib.Path('/ARG2')]
+    assert two.cmdline == 'default'
+    assert two.uname == '1.2.3'
+    assert two.sign_kernel is False
+    assert two.sbat == ['sbat,1,foo\nfoo,1\n']
+
+def test_parse_manifest_ini(tmp_path):
+    manifest = tmp_path / 'manifest.conf'
+    manifest.write_text(textwrap.dedent(
+        '''
+        [Image:one]
+        Output = one.efi
+        Initrd = /i1 /i2
+
+        [Image:two]
+        Output = two.efi
+        Cmdline = x y z
+        '''))
+
+    opts = ukify.parse_args(['build-many', str(manifest), '--linux=/ARG1'])
+    one, two = opts.images
+    assert one.image_name == 'one'
+    assert one.initrd == [pathlib.Path('/i1'), pathlib.Path('/i2')]
+    assert two.image_name == 'two'
+    assert two.cmdline == 'x y z'
+
+    manifest.write_text('[Image:one]\nOutput = a.efi\n[Image:two]\nOutput = a.efi\n')
+    with pytest.raises(ValueError, match='same output'):
+        ukify.parse_args(['build-many', str(manifest), '--linux=/ARG1'])
+
+    manifest.write_text('[Image:one]\nNoSuchSetting = 1\n')
+    with pytest.raises(ValueError, match='NoSuchSetting'):
+        ukify.parse_args(['build-many', str(manifest), '--linux=/ARG1'])
+
 def test_help(capsys):
     with pytest.raises(SystemExit):
         ukify.parse_args(['--help'])
@@ -364,6 +718,19 @@ def test_help(capsys):
     assert '--section' in out.out
     assert not out.err
 
+def test_lazy_imports():
+    # Heavy modules are only imported by the verbs that need them
+    p = subprocess.run([sys.executable, '-X', 'importtime', ukify.__file__, '--help'],
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE,
+                       env=dict(os.environ, PAGER='cat'),
+                       text=True,
+                       check=True)
+    modules = {line.split('|')[-1].strip() for line in p.stderr.splitlines()}
+    assert 'argparse' in modules
+    for module in ('pefile', 'cryptography', 'multiprocessing', 'concurrent.futures', 'gzip'):
+        assert module not in modules
+
 def test_help_display(capsys):
     with pytest.raises(SystemExit):
         ukify.parse_args(['inspect', '--help'])
@@ -387,6 +754,12 @@ def test_help_error(capsys):
     assert '--no-such-option' in out.err
     assert len(out.err.splitlines()) == 1
 
+@pytest.fixture
+def stub(tmp_path):
+    path = tmp_path / 'stub.efi'
+    make_stub(path)
+    return path
+
 @pytest.fixture(scope='session')
 def kernel_initrd():
     opts = ukify.create_parser().parse_args(arg_tools)
@@ -521,6 +894,41 @@ baz,3
 
     assert found is True
 
+def test_merge_sbat(tmp_path, stub, monkeypatch, capsys):
+    addon = tmp_path / 'addon.efi'
+    ukify.make_uki(ukify.parse_args(['build', f'--stub={stub}', '--cmdline=ARG', f'--output={addon}',
+                                     '--sbat=sbat,1,foo\nfoo,2,Vendor,foo,2.0,https://example.com\n']))
+    other = tmp_path / 'other'
+    other.write_bytes(b'not a PE file')
+    text = tmp_path / 'sbat.csv'
+    text.write_text('sbat,1\nbar,1\nfoo,2,Someone Else\n')
+
+    # Components are listed once, with the lowest generation, in the order of their first appearance
+    merged = ukify.merge_sbat([addon, other], ['sbat,1,x\nfoo,1,Other\n\n', f'@{text}'])
+    assert merged == ukify.SBAT_HEADER + '\nfoo,1,Other\nbar,1\n\x00'
+    assert 'not a valid PE file' in capsys.readouterr().out
+
+    entries = ukify.parse_sbat(merged, 'test')
+    assert entries == [ukify.SbatEntry('foo', 1, ('Other',)), ukify.SbatEntry('bar', 1)]
+
+    for bad in ('foo,1\n', 'sbat,1\nfoo\n', 'sbat,1\nfoo,0\n', 'sbat,1\nfoo,x\n', 'sbat,1\nf/o,1\n',
+                'sbat,1\nfoo,1,a,b,c,d,e\n'):
+        with pytest.raises(ValueError):
+            ukify.merge_sbat([], [bad])
+
+    # The entries of a PE file are cached by its digest, so a later build does not need to parse it
+    cache = ukify.BuildCache(tmp_path / 'cache', 1024**2)
+    monkeypatch.setattr(ukify, '_SBATS', {})
+    entries = ukify.pe_sbat(addon, cache=cache)
+    assert entries == [ukify.SbatEntry('foo', 2, ('Vendor', 'foo', '2.0', 'https://example.com'))]
+
+    def fail(path):
+        raise AssertionError(f'{path} parsed again')
+
+    monkeypatch.setattr(ukify, '_SBATS', {})
+    monkeypatch.setattr(ukify, 'load_pe', fail)
+    assert ukify.pe_sbat(addon, cache=cache) == entries
+
 def unbase64(filename):
     tmp = tempfile.NamedTemporaryFile()
     base64.decode(filename.open('rb'), tmp)
@@ -535,6 +943,94 @@ def test_uname_scraping(kernel_initrd):
     uname = ukify.Uname.scrape(kernel_initrd[1])
     assert re.match(r'\d+\.\d+\.\d+', uname)
 
+@pytest.mark.parametrize('elf_class,e', [(2, '<'), (1, '>')])
+def test_uname_scrape_elf(elf_class, e, tmp_path):
+    import struct
+
+    def note(name, type_, desc):
+        name += b'\0'
+        return (struct.pack(f'{e}III', len(name), len(desc), type_) +
+                name.ljust(ukify.round_up(len(name), 4), b'\0') +
+                desc.ljust(ukify.round_up(len(desc), 4), b'\0'))
+
+    notes = note(b'GNU', 3, b'\x01' * 20) + note(b'Linux', 0x100, b'6.1.0-test\0')
+
+    # A minimal ELF file with one PT_NOTE segment directly after the headers
+    if elf_class == 2:
+        ehdr = struct.pack(f'{e}HHIQQQIHHHHHH', 2, 62, 1, 0, 64, 0, 0, 64, 56, 1, 64, 0, 0)
+        phdr = struct.pack(f'{e}IIQQQQQQ', 4, 0, 64 + 56, 0, 0, len(notes), len(notes), 4)
+    else:
+        ehdr = struct.pack(f'{e}HHIIIIIHHHHHH', 2, 3, 1, 0, 52, 0, 0, 52, 32, 1, 40, 0, 0)
+        phdr = struct.pack(f'{e}IIIIIIII', 4, 52 + 32, 0, 0, len(notes), len(notes), 0, 4)
+    ident = b'\x7fELF' + bytes([elf_class, 1 if e == '<' else 2, 1]) + bytes(9)
+
+    kernel = tmp_path / 'vmlinux'
+    kernel.write_bytes(ident + ehdr + phdr + notes)
+
+    assert [n[:2] for n in ukify.elf_notes(kernel)] == [(b'GNU', 3), (b'Linux', 0x100)]
+    assert ukify.Uname.scrape_elf(kernel) == '6.1.0-test'
+    assert ukify.Uname.scrape(kernel) == '6.1.0-test'
+
+    kernel.write_bytes(ident + ehdr + phdr + note(b'GNU', 3, b'\x01' * 20))
+    with pytest.raises(ValueError):
+        ukify.Uname.scrape_elf(kernel)
+
+    kernel.write_bytes(b'MZ' + bytes(100))
+    with pytest.raises(ValueError):
+        ukify.Uname.scrape_elf(kernel)
+
+@pytest.mark.parametrize('compression', ['gzip', 'bz2', 'lzma', 'zstd', 'lz4'])
+def test_maybe_decompress_bounded(compression, tmp_path):
+    import bz2
+    import gzip
+    import lzma
+
+    if compression == 'zstd':
+        compress = pytest.importorskip('zstandard').compress
+    elif compression == 'lz4':
+        compress = pytest.importorskip('lz4.frame').compress
+    else:
+        compress = {
+            'gzip': gzip.compress,
+            'bz2': bz2.compress,
+            'lzma': lambda data: lzma.compress(data, format=lzma.FORMAT_ALONE),
+        }[compression]
+
+    # Zeros compress extremely well, but are still returned in chunks of bounded size
+    data = bytes(16 * 1024 * 1024) + b'end'
+    kernel = tmp_path / 'kernel'
+    kernel.write_bytes(compress(data))
+
+    chunks = list(ukify.maybe_decompress(kernel))
+    assert max(len(chunk) for chunk in chunks) <= ukify.DECOMPRESS_CHUNK_SIZE
+    assert b''.join(chunks) == data
+
+@pytest.mark.parametrize('compression', ['gzip', 'bz2', 'lzma'])
+def test_uname_scrape_generic(compression, tmp_path, monkeypatch):
+    import bz2
+    import gzip
+    import lzma
+
+    compress = {
+        'gzip': gzip.compress,
+        'bz2': bz2.compress,
+        'lzma': lambda data: lzma.compress(data, format=lzma.FORMAT_ALONE),
+    }[compression]
+
+    # Make the version string straddle a chunk boundary
+    monkeypatch.setattr(ukify, 'DECOMPRESS_CHUNK_SIZE', 1000)
+    text = b'Linux version 6.1.0-test (builder@host) (gcc) #1 SMP\0'
+    data = os.urandom(5000) + text + os.urandom(5000)
+    kernel = tmp_path / 'kernel'
+    kernel.write_bytes(compress(data))
+
+    assert b''.join(ukify.maybe_decompress(kernel)) == data
+    assert ukify.Uname.scrape_generic(kernel) == '6.1.0-test'
+
+    kernel.write_bytes(compress(os.urandom(5000)))
+    with pytest.raises(ValueError):
+        ukify.Uname.scrape_generic(kernel)
+
 @pytest.mark.skipif(not slow_tests, reason='slow')
 @pytest.mark.parametrize("days", [365*10, None])
 def test_efi_signing_sbsign(days, kernel_initrd, tmp_path):
@@ -581,6 +1077,109 @@ def test_efi_signing_sbsign(days, kernel_initrd, tmp_path):
 
     shutil.rmtree(tmp_path)
 
+def test_efi_signing_pipeline(tmp_path, stub):
+    linux = tmp_path / 'linux'
+    linux.write_bytes(os.urandom(64 * 1024))
+
+    # A stand-in for sbsign, which records its input and appends a fake signature
+    tools = tmp_path / 'tools'
+    tools.mkdir()
+    (tools / 'sbsign').write_text(textwrap.dedent(f'''\
+        #!/bin/sh
+        while [ $# -gt 0 ]; do
+            case "$1" in
+                --key|--cert) shift 2;;
+                --output) out=$2; shift 2;;
+                *) in=$1; shift;;
+            esac
+        done
+        echo "$in" >>{tmp_path}/inputs
+        cat "$in" >"$out" && echo SIGNED >>"$out"
+        '''))
+    (tools / 'sbsign').chmod(0o755)
+
+    output = tmp_path / 'out' / 'signed.efi'
+    output.parent.mkdir()
+    args = [
+        'build',
+        f'--stub={stub}',
+        f'--linux={linux}',
+        '--uname=1.2.3',
+        '--os-release=ID=foo',
+        f'--tools={tools}',
+    ]
+    ukify.make_uki(ukify.parse_args([*args, '--secureboot-private-key=KEY', '--secureboot-certificate=CERT',
+                                     '--no-sign-kernel', f'--output={output}']))
+    ukify.make_uki(ukify.parse_args([*args, f'--output={tmp_path / "unsigned.efi"}']))
+
+    assert output.read_bytes() == (tmp_path / 'unsigned.efi').read_bytes() + b'SIGNED\n'
+    assert output.stat().st_mode & 0o100
+    # Nothing but the output is written to the output directory
+    assert os.listdir(output.parent) == ['signed.efi']
+    if hasattr(os, 'memfd_create'):
+        assert (tmp_path / 'inputs').read_text().startswith('/proc/')
+
+def test_efi_signing_builtin(tmp_path, stub, capsys):
+    pytest.importorskip('cryptography')
+    from cryptography import x509
+    from cryptography.hazmat.primitives.serialization import pkcs7
+
+    ourdir = pathlib.Path(__file__).parent
+    cert = unbase64(ourdir / 'example.signing.crt.base64')
+    key = unbase64(ourdir / 'example.signing.key.base64')
+
+    linux = tmp_path / 'linux'
+    linux.write_bytes(os.urandom(64 * 1024))
+    args = [
+        'build',
+        f'--stub={stub}',
+        f'--linux={linux}',
+        '--uname=1.2.3',
+        '--os-release=ID=foo',
+    ]
+
+    unsigned = tmp_path / 'unsigned.efi'
+    ukify.make_uki(ukify.parse_args([*args, f'--output={unsigned}']))
+    assert not ukify.pe_is_signed(unsigned)
+
+    signed = tmp_path / 'signed.efi'
+    opts = ukify.parse_args([*args,
+                             '--signtool=builtin',
+                             f'--secureboot-certificate={cert.name}',
+                             f'--secureboot-private-key={key.name}',
+                             '--no-sign-kernel',
+                             f'--output={signed}'])
+    capsys.readouterr()
+    ukify.make_uki(opts)
+    assert ukify.pe_is_signed(signed)
+    # The unsigned image is only a temporary file, the message names the output
+    assert capsys.readouterr().out.splitlines()[0] == f'Signing {signed}'
+
+    # The signature is appended, and the certificate table is not covered by the Authenticode hash
+    data = signed.read_bytes()
+    assert data.startswith(unsigned.read_bytes()[:0x40])
+    pe = ukify.PEImage.load(signed)
+    offset, size = pe.directory(ukify.IMAGE_DIRECTORY_ENTRY_SECURITY)
+    assert offset == unsigned.stat().st_size
+    assert offset + size == len(data)
+    digest = ukify.authenticode_digest(pe, signed, len(data))
+    assert digest == ukify.authenticode_digest(ukify.PEImage.load(unsigned), unsigned, offset)
+
+    length, revision, cert_type = ukify.WIN_CERTIFICATE.unpack_from(data, offset)
+    assert (revision, cert_type) == (0x0200, 0x0002)
+    blob = data[offset + 8:offset + length]
+    assert digest in blob
+    certificate = x509.load_pem_x509_certificate(pathlib.Path(cert.name).read_bytes())
+    assert pkcs7.load_der_pkcs7_certificates(blob) == [certificate]
+
+    if shutil.which('sbverify'):
+        dump = subprocess.check_output(['sbverify', '--cert', cert.name, signed], text=True)
+        assert 'Signature verification OK' in dump
+
+    with pytest.raises(ValueError, match='--signing-engine'):
+        ukify.parse_args([*args, '--signtool=builtin', '--signing-engine=foo',
+                          '--secureboot-certificate=CERT', '--secureboot-private-key=KEY'])
+
 @pytest.mark.skipif(not slow_tests, reason='slow')
 def test_efi_signing_pesign(kernel_initrd, tmp_path):
     if kernel_initrd is None:
@@ -680,6 +1279,310 @@ def test_inspect(kernel_initrd, tmp_path, capsys):
 
     shutil.rmtree(tmp_path)
 
+def test_inspect_many(tmp_path, stub, capsys):
+    linux = tmp_path / 'linux'
+    linux.write_bytes(os.urandom(3 * 1024 * 1024))
+
+    outputs = []
+    for i in range(3):
+        output = tmp_path / f'uki{i}.efi'
+        opts = ukify.parse_args([
+            'build',
+            f'--stub={stub}',
+            f'--linux={linux}',
+            f'--cmdline=ARG{i}',
+            '--uname=1.2.3',
+            '--os-release=ID=foo',
+            f'--output={output}',
+        ])
+        ukify.make_uki(opts)
+        outputs += [output]
+    capsys.readouterr()
+
+    opts = ukify.parse_args(['inspect', *map(str, outputs), '--json=short', '--jobs=2'])
+    ukify.inspect_sections(opts)
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 3
+    for i, (line, output) in enumerate(zip(lines, outputs)):
+        desc = json.loads(line)
+        assert desc['file'] == str(output)
+        sections = desc['sections']
+        assert sections['.cmdline']['text'] == f'ARG{i}'
+        assert sections['.linux']['size'] == linux.stat().st_size
+        assert sections['.linux']['sha256'] == hashlib.sha256(linux.read_bytes()).hexdigest()
+
+    # A config file is only read if given explicitly
+    config = tmp_path / 'ukify.conf'
+    config.write_text('[UKI]\nCmdline=ARG9\n')
+    assert ukify.parse_args(['inspect', str(outputs[0])]).cmdline is None
+    assert ukify.parse_args(['inspect', str(outputs[0]), f'--config={config}']).cmdline == 'ARG9'
+
+    opts = ukify.parse_args(['inspect', *map(str, outputs), '--digest-only'])
+    ukify.inspect_sections(opts)
+    text = capsys.readouterr().out
+    assert text.count('.cmdline:\n  size: 4 bytes\n') == 3
+    assert 'text:' not in text
+
+    with pytest.raises(ValueError):
+        ukify.parse_args(['inspect', *map(str, outputs), '--json=pretty'])
+
+def test_build_profiles(tmp_path, stub, capsys):
+    linux = tmp_path / 'linux'
+    linux.write_bytes(os.urandom(1024 * 1024))
+    initrd = tmp_path / 'initrd'
+    initrd.write_bytes(os.urandom(512 * 1024))
+
+    args = [
+        'build',
+        f'--stub={stub}',
+        f'--linux={linux}',
+        f'--initrd={initrd}',
+        '--uname=1.2.3',
+        '--os-release=ID=foo',
+        '--cmdline=ARG0',
+        '--measure',
+        '--pcr-banks=sha256',
+    ]
+
+    # One image with two profiles, and an image for each of them
+    uki = tmp_path / 'uki.efi'
+    ukify.make_uki(ukify.parse_args([*args, f'--output={uki}',
+                                     '--profile-section=one:.cmdline:ARG1',
+                                     '--profile-section=two:.cmdline:ARG2',
+                                     '--profile-section=two:.osrel:ID=bar']))
+    captured = capsys.readouterr()
+    assert 'stub which supports .profile sections' in captured.err
+
+    # Only the shared sections are measured, like an image without profiles
+    shared = tmp_path / 'shared.efi'
+    ukify.make_uki(ukify.parse_args([*args, f'--output={shared}']))
+    pcrs = [line for line in capsys.readouterr().out.splitlines() if line.startswith('11:')]
+    assert [line for line in captured.out.splitlines() if line.startswith('11:')] == pcrs
+
+    separate = []
+    for cmdline, osrel in (('ARG1', 'ID=foo'), ('ARG2', 'ID=bar')):
+        output = tmp_path / f'{cmdline}.efi'
+        ukify.make_uki(ukify.parse_args([*args, f'--cmdline={cmdline}', f'--os-release={osrel}',
+                                         f'--output={output}']))
+        separate += [output]
+    capsys.readouterr()
+
+    pe = pefile.PE(uki, fast_load=True)
+    names = [s.Name.rstrip(b'\0').decode() for s in pe.sections]
+    assert names == ['.text', '.osrel', '.cmdline', '.uname', '.initrd', '.sbat', '.linux',
+                     '.profile', '.cmdline', '.profile', '.cmdline', '.osrel']
+
+    # The payloads are shared
+    assert uki.stat().st_size < sum(p.stat().st_size for p in separate) * 0.6
+
+    opts = ukify.parse_args(['inspect', str(uki), '--json=short'])
+    ukify.inspect_sections(opts)
+    sections = json.loads(capsys.readouterr().out)
+    assert sections['.cmdline']['text'] == 'ARG0'
+    assert sections['.profile@0']['text'] == 'ID=one\n'
+    assert sections['.cmdline@0']['text'] == 'ARG1'
+    assert sections['.profile@1']['text'] == 'ID=two\n'
+    assert sections['.cmdline@1']['text'] == 'ARG2'
+    assert sections['.osrel@1']['text'] == 'ID=bar'
+
+    with pytest.raises(ValueError, match='profiles'):
+        ukify.parse_args(['patch', str(uki), '--profile-section=three:.cmdline:ARG3'])
+    with pytest.raises(ValueError, match='contains profiles'):
+        ukify.patch_uki(ukify.parse_args(['patch', str(uki), '--cmdline=ARG3']))
+
+def test_build_profiles_pcrsig(tmp_path, stub, monkeypatch):
+    linux = tmp_path / 'linux'
+    linux.write_bytes(os.urandom(1024))
+    priv = unbase64(pathlib.Path(__file__).parent / 'example.tpm2-pcr-private.pem.base64')
+
+    # With PCR signing, only the shared sections are signed, which stubs that do not know about profiles
+    # use. The signatures are faked, each one records the command line it was made for.
+    def fake_measure(cmd, **kwargs):
+        cmdline = pathlib.Path(next(a for a in cmd if a.startswith('--cmdline=')).split('=', 1)[1])
+        return json.dumps({'sha1': [{'pol': cmdline.read_text()}]})
+
+    monkeypatch.setattr(ukify.subprocess, 'check_output', fake_measure)
+    output = tmp_path / 'uki.efi'
+    ukify.make_uki(ukify.parse_args(['build', f'--stub={stub}', f'--linux={linux}', f'--output={output}',
+                                     '--uname=1.2.3', '--os-release=ID=foo', '--cmdline=ARG0', '--pcr-banks=sha1',
+                                     f'--pcr-private-key={priv.name}',
+                                     '--profile-section=one:.cmdline:ARG1',
+                                     '--profile-section=two:.cmdline:ARG2']))
+
+    pe = pefile.PE(output, fast_load=True)
+    names = [s.Name.rstrip(b'\0').decode() for s in pe.sections]
+    assert names == ['.text', '.osrel', '.cmdline', '.uname', '.pcrpkey', '.sbat', '.pcrsig', '.linux',
+                     '.profile', '.cmdline', '.profile', '.cmdline']
+    pcrsigs = [json.loads(s.get_data(length=s.Misc_VirtualSize).rstrip(b'\0'))
+               for s in pe.sections if s.Name.rstrip(b'\0') == b'.pcrsig']
+    assert [sig['sha1'][0]['pol'] for sig in pcrsigs] == ['ARG0']
+
+def test_profile(tmp_path, stub, capsys, monkeypatch):
+    import gzip
+
+    linux = tmp_path / 'linux'
+    linux.write_bytes(gzip.compress(b'Linux version 1.2.3 (builder@host) (gcc) #1 SMP\0' + os.urandom(100000)))
+    output = tmp_path / 'uki.efi'
+
+    # main() sets the profile, restore it afterwards
+    monkeypatch.setattr(ukify, 'PROFILE', None)
+    monkeypatch.setattr(sys, 'argv', ['ukify', 'build', f'--stub={stub}', f'--linux={linux}',
+                                      '--os-release=ID=foo', f'--output={output}', '--profile=json'])
+    ukify.main()
+
+    out = capsys.readouterr()
+    assert 'Wrote unsigned' in out.out
+    profile = json.loads(out.err)
+    assert profile['verb'] == 'build'
+    assert profile['peak_rss_bytes'] > 0
+
+    phases = {p['name']: p for p in profile['phases']}
+    assert list(phases) == ['uname', 'sbat', 'measure', 'assemble']
+    assert phases['uname']['processed_bytes'] == linux.stat().st_size
+    assert phases['uname']['phases'][0]['name'] == 'decompress'
+    assert phases['assemble']['processed_bytes'] == output.stat().st_size
+    for phase in phases.values():
+        assert 0 <= phase['wall_seconds'] <= profile['wall_seconds']
+        assert phase['commands'] == []
+
+    # Without --profile, nothing is printed to stderr
+    monkeypatch.setattr(ukify, 'PROFILE', None)
+    monkeypatch.setattr(sys, 'argv', sys.argv[:-1])
+    ukify.main()
+    assert not capsys.readouterr().err
+
+def test_patch(tmp_path, stub, capsys, monkeypatch):
+    linux = tmp_path / 'linux'
+    linux.write_bytes(os.urandom(1024 * 1024))
+    initrd = tmp_path / 'initrd'
+    initrd.write_bytes(os.urandom(12345))
+
+    uki = tmp_path / 'uki.efi'
+    build_args = [
+        f'--stub={stub}',
+        f'--linux={linux}',
+        f'--initrd={initrd}',
+        '--uname=1.2.3',
+        '--os-release=ID=foo',
+    ]
+    ukify.make_uki(ukify.parse_args(['build', *build_args, '--cmdline=ARG1 ARG2', f'--output={uki}']))
+    size = uki.stat().st_size
+    before = pefile.PE(uki, fast_load=True)
+    linux_before = [s for s in before.sections if s.Name.startswith(b'.linux')][0]
+
+    # A shorter command line fits into the old section, and only the section and the headers are rewritten.
+    # By default a copy replaces the image, with --in-place the image itself is changed.
+    for args, arg in ((), 'ARG3'), (('--in-place',), 'ARG4'):
+        inode = uki.stat().st_ino
+        opts = ukify.parse_args(['patch', str(uki), f'--cmdline={arg}', *args])
+        ukify.patch_uki(opts)
+        assert 'Replacing .cmdline in place' in capsys.readouterr().out
+        assert (uki.stat().st_ino == inode) == bool(args)
+
+        pe = pefile.PE(uki, fast_load=True)
+        sections = {s.Name.rstrip(b'\0').decode(): s for s in pe.sections}
+        assert sections['.cmdline'].get_data(length=sections['.cmdline'].Misc_VirtualSize) == arg.encode()
+        assert len(pe.sections) == len(before.sections)
+        assert uki.stat().st_size == size
+    assert not list(tmp_path.glob('.#*'))
+
+    for args in ([f'--output={tmp_path / "x.efi"}'], ['--secureboot-certificate-name=foo']):
+        with pytest.raises(ValueError, match='--in-place'):
+            ukify.parse_args(['patch', str(uki), '--cmdline=ARG5', '--in-place', *args])
+
+    # A longer command line and a new section are added before .linux, whose contents stay in place
+    cmdline = 'x' * 5000
+    output = tmp_path / 'patched.efi'
+    opts = ukify.parse_args(['patch', str(uki), f'--cmdline={cmdline}', '--section=.test:TEST',
+                             f'--output={output}'])
+    ukify.patch_uki(opts)
+    out = capsys.readouterr().out
+    assert 'Moving .cmdline to the end of the image' in out
+    assert 'Adding .test' in out
+
+    pe = pefile.PE(output)
+    assert not pe.get_warnings()
+    names = [s.Name.rstrip(b'\0').decode() for s in pe.sections]
+    assert names[-3:] == ['.cmdline', '.test', '.linux']
+    sections = dict(zip(names, pe.sections))
+    assert sections['.cmdline'].get_data(length=sections['.cmdline'].Misc_VirtualSize) == cmdline.encode()
+    assert sections['.test'].get_data(length=4) == b'TEST'
+    assert sections['.linux'].PointerToRawData == linux_before.PointerToRawData
+    assert sections['.linux'].get_data(length=sections['.linux'].Misc_VirtualSize) == linux.read_bytes()
+    assert sections['.linux'].VirtualAddress > sections['.test'].VirtualAddress
+    assert pe.OPTIONAL_HEADER.SizeOfImage == ukify.round_up(
+        sections['.linux'].VirtualAddress + sections['.linux'].Misc_VirtualSize, 0x1000)
+
+    # The PCR values of the patched image are the same as those of an image built from scratch
+    opts = ukify.parse_args(['patch', str(output), '--os-release=ID=bar', '--measure'])
+    ukify.patch_uki(opts)
+    patched = [line for line in capsys.readouterr().out.splitlines() if line.startswith('11:')]
+
+    opts = ukify.parse_args(['build', *build_args, '--os-release=ID=bar', f'--cmdline={cmdline}',
+                             '--section=.test:TEST', '--measure', f'--output={tmp_path / "built.efi"}'])
+    ukify.make_uki(opts)
+    built = [line for line in capsys.readouterr().out.splitlines() if line.startswith('11:')]
+    assert patched == built
+
+    # If signing fails, an image patched in place is left as it was
+    def failing_sign(*args, **kwargs):
+        raise ValueError('signing failed')
+
+    monkeypatch.setattr(ukify, 'builtin_sign', failing_sign)
+    contents = uki.read_bytes()
+    opts = ukify.parse_args(['patch', str(uki), '--cmdline=ARG4', '--signtool=builtin',
+                             f'--secureboot-private-key={tmp_path / "key"}',
+                             f'--secureboot-certificate={tmp_path / "cert"}'])
+    with pytest.raises(ValueError, match='signing failed'):
+        ukify.patch_uki(opts)
+    assert uki.read_bytes() == contents
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith('.#')]
+
+    with pytest.raises(ValueError, match='cannot be replaced'):
+        ukify.parse_args(['patch', str(uki), f'--linux={linux}'])
+    with pytest.raises(ValueError, match='no sections'):
+        ukify.patch_uki(ukify.parse_args(['patch', str(uki)]))
+
+def test_pcr_signing_parallel(tmp_path, monkeypatch, capsys):
+    import threading
+
+    linux = tmp_path / 'linux'
+    linux.write_bytes(b'kernel')
+    keys = ['KEY0', 'KEY1', 'KEY2']
+
+    # The signatures are faked. Each signing job waits for the job of the next key to finish, so the jobs
+    # finish in the reverse order of the keys.
+    done = {key: threading.Event() for key in keys}
+
+    def fake_measure(cmd, **kwargs):
+        key = next(a for a in cmd if a.startswith('--private-key=')).split('=', 1)[1]
+        phases = [a.split('=', 1)[1] for a in cmd if a.startswith('--phase=')]
+        index = keys.index(key)
+        if index + 1 < len(keys):
+            assert done[keys[index + 1]].wait(timeout=10)
+        done[key].set()
+        return json.dumps({'sha256': [{'pkfp': key, 'phases': phases}]})
+
+    monkeypatch.setattr(ukify.subprocess, 'check_output', fake_measure)
+    opts = ukify.parse_args(['build', f'--linux={linux}', '--pcr-banks=sha256', '--signing-jobs=3',
+                             *(f'--pcr-private-key={key}' for key in keys),
+                             '--phases=enter-initrd', '--phases=enter-initrd:leave-initrd', '--phases=sysinit'])
+    uki = ukify.UKI([])
+    ukify.call_systemd_measure(uki, linux, opts=opts)
+
+    # The signatures are combined in the order of the keys, with the phases of each key
+    pcrsig = json.loads(uki.sections[-1].content.data)
+    assert [sig['pkfp'] for sig in pcrsig['sha256']] == keys
+    assert [sig['phases'] for sig in pcrsig['sha256']] == [['enter-initrd'], ['enter-initrd:leave-initrd'], ['sysinit']]
+
+    took = [line for line in capsys.readouterr().out.splitlines() if ' took ' in line]
+    assert [line.split()[3] for line in took] == keys
+
+    for option in ('--jobs', '--signing-jobs'):
+        for value in ('0', '-1'):
+            with pytest.raises(SystemExit):
+                ukify.parse_args(['build', f'--linux={linux}', f'{option}={value}'])
+
 @pytest.mark.skipif(not slow_tests, reason='slow')
 def test_pcr_signing(kernel_initrd, tmp_path):
     if kernel_initrd is None:
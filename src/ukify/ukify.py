@@ -23,23 +23,26 @@ import argparse
 import configparser
 import contextlib
 import collections
+import copy
 import dataclasses
 import datetime
 import fnmatch
+import functools
+import hashlib
 import itertools
 import json
+import mmap
 import os
 import pathlib
-import pprint
-import pydoc
 import re
 import shlex
 import shutil
-import socket
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
+import time
 import struct
 from hashlib import sha256
 from typing import (Any,
@@ -49,7 +52,8 @@ from typing import (Any,
                     Sequence,
                     Union)
 
-import pefile  # type: ignore
+# Modules which are slow to import, like pefile and cryptography, or which are only needed for some
+# operations, are imported where they are used, to keep the startup fast.
 
 __version__ = '{{PROJECT_VERSION_FULL}} ({{VERSION_TAG}})'
 
@@ -109,6 +113,7 @@ def page(text: str, enabled: Optional[bool]) -> None:
     if enabled:
         # Initialize less options from $SYSTEMD_LESS or provide a suitable fallback.
         os.environ['LESS'] = os.getenv('SYSTEMD_LESS', 'FRSXMK')
+        import pydoc
         pydoc.pager(text)
     else:
         print(text)
@@ -129,8 +134,60 @@ def try_import(modname, name=None):
     except ImportError as e:
         raise ValueError(f'Kernel is compressed with {name or modname}, but module unavailable') from e
 
+# Compressed data is fed to the decompressors, and decompressed data is returned, in chunks of this size
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+
+def iter_decompress(decompressor, f, size=None):
+    """Feed up to size bytes from f to an incremental decompressor. Yield the output in chunks.
+
+    Works with the decompressor objects of zlib, bz2, lzma and lz4.frame, which all have a decompress()
+    method with a max_length argument and an eof attribute. The output is limited to DECOMPRESS_CHUNK_SIZE
+    bytes per call, so that highly compressible input does not expand in one go.
+    """
+    data = b''
+    needs_input = True
+    while not decompressor.eof:
+        if needs_input:
+            n = DECOMPRESS_CHUNK_SIZE if size is None else min(DECOMPRESS_CHUNK_SIZE, size)
+            data = f.read(n)
+            if not data:
+                # Truncated input, return what we got
+                return
+            if size is not None:
+                size -= len(data)
+
+        out = decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+
+        # zlib returns the input it did not get to in unconsumed_tail, and has more output pending if
+        # the limit was reached. The others keep the input internally, and tell if they need more.
+        data = getattr(decompressor, 'unconsumed_tail', b'')
+        needs_input = getattr(decompressor, 'needs_input', not data and len(out) < DECOMPRESS_CHUNK_SIZE)
+        if out:
+            yield out
+
+def iter_zstd(f, size=None):
+    try:
+        import zstandard
+    except ImportError:
+        # python-zstd can only decompress all of the data at once
+        zstd = try_import('zstd')
+        yield zstd.uncompress(f.read(-1 if size is None else size))
+        return
+
+    # The decompressobj() of zstandard has no limit for the output, but the stream reader does. The
+    # reader stops at the end of the frame, so the size of the input does not need to be enforced.
+    reader = zstandard.ZstdDecompressor().stream_reader(f, read_size=DECOMPRESS_CHUNK_SIZE, closefd=False)
+    with reader:
+        while data := reader.read(DECOMPRESS_CHUNK_SIZE):
+            yield data
+
+def iter_file(f):
+    while data := f.read(DECOMPRESS_CHUNK_SIZE):
+        yield data
+
 def get_zboot_kernel(f):
-    """Decompress zboot efistub kernel if compressed. Return contents."""
+    """Decompress zboot efistub kernel if compressed. Yield contents in chunks."""
     # See linux/drivers/firmware/efi/libstub/Makefile.zboot
     # and linux/drivers/firmware/efi/libstub/zboot-header.S
 
@@ -151,74 +208,146 @@ def get_zboot_kernel(f):
     comp_type = f.read(6)
     f.seek(start)
     if comp_type.startswith(b'gzip'):
-        gzip = try_import('gzip')
-        return gzip.open(f).read(size)
+        zlib = try_import('zlib', 'gzip')
+        yield from iter_decompress(zlib.decompressobj(16 + zlib.MAX_WBITS), f, size)
     elif comp_type.startswith(b'lz4'):
         lz4 = try_import('lz4.frame', 'lz4')
-        return lz4.frame.decompress(f.read(size))
+        yield from iter_decompress(lz4.frame.LZ4FrameDecompressor(), f, size)
     elif comp_type.startswith(b'lzma'):
         lzma = try_import('lzma')
-        return lzma.open(f).read(size)
+        yield from iter_decompress(lzma.LZMADecompressor(), f, size)
     elif comp_type.startswith(b'lzo'):
         raise NotImplementedError('lzo decompression not implemented')
     elif comp_type.startswith(b'xzkern'):
         raise NotImplementedError('xzkern decompression not implemented')
     elif comp_type.startswith(b'zstd22'):
-        zstd = try_import('zstd')
-        return zstd.uncompress(f.read(size))
+        yield from iter_zstd(f, size)
     else:
         raise NotImplementedError(f'unknown compressed type: {comp_type}')
 
 def maybe_decompress(filename):
-    """Decompress file if compressed. Return contents."""
-    f = open(filename, 'rb')
-    start = f.read(4)
-    f.seek(0)
-
-    if start.startswith(b'\x7fELF'):
-        # not compressed
-        return f.read()
-
-    if start.startswith(b'MZ'):
-        f.seek(4)
-        img_type = f.read(4)
-        if img_type.startswith(b'zimg'):
-            # zboot efistub kernel
-            return get_zboot_kernel(f)
-        else:
-            # not compressed aarch64 and riscv64
-            return f.read()
+    """Decompress file if compressed. Yield contents in chunks.
+
+    The data is decompressed incrementally, so memory use is bounded and the caller can stop early.
+    """
+    with open(filename, 'rb') as f:
+        start = f.read(4)
+        f.seek(0)
+
+        if start.startswith(b'\x7fELF'):
+            # not compressed
+            yield from iter_file(f)
+            return
+
+        if start.startswith(b'MZ'):
+            f.seek(4)
+            img_type = f.read(4)
+            if img_type.startswith(b'zimg'):
+                # zboot efistub kernel
+                yield from get_zboot_kernel(f)
+            else:
+                # not compressed aarch64 and riscv64
+                yield from iter_file(f)
+            return
 
-    if start.startswith(b'\x1f\x8b'):
-        gzip = try_import('gzip')
-        return gzip.open(f).read()
+        if start.startswith(b'\x1f\x8b'):
+            zlib = try_import('zlib', 'gzip')
+            yield from iter_decompress(zlib.decompressobj(16 + zlib.MAX_WBITS), f)
+            return
 
-    if start.startswith(b'\x28\xb5\x2f\xfd'):
-        zstd = try_import('zstd')
-        return zstd.uncompress(f.read())
+        if start.startswith(b'\x28\xb5\x2f\xfd'):
+            yield from iter_zstd(f)
+            return
 
-    if start.startswith(b'\x02\x21\x4c\x18'):
-        lz4 = try_import('lz4.frame', 'lz4')
-        return lz4.frame.decompress(f.read())
+        if start.startswith(b'\x02\x21\x4c\x18'):
+            lz4 = try_import('lz4.frame', 'lz4')
+            yield from iter_decompress(lz4.frame.LZ4FrameDecompressor(), f)
+            return
 
-    if start.startswith(b'\x04\x22\x4d\x18'):
-        print('Newer lz4 stream format detected! This may not boot!')
-        lz4 = try_import('lz4.frame', 'lz4')
-        return lz4.frame.decompress(f.read())
+        if start.startswith(b'\x04\x22\x4d\x18'):
+            print('Newer lz4 stream format detected! This may not boot!')
+            lz4 = try_import('lz4.frame', 'lz4')
+            yield from iter_decompress(lz4.frame.LZ4FrameDecompressor(), f)
+            return
 
-    if start.startswith(b'\x89LZO'):
-        # python3-lzo is not packaged for Fedora
-        raise NotImplementedError('lzo decompression not implemented')
+        if start.startswith(b'\x89LZO'):
+            # python3-lzo is not packaged for Fedora
+            raise NotImplementedError('lzo decompression not implemented')
 
-    if start.startswith(b'BZh'):
-        bz2 = try_import('bz2', 'bzip2')
-        return bz2.open(f).read()
+        if start.startswith(b'BZh'):
+            bz2 = try_import('bz2', 'bzip2')
+            yield from iter_decompress(bz2.BZ2Decompressor(), f)
+            return
 
-    if start.startswith(b'\x5d\x00\x00'):
-        lzma = try_import('lzma')
-        return lzma.open(f).read()
+        if start.startswith(b'\x5d\x00\x00'):
+            lzma = try_import('lzma')
+            yield from iter_decompress(lzma.LZMADecompressor(), f)
+            return
+
+        raise NotImplementedError(f'unknown file format (starts with {start})')
+
+
+ELF_PT_NOTE = 4
+ELF_SHT_NOTE = 7
 
-    raise NotImplementedError(f'unknown file format (starts with {start})')
+def elf_notes(filename):
+    """Yield (name, type, description) for each note in an ELF file
+
+    The notes are taken from the PT_NOTE segments or, if there are none, from the SHT_NOTE sections.
+    The file is mapped into memory, so only the pages with the headers and the notes are read.
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 64:
+            raise ValueError(f'{filename} is not an ELF file')
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:4] != b'\x7fELF':
+                raise ValueError(f'{filename} is not an ELF file')
+
+            elf_class, elf_data = m[4], m[5]
+            if elf_class not in (1, 2) or elf_data not in (1, 2):
+                raise ValueError(f'{filename}: unsupported ELF class {elf_class} or data encoding {elf_data}')
+
+            e = '<' if elf_data == 1 else '>'
+            try:
+                if elf_class == 2:
+                    (phoff, shoff, _, _, phentsize, phnum,
+                     shentsize, shnum, _) = struct.unpack_from(f'{e}QQIHHHHHH', m, 0x20)
+                    phdrs = [struct.unpack_from(f'{e}IIQQQQQQ', m, phoff + i * phentsize)
+                             for i in range(phnum)]
+                    # p_type, p_offset, p_filesz, p_align
+                    segments = [(p[0], p[2], p[5], p[7]) for p in phdrs]
+                    shdrs = [struct.unpack_from(f'{e}IIQQQQIIQQ', m, shoff + i * shentsize)
+                             for i in range(shnum)]
+                    # sh_type, sh_offset, sh_size, sh_addralign
+                    sections = [(sh[1], sh[4], sh[5], sh[8]) for sh in shdrs]
+                else:
+                    (phoff, shoff, _, _, phentsize, phnum,
+                     shentsize, shnum, _) = struct.unpack_from(f'{e}IIIHHHHHH', m, 0x1c)
+                    phdrs = [struct.unpack_from(f'{e}IIIIIIII', m, phoff + i * phentsize)
+                             for i in range(phnum)]
+                    segments = [(p[0], p[1], p[4], p[7]) for p in phdrs]
+                    shdrs = [struct.unpack_from(f'{e}IIIIIIIIII', m, shoff + i * shentsize)
+                             for i in range(shnum)]
+                    sections = [(sh[1], sh[4], sh[5], sh[8]) for sh in shdrs]
+
+                regions = ([(off, size, align) for type_, off, size, align in segments if type_ == ELF_PT_NOTE] or
+                           [(off, size, align) for type_, off, size, align in sections if type_ == ELF_SHT_NOTE])
+
+                for offset, size, align in regions:
+                    # Notes are 4-byte aligned, except for some GNU notes in 64-bit files
+                    align = 8 if align == 8 else 4
+                    pos, end = offset, min(offset + size, len(m))
+                    while pos + 12 <= end:
+                        namesz, descsz, type_ = struct.unpack_from(f'{e}III', m, pos)
+                        pos += 12
+                        name = m[pos:pos + namesz].rstrip(b'\0')
+                        pos += round_up(namesz, align)
+                        desc = m[pos:pos + descsz]
+                        pos += round_up(descsz, align)
+                        yield name, type_, desc
+            except struct.error as err:
+                raise ValueError(f'{filename}: truncated ELF file') from err
 
 
 class Uname:
@@ -226,12 +355,16 @@ class Uname:
 
     VERSION_PATTERN = r'(?P<version>[a-z0-9._-]+) \([^ )]+\) (?:#.*)'
 
-    NOTES_PATTERN = r'^\s+Linux\s+0x[0-9a-f]+\s+OPEN\n\s+description data: (?P<version>[0-9a-f ]+)\s*$'
+    # The 'Linux' note with the kernel release, see include/linux/build-salt.h
+    LINUX_NOTE_NAME = b'Linux'
+    LINUX_NOTE_TYPE = 0x100
 
     # Linux version 6.0.8-300.fc37.ppc64le (mockbuild@buildvm-ppc64le-03.iad2.fedoraproject.org)
     # (gcc (GCC) 12.2.1 20220819 (Red Hat 12.2.1-2), GNU ld version 2.38-24.fc37)
     # #1 SMP Fri Nov 11 14:39:11 UTC 2022
     TEXT_PATTERN = rb'Linux version (?P<version>\d\.\S+) \('
+    # The longest match of TEXT_PATTERN that is expected
+    TEXT_WINDOW = 4096
 
     @classmethod
     def scrape_x86(cls, filename, opts=None):
@@ -255,25 +388,11 @@ class Uname:
 
     @classmethod
     def scrape_elf(cls, filename, opts=None):
-        readelf = find_tool('readelf', opts=opts)
-
-        cmd = [
-            readelf,
-            '--notes',
-            filename,
-        ]
-
-        print('+', shell_join(cmd))
-        try:
-            notes = subprocess.check_output(cmd, stderr=subprocess.PIPE, text=True)
-        except subprocess.CalledProcessError as e:
-            raise ValueError(e.stderr.strip()) from e
+        for name, type_, desc in elf_notes(filename):
+            if name == cls.LINUX_NOTE_NAME and type_ == cls.LINUX_NOTE_TYPE:
+                return desc.decode().rstrip('\0')
 
-        if not (m := re.search(cls.NOTES_PATTERN, notes, re.MULTILINE)):
-            raise ValueError('Cannot find Linux version note')
-
-        text = ''.join(chr(int(c, 16)) for c in m.group('version').split())
-        return text.rstrip('\0')
+        raise ValueError('Cannot find Linux version note')
 
     @classmethod
     def scrape_generic(cls, filename, opts=None):
@@ -283,15 +402,24 @@ class Uname:
 
         # Based on https://gitlab.archlinux.org/archlinux/mkinitcpio/mkinitcpio/-/blob/master/functions#L209
 
-        text = maybe_decompress(filename)
-        if not (m := re.search(cls.TEXT_PATTERN, text)):
-            raise ValueError(f'Cannot find {cls.TEXT_PATTERN!r} in {filename}')
-
-        return m.group('version').decode()
+        # Search over a sliding window of the decompressed data, and stop at the first match. The tail of
+        # the previous chunk is kept, so that matches which cross chunk boundaries are found too.
+        tail = b''
+        with profile_phase('decompress') as record, \
+             contextlib.closing(maybe_decompress(filename)) as chunks:
+            record['processed_bytes'] = 0
+            for chunk in chunks:
+                record['processed_bytes'] += len(chunk)
+                window = tail + chunk
+                if m := re.search(cls.TEXT_PATTERN, window):
+                    return m.group('version').decode()
+                tail = window[-cls.TEXT_WINDOW:]
+
+        raise ValueError(f'Cannot find {cls.TEXT_PATTERN!r} in {filename}')
 
     @classmethod
     def scrape(cls, filename, opts=None):
-        for func in (cls.scrape_x86, cls.scrape_elf, cls.scrape_generic):
+        for func in (cls.scrape_elf, cls.scrape_x86, cls.scrape_generic):
             try:
                 version = func(filename, opts=opts)
                 print(f'Found uname version: {version}')
@@ -313,28 +441,115 @@ DEFAULT_SECTIONS_TO_SHOW = {
         '.pcrsig'   : 'text',
         '.sbat'     : 'text',
         '.sbom'     : 'binary',
+        '.profile'  : 'text',
 }
 
+@dataclasses.dataclass(frozen=True)
+class ConcatenatedFiles:
+    """A virtual file made of the contents of several files, each padded to a multiple of alignment"""
+    files: tuple[pathlib.Path, ...]
+    alignment: int = 4
+
+    def extents(self):
+        "Yield (path, offset, size, padding) for each of the files"
+        for file in self.files:
+            size = file.stat().st_size
+            yield file, 0, size, round_up(size, self.alignment) - size
+
+    def size(self):
+        return extents_size(self.extents())
+
+    def copy_to_offset(self, dst_fd: int, offset: int) -> None:
+        copy_extents_to_offset(self.extents(), dst_fd, offset)
+
+    def write_to(self, dst: IO) -> None:
+        write_extents(self.extents(), dst)
+
+
+@dataclasses.dataclass(frozen=True)
+class FileSlice:
+    """A part of a file, e.g. a section of an existing PE image"""
+    path: pathlib.Path
+    offset: int
+    length: int
+
+    def extents(self):
+        yield self.path, self.offset, self.length, 0
+
+    def size(self):
+        return self.length
+
+    def copy_to_offset(self, dst_fd: int, offset: int) -> None:
+        copy_extents_to_offset(self.extents(), dst_fd, offset)
+
+    def write_to(self, dst: IO) -> None:
+        write_extents(self.extents(), dst)
+
+
+@dataclasses.dataclass(frozen=True)
+class MemoryContent:
+    """Section contents held in memory, e.g. a command line or a PCR signature"""
+    data: bytes
+
+    def size(self):
+        return len(self.data)
+
+    def copy_to_offset(self, dst_fd: int, offset: int) -> None:
+        view = memoryview(self.data)
+        while view:
+            n = os.pwrite(dst_fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def write_to(self, dst: IO) -> None:
+        dst.write(self.data)
+
+
+def content_size(content) -> int:
+    if isinstance(content, pathlib.Path):
+        return content.stat().st_size
+    return content.size()
+
+
+def extents_size(extents) -> int:
+    return sum(size + padding for _, _, size, padding in extents)
+
+
+def copy_extents_to_offset(extents, dst_fd: int, offset: int) -> None:
+    for file, src_offset, size, padding in extents:
+        copy_file_to_offset(file, dst_fd, offset, size, src_offset=src_offset)
+        if padding:
+            os.pwrite(dst_fd, bytes(padding), offset + size)
+        offset += size + padding
+
+
+def write_extents(extents, dst: IO) -> None:
+    for file, offset, size, padding in extents:
+        with open(file, 'rb') as f:
+            f.seek(offset)
+            while size > 0 and (chunk := f.read(min(size, 1024 * 1024))):
+                dst.write(chunk)
+                size -= len(chunk)
+        dst.write(bytes(padding))
+
+
 @dataclasses.dataclass
 class Section:
     name: str
-    content: Optional[pathlib.Path]
-    tmpfile: Optional[IO] = None
+    content: Optional[Union[pathlib.Path, ConcatenatedFiles, FileSlice, MemoryContent]]
     measure: bool = False
     output_mode: Optional[str] = None
 
     @classmethod
     def create(cls, name, contents, **kwargs):
-        if isinstance(contents, (str, bytes)):
-            mode = 'wt' if isinstance(contents, str) else 'wb'
-            tmp = tempfile.NamedTemporaryFile(mode=mode, prefix=f'tmp{name}')
-            tmp.write(contents)
-            tmp.flush()
-            contents = pathlib.Path(tmp.name)
-        else:
-            tmp = None
+        # Literal contents are small, so they are kept in memory instead of being written to a temporary
+        # file. Files are referenced and only read when the image is written.
+        if isinstance(contents, str):
+            contents = contents.encode()
+        if isinstance(contents, bytes):
+            contents = MemoryContent(contents)
 
-        return cls(name, contents, tmpfile=tmp, **kwargs)
+        return cls(name, contents, **kwargs)
 
     @classmethod
     def parse_input(cls, s):
@@ -363,7 +578,13 @@ class Section:
         return cls.create(name, out, output_mode=ttype)
 
     def size(self):
-        return self.content.stat().st_size
+        return content_size(self.content)
+
+    def copy_to_offset(self, dst_fd: int, offset: int, size: int) -> None:
+        if isinstance(self.content, pathlib.Path):
+            copy_file_to_offset(self.content, dst_fd, offset, size)
+        else:
+            self.content.copy_to_offset(dst_fd, offset)
 
     def check_name(self):
         # PE section names with more than 8 characters are legal, but our stub does
@@ -380,12 +601,259 @@ class UKI:
     sections: list[Section] = dataclasses.field(default_factory=list, init=False)
 
     def add_section(self, section):
-        if section.name in [s.name for s in self.sections]:
+        # The sections after a .profile section belong to that profile, and may have the same names as
+        # the sections before the first .profile section, which are shared by all profiles
+        start = max((i + 1 for i, s in enumerate(self.sections) if s.name == '.profile'), default=0)
+        if section.name in [s.name for s in self.sections[start:]]:
             raise ValueError(f'Duplicate section {section.name}')
 
         self.sections += [section]
 
 
+class Profile:
+    """Wall and CPU time, I/O and memory use of the phases of a command, see --profile
+
+    Phases nest and are recorded in the order in which they are entered. External tools are recorded
+    with the phase they are called from. The CPU time of a phase includes all threads of the process,
+    and the tools which finished during the phase are accounted separately. The peak RSS of a phase
+    is the high-water mark of the process at the end of the phase.
+    """
+
+    def __init__(self):
+        self.start = self._usage()
+        self.root: dict[str, Any] = {'phases': [], 'commands': []}
+        self._stack = [self.root]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _usage() -> dict[str, Union[int, float]]:
+        import resource
+
+        try:
+            with open('/proc/self/io') as f:
+                io = dict(line.split(': ') for line in f.read().splitlines())
+        except OSError:
+            io = {}
+
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            'wall_seconds': time.monotonic(),
+            'cpu_seconds': time.process_time(),
+            'children_cpu_seconds': children.ru_utime + children.ru_stime,
+            'read_bytes': int(io.get('rchar', 0)),
+            'written_bytes': int(io.get('wchar', 0)),
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+
+    @staticmethod
+    def _metrics(start, end) -> dict[str, Union[int, float]]:
+        metrics = {key: end[key] - start[key] for key in start}
+        metrics['peak_rss_bytes'] = end['peak_rss_bytes']
+        return {key: round(value, 6) if isinstance(value, float) else value
+                for key, value in metrics.items()}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Record the enclosed code as a phase
+
+        Yields a dict, in which 'processed_bytes' can be set to the amount of data the phase worked on.
+        """
+        record = {'name': name, 'phases': [], 'commands': []}
+        with self._lock:
+            self._stack[-1]['phases'].append(record)
+            self._stack.append(record)
+        start = self._usage()
+
+        try:
+            yield record
+        finally:
+            metrics = self._metrics(start, self._usage())
+            with self._lock:
+                self._stack.remove(record)
+            # Keep the name and the metrics of the phase ahead of the nested phases
+            phases, commands = record.pop('phases'), record.pop('commands')
+            record.update(metrics)
+            record.update(phases=phases, commands=commands)
+
+    @contextlib.contextmanager
+    def command(self, cmd):
+        "Record the run time of an external tool called in the enclosed code"
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._stack[-1]['commands'].append({
+                    'command': shell_join(cmd),
+                    'wall_seconds': round(time.monotonic() - start, 6),
+                })
+
+    def add(self, record: dict[str, Any]):
+        "Add a phase recorded by another process"
+        with self._lock:
+            self._stack[-1]['phases'].append(record)
+
+    def report(self, verb: str) -> dict[str, Any]:
+        import resource
+
+        return {
+            'version': __version__,
+            'verb': verb,
+            **self._metrics(self.start, self._usage()),
+            'children_peak_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            **self.root,
+        }
+
+
+# The profile of the running command, if --profile is used. Worker processes inherit it.
+PROFILE: Optional[Profile] = None
+
+
+def profile_phase(name: str):
+    "Record the enclosed code as a phase of the profile, if one is taken"
+    return PROFILE.phase(name) if PROFILE else contextlib.nullcontext({})
+
+
+def profile_command(cmd):
+    "Record the run time of the external tool called in the enclosed code, if a profile is taken"
+    return PROFILE.command(cmd) if PROFILE else contextlib.nullcontext()
+
+
+class BuildCache:
+    """A content-addressed cache of intermediate build results
+
+    Entries are keyed by the SHA-256 of all inputs that influence the result. If no directory is
+    configured, nothing is cached and the results are simply computed. Entries are evicted in
+    least-recently-used order when the total size of the cache exceeds max_size.
+    """
+
+    def __init__(self, directory: Optional[pathlib.Path], max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self._digests: dict[tuple, str] = {}
+        self._tmpfiles: list[IO] = []
+
+    def __getstate__(self):
+        # Temporary files stay with the process that created them
+        return dict(self.__dict__, _tmpfiles=[])
+
+    def file_digest(self, path: pathlib.Path) -> str:
+        memo = file_identity(path)
+        if digest := self._digests.get(memo):
+            return digest
+
+        h = sha256()
+        with path.open('rb') as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        digest = self._digests[memo] = h.hexdigest()
+        return digest
+
+    def digest(self, item) -> str:
+        "Return a digest of the contents of item, or of item itself if it is not a file"
+        if isinstance(item, ConcatenatedFiles):
+            return self.key('concatenated', *item.files, item.alignment)
+        if isinstance(item, FileSlice):
+            return self.key('slice', item.path, item.offset, item.length)
+        if isinstance(item, MemoryContent):
+            # The same as for a file with these contents, so that keys do not depend on where contents are kept
+            return 'file:' + sha256(item.data).hexdigest()
+        if isinstance(item, pathlib.Path) and item.is_file():
+            return 'file:' + self.file_digest(item)
+        if isinstance(item, (list, tuple)):
+            return self.key('list', *item)
+        if isinstance(item, bytes):
+            return 'bytes:' + sha256(item).hexdigest()
+        return 'text:' + sha256(str(item).encode()).hexdigest()
+
+    def key(self, kind: str, *items) -> str:
+        h = sha256(kind.encode())
+        for item in items:
+            h.update(b'\0' + self.digest(item).encode())
+        return h.hexdigest()
+
+    def _entry(self, kind: str, items) -> pathlib.Path:
+        assert self.directory
+        key = self.key(kind, *items)
+        return self.directory / key[:2] / key
+
+    def _lookup(self, kind: str, entry: pathlib.Path) -> bool:
+        try:
+            # Bump the modification time, it is used for LRU eviction
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        print(f'Using cached {kind} from {entry}')
+        return True
+
+    def _store(self, entry: pathlib.Path, write: Callable[[pathlib.Path], None]) -> None:
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=entry.parent, prefix='.tmp', delete=False)
+        tmp.close()
+        try:
+            write(pathlib.Path(tmp.name))
+            os.replace(tmp.name, entry)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+
+    def text(self, kind: str, items, func: Callable[[], Optional[str]]) -> Optional[str]:
+        "Return the cached string result of func for the given inputs, calling func on cache miss"
+        if not self.directory:
+            return func()
+
+        entry = self._entry(kind, items)
+        if self._lookup(kind, entry):
+            return entry.read_text()
+
+        text = func()
+        if text is not None:
+            self._store(entry, lambda path: path.write_text(text))
+        return text
+
+    def file(self, kind: str, items, func: Callable[[pathlib.Path], None]) -> pathlib.Path:
+        "Return a path to the cached output of func for the given inputs. func writes to the path it is given"
+        if not self.directory:
+            tmp, path = scratch_file(kind)
+            self._tmpfiles += [tmp]
+            func(path)
+            return path
+
+        entry = self._entry(kind, items)
+        if not self._lookup(kind, entry):
+            self._store(entry, func)
+        return entry
+
+    def evict(self) -> None:
+        if not self.directory or not self.directory.exists():
+            return
+
+        entries = []
+        for path in self.directory.glob('??/*'):
+            if path.name.startswith('.tmp'):
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries += [(st.st_mtime_ns, st.st_size, path)]
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+            total -= size
+
+
+def parse_size(s):
+    suffixes = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if not (m := re.fullmatch(r'\s*(\d+)\s*([KMGT]?)B?\s*', s.upper())):
+        raise argparse.ArgumentTypeError(f'Cannot parse size: {s!r}')
+    return int(m.group(1)) * suffixes[m.group(2)]
+
+
 def parse_banks(s):
     banks = re.split(r',|\s+', s)
     # TODO: do some sanity checking here
@@ -401,6 +869,45 @@ KNOWN_PHASES = (
     'final',
 )
 
+def parse_profile_sections(specs: list[str]) -> dict[str, list[Section]]:
+    """Group --profile-section= specifications by profile ID
+
+    The profiles are ordered by their first appearance. Each profile starts with its .profile section,
+    which is generated from the ID if it is not specified.
+    """
+    profiles: dict[str, list[Section]] = {}
+
+    for spec in specs:
+        id_, _, section_spec = spec.partition(':')
+        if not re.fullmatch(r'[a-zA-Z0-9_.-]+', id_) or not section_spec:
+            raise ValueError(f'Cannot parse profile section spec: {spec!r}')
+
+        section = Section.parse_input(section_spec)
+        if section.name in UNIFIED_SECTIONS and section.name not in PROFILE_SECTIONS:
+            raise ValueError(f'Section {section.name} is shared by all profiles, it cannot be specified for profile {id_}')
+        section.measure = section.name in UNIFIED_SECTIONS
+
+        sections = profiles.setdefault(id_, [])
+        if section.name in [s.name for s in sections]:
+            raise ValueError(f'Duplicate section {section.name} in profile {id_}')
+        sections += [section]
+
+    for id_, sections in profiles.items():
+        header = next((s for s in sections if s.name == '.profile'), None)
+        if header is None:
+            header = Section.create('.profile', f'ID={id_}\n')
+        profiles[id_] = [header] + [s for s in sections if s is not header]
+
+    return profiles
+
+
+def parse_jobs(s):
+    jobs = int(s)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f'The number of jobs must be positive: {s}')
+    return jobs
+
+
 def parse_phase_paths(s):
     # Split on commas or whitespace here. Commas might be hard to parse visually.
     paths = re.split(r',|\s+', s)
@@ -429,7 +936,7 @@ def check_splash(filename):
 
 def check_inputs(opts):
     for name, value in vars(opts).items():
-        if name in {'output', 'tools'}:
+        if name in {'output', 'tools', 'cache_dir'}:
             continue
 
         if isinstance(value, pathlib.Path):
@@ -455,11 +962,16 @@ def check_cert_and_keys_nonexistent(opts):
 
 
 def find_tool(name, fallback=None, opts=None):
-    if opts and opts.tools:
-        for d in opts.tools:
-            tool = d / name
-            if tool.exists():
-                return tool
+    tools = tuple(opts.tools) if opts and opts.tools else ()
+    return _find_tool(name, fallback, tools)
+
+
+@functools.lru_cache(maxsize=None)
+def _find_tool(name, fallback, tools):
+    for d in tools:
+        tool = d / name
+        if tool.exists():
+            return tool
 
     if shutil.which(name) is not None:
         return name
@@ -492,53 +1004,240 @@ def key_path_groups(opts):
                    pp_groups)
 
 
-def call_systemd_measure(uki, linux, opts):
-    measure_tool = find_tool('systemd-measure',
-                             '/usr/lib/systemd/systemd-measure',
-                             opts=opts)
+@contextlib.contextmanager
+def measured_section_args(uki, linux):
+    """Yield systemd-measure arguments for the measured sections and the fds that need to be passed on
+
+    Sections which are not backed by a file of their own are fed to systemd-measure through a pipe, so
+    that the contents never need to be written out.
+    """
+    args = []
+    pass_fds = []
+    writers = []
+    measured = [('.linux', linux)] + [(s.name, s.content) for s in uki.sections if s.measure]
+
+    try:
+        for name, content in measured:
+            if not isinstance(content, pathlib.Path):
+                rfd, wfd = os.pipe()
+                pass_fds += [rfd]
+                writers += [threading.Thread(target=pipe_feed, args=(content, wfd), daemon=True)]
+                path = f'/dev/fd/{rfd}'
+            else:
+                path = content
+
+            args += [f"--{name.removeprefix('.')}={path}"]
+
+        for writer in writers:
+            writer.start()
+
+        yield args, pass_fds
+
+    finally:
+        # Close the read ends first, so that writers blocked on a pipe nobody reads from anymore
+        # get EPIPE and terminate.
+        for fd in pass_fds:
+            os.close(fd)
+        for writer in writers:
+            if writer.is_alive():
+                writer.join()
+
+
+def pipe_feed(content, wfd):
+    try:
+        with open(wfd, 'wb') as f:
+            content.write_to(f)
+    except BrokenPipeError:
+        pass
+
+
+def tool_path(tool) -> pathlib.Path:
+    return pathlib.Path(shutil.which(tool) or tool)
+
+
+# The sections measured by systemd-stub, in the order they are measured, see src/fundamental/uki.c
+UNIFIED_SECTIONS = (
+    '.linux',
+    '.osrel',
+    '.cmdline',
+    '.initrd',
+    '.ucode',
+    '.splash',
+    '.dtb',
+    '.uname',
+    '.sbat',
+    '.pcrsig',
+    '.pcrpkey',
+)
+
+# The sections which can be specified per profile. The payloads and the SBAT metadata are shared.
+PROFILE_SECTIONS = (
+    '.profile',
+    '.osrel',
+    '.cmdline',
+    '.splash',
+    '.dtb',
+    '.uname',
+)
+
+TPM2_PCR_KERNEL_BOOT = 11
+
+# Defaults of systemd-measure, used when no banks or phases are specified
+DEFAULT_PCR_BANKS = ('SHA1', 'SHA256', 'SHA384', 'SHA512')
+DEFAULT_PHASE_PATHS = (
+    'enter-initrd',
+    'enter-initrd:leave-initrd',
+    'enter-initrd:leave-initrd:sysinit',
+    'enter-initrd:leave-initrd:sysinit:ready',
+)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_extents(content):
+    if isinstance(content, (ConcatenatedFiles, FileSlice)):
+        yield from content.extents()
+    else:
+        yield content, 0, content.stat().st_size, 0
+
+
+def hash_content(content, banks) -> list[bytes]:
+    """Hash content with each of the banks in a single pass over the data
+
+    Files are mapped into memory and fed to all hashes chunk by chunk, so that each chunk is
+    read from the page cache once, no matter how many banks are used.
+    """
+    hashes = [hashlib.new(bank) for bank in banks]
+    update_hashes(hashes, content)
+    return [h.digest() for h in hashes]
+
+
+def update_hashes(hashes, content) -> None:
+    if isinstance(content, MemoryContent):
+        for h in hashes:
+            h.update(content.data)
+        return
+
+    for file, start, size, padding in content_extents(content):
+        if size > 0:
+            # Mappings must start at a multiple of the allocation granularity
+            skip = start % mmap.ALLOCATIONGRANULARITY
+            with open(file, 'rb') as f, \
+                 mmap.mmap(f.fileno(), skip + size, offset=start - skip, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    for offset in range(skip, skip + size, HASH_CHUNK_SIZE):
+                        chunk = view[offset:min(offset + HASH_CHUNK_SIZE, skip + size)]
+                        for h in hashes:
+                            h.update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+        if padding:
+            for h in hashes:
+                h.update(bytes(padding))
+
+
+def pcr_extend(bank, value: bytes, data: bytes) -> bytes:
+    return hashlib.new(bank, value + data).digest()
+
+
+def pcr_calculate(sections, banks=None, phase_paths=None) -> str:
+    """Calculate the expected values of PCR 11 like 'systemd-measure calculate' does
+
+    sections is a mapping from section name to contents. The output is the same as the text
+    output of systemd-measure: one line per phase path and bank.
+    """
+    if not sections.get('.linux'):
+        raise ValueError('Cannot calculate PCR values without a .linux section')
+
+    for name in sections:
+        if name not in UNIFIED_SECTIONS:
+            raise ValueError(f'Section {name} cannot be measured')
+
+    # systemd-measure sorts and deduplicates the banks and, if specified explicitly, the phase paths. Both
+    # are normalized first: the banks to the upper case name of the digest, like OpenSSL's EVP_MD_name(),
+    # and the phase paths by dropping empty words, i.e. leading, trailing and repeated ':'.
+    try:
+        banks = sorted({hashlib.new(bank).name.upper() for bank in banks or DEFAULT_PCR_BANKS})
+    except ValueError as e:
+        raise ValueError(f'Unsupported PCR bank: {e}') from e
+    if phase_paths:
+        phase_paths = sorted({':'.join(word for word in p.split(':') if word) for p in phase_paths})
+    else:
+        phase_paths = DEFAULT_PHASE_PATHS
+
+    states = [bytes(hashlib.new(bank).digest_size) for bank in banks]
+
+    for name in UNIFIED_SECTIONS:
+        content = sections.get(name)
+        if content is None:
+            continue
+
+        # Empty sections are skipped, the stub does so too
+        if not content_size(content):
+            continue
+
+        digests = hash_content(content, banks)
+        for i, bank in enumerate(banks):
+            states[i] = pcr_extend(bank, states[i], hashlib.new(bank, name.encode() + b'\0').digest())
+            states[i] = pcr_extend(bank, states[i], digests[i])
+
+    lines = []
+    for phase_path in phase_paths:
+        values = states
+        for word in phase_path.split(':'):
+            if word:
+                values = [pcr_extend(bank, value, hashlib.new(bank, word.encode()).digest())
+                          for bank, value in zip(banks, values)]
 
+        lines += [f'{TPM2_PCR_KERNEL_BOOT}:{hashlib.new(bank).name}={value.hex()}\n'
+                  for bank, value in zip(banks, values)]
+
+    return ''.join(lines)
+
+
+# Signing is not CPU bound, so by default more jobs than CPUs are run in parallel
+MAX_SIGNING_JOBS = 8
+
+
+def call_systemd_measure(uki, linux, opts, cache=None):
     banks = opts.pcr_banks or ()
+    cache = cache or BuildCache(None, 0)
+    measured = [(s.name, s.content) for s in uki.sections if s.measure]
 
     # PCR measurement
 
     if opts.measure:
         pp_groups = opts.phase_path_groups or []
 
-        cmd = [
-            measure_tool,
-            'calculate',
-            f'--linux={linux}',
-            *(f"--{s.name.removeprefix('.')}={s.content}"
-              for s in uki.sections
-              if s.measure),
-            *(f'--bank={bank}'
-              for bank in banks),
-            # For measurement, the keys are not relevant, so we can lump all the phase paths
-            # into one call to systemd-measure calculate.
-            *(f'--phase={phase_path}'
-              for phase_path in itertools.chain.from_iterable(pp_groups)),
-        ]
+        # The calculation is done in-process. For measurement, the keys are not relevant, so we can
+        # lump all the phase paths together.
+        def calculate():
+            return pcr_calculate({'.linux': linux, **dict(measured)},
+                                 banks=banks,
+                                 phase_paths=list(itertools.chain.from_iterable(pp_groups)))
 
-        print('+', shell_join(cmd))
-        subprocess.check_call(cmd)
+        print(cache.text('pcr-measurement', [linux, *measured, banks, pp_groups], calculate), end='')
 
     # PCR signing
 
     if opts.pcr_private_keys:
-        pcrsigs = []
+        measure_tool = find_tool('systemd-measure',
+                                 '/usr/lib/systemd/systemd-measure',
+                                 opts=opts)
+        cache_inputs = [tool_path(measure_tool), linux, *measured, banks]
 
         cmd = [
             measure_tool,
             'sign',
-            f'--linux={linux}',
-            *(f"--{s.name.removeprefix('.')}={s.content}"
-              for s in uki.sections
-              if s.measure),
             *(f'--bank={bank}'
               for bank in banks),
         ]
 
-        for priv_key, pub_key, group in key_path_groups(opts):
+        print_lock = threading.Lock()
+
+        def sign(priv_key, pub_key, group):
             extra = [f'--private-key={priv_key}']
             if opts.signing_engine is not None:
                 assert pub_key
@@ -548,9 +1247,34 @@ def call_systemd_measure(uki, linux, opts):
                 extra += [f'--public-key={pub_key}']
             extra += [f'--phase={phase_path}' for phase_path in group or ()]
 
-            print('+', shell_join(cmd + extra))
-            pcrsig = subprocess.check_output(cmd + extra, text=True)
-            pcrsig = json.loads(pcrsig)
+            def call():
+                with measured_section_args(uki, linux) as (section_args, pass_fds):
+                    with print_lock:
+                        print('+', shell_join(cmd + section_args + extra))
+                    with profile_command(cmd + section_args + extra):
+                        return subprocess.check_output(cmd + section_args + extra, pass_fds=pass_fds, text=True)
+
+            start = time.monotonic()
+            key = pathlib.Path(priv_key) if opts.signing_engine is None else priv_key
+            pcrsig = cache.text('pcr-signature',
+                                [*cache_inputs, key, pub_key, opts.signing_engine, group],
+                                call)
+            return json.loads(pcrsig), time.monotonic() - start
+
+        # The signing jobs are independent of each other, and mostly wait for systemd-measure (and
+        # possibly an HSM behind the signing engine), so they are run in parallel. The results are
+        # collected in the order of the keys, so that the combined signature does not depend on timing.
+        groups = list(key_path_groups(opts))
+        workers = min(len(groups), opts.signing_jobs or MAX_SIGNING_JOBS)
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(sign, *group) for group in groups]
+            results = [future.result() for future in futures]
+
+        pcrsigs = []
+        for (priv_key, _, group), (pcrsig, elapsed) in zip(groups, results):
+            phases = ', '.join(group) if group else 'default phases'
+            print(f'PCR signature with {priv_key} ({phases}) took {elapsed:.3f}s')
             pcrsigs += [pcrsig]
 
         combined = combine_signatures(pcrsigs)
@@ -563,14 +1287,9 @@ def join_initrds(initrds):
     if len(initrds) == 1:
         return initrds[0]
 
-    seq = []
-    for file in initrds:
-        initrd = file.read_bytes()
-        n = len(initrd)
-        padding = b'\0' * (round_up(n, 4) - n)  # pad to 32 bit alignment
-        seq += [initrd, padding]
-
-    return b''.join(seq)
+    # Each initrd is padded to 32 bit alignment. The joined file is never materialized, the pieces are
+    # copied directly into the output.
+    return ConcatenatedFiles(tuple(initrds))
 
 
 def pairwise(iterable):
@@ -583,147 +1302,521 @@ class PEError(Exception):
     pass
 
 
-def pe_add_sections(uki: UKI, output: str):
-    pe = pefile.PE(uki.executable, fast_load=True)
+# Per-process memos of parsed PE images, fixed-up stubs and SBAT sections, keyed by file_identity()
+_IMAGES: dict[tuple, 'PEImage'] = {}
+_STUBS: dict[tuple, 'PEImage'] = {}
+_SBATS: dict[tuple, list['SbatEntry']] = {}
+
+
+def file_identity(path: pathlib.Path) -> tuple:
+    st = path.stat()
+    return (str(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def scratch_file(name: str, directory: Optional[pathlib.Path] = None) -> tuple[IO, pathlib.Path]:
+    """Return a temporary file and a path to it that other processes can open
+
+    Where possible, the file is a memfd, so that nothing is written to disk. Otherwise, a temporary file
+    is created in directory, or /tmp. The file is removed when the returned file object is closed.
+    """
+    if hasattr(os, 'memfd_create'):
+        try:
+            fd = os.memfd_create(name)
+        except OSError:
+            pass
+        else:
+            # Helper tools are not passed the fd, they open it through our process
+            return open(fd, 'w+b'), pathlib.Path(f'/proc/{os.getpid()}/fd/{fd}')
+
+    tmp = tempfile.NamedTemporaryFile(prefix=name, dir=directory)
+    return tmp, pathlib.Path(tmp.name)
+
+
+@contextlib.contextmanager
+def replace_atomically(path, mode: int = 0o666):
+    """Yield a temporary path next to path, which replaces path if the block succeeds
+
+    Readers of path never see a partially written file. The permissions are set to mode, minus the umask.
+    Paths which exist but are not regular files, like /dev/stdout, are written to directly.
+    """
+    path = pathlib.Path(path)
+    if path.exists() and not path.is_file():
+        yield path
+        return
+
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.#{path.name}')
+    os.close(fd)
+    try:
+        yield pathlib.Path(tmp)
+        os.umask(umask := os.umask(0))
+        os.chmod(tmp, mode & ~umask)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+def copy_file_to_offset(src: pathlib.Path, dst_fd: int, offset: int, size: int, src_offset: int = 0) -> None:
+    """Copy size bytes of src starting at src_offset into dst_fd at offset without going through Python buffers."""
+    with open(src, 'rb') as f:
+        src_fd = f.fileno()
+        done = 0
+
+        while done < size:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, size - done, src_offset + done, offset + done)
+            except (AttributeError, OSError):
+                break
+            if n == 0:
+                break
+            done += n
+
+        while done < size:
+            os.lseek(dst_fd, offset + done, os.SEEK_SET)
+            try:
+                n = os.sendfile(dst_fd, src_fd, src_offset + done, size - done)
+            except OSError:
+                break
+            if n == 0:
+                break
+            done += n
+
+        while done < size:
+            f.seek(src_offset + done)
+            buf = f.read(min(size - done, 1024 * 1024))
+            if not buf:
+                break
+            done += os.pwrite(dst_fd, buf, offset + done)
+
+    if done != size:
+        raise PEError(f'{src} changed size while being copied ({done} != {size} bytes).')
+
+
+IMAGE_FILE_LOCAL_SYMS_STRIPPED = 0x0008
+IMAGE_SCN_CNT_CODE = 0x00000020
+IMAGE_SCN_CNT_INITIALIZED_DATA = 0x00000040
+IMAGE_SCN_MEM_READ = 0x40000000
+IMAGE_DIRECTORY_ENTRY_SECURITY = 4
+
+PE_FILE_HEADER = struct.Struct('<HHIIIHH')
+PE_SECTION_HEADER = struct.Struct('<8sIIIIIIHHI')
+
+
+@dataclasses.dataclass
+class PESection:
+    name: str
+    VirtualSize: int = 0
+    VirtualAddress: int = 0
+    SizeOfRawData: int = 0
+    PointerToRawData: int = 0
+    PointerToRelocations: int = 0
+    PointerToLinenumbers: int = 0
+    NumberOfRelocations: int = 0
+    NumberOfLinenumbers: int = 0
+    Characteristics: int = 0
+
+    @classmethod
+    def unpack(cls, data, offset):
+        name, *fields = PE_SECTION_HEADER.unpack_from(data, offset)
+        # latin-1 round-trips arbitrary bytes
+        return cls(name.rstrip(b'\0').decode('latin-1'), *fields)
+
+    def pack(self):
+        return PE_SECTION_HEADER.pack(self.name.encode('latin-1'), *dataclasses.astuple(self)[1:])
+
+
+class PEImage:
+    """The headers of a PE image, parsed once
+
+    Changes to the headers and the section table are made to this object, and only serialized at the end
+    by headers(). The contents of the sections are read from the file on demand, or, once the layout of
+    the image has been changed in memory, from data.
+    """
+
+    def __init__(self, path: Optional[pathlib.Path], header: bytes, data: Optional[bytes] = None):
+        self.path = path
+        self.data = data
+        self.header = header
+
+        if header[:2] != b'MZ':
+            raise PEError(f'{path} is not a PE file: no DOS header')
+        self.pe_offset = struct.unpack_from('<I', header, 0x3c)[0]
+        if header[self.pe_offset:self.pe_offset + 4] != b'PE\0\0':
+            raise PEError(f'{path} is not a PE file: no PE signature')
+
+        self.file_header_offset = self.pe_offset + 4
+        (self.Machine,
+         number_of_sections,
+         self.TimeDateStamp,
+         self.PointerToSymbolTable,
+         self.NumberOfSymbols,
+         size_of_optional_header,
+         self.Characteristics) = PE_FILE_HEADER.unpack_from(header, self.file_header_offset)
+
+        # The fields used here are at the same offsets in PE32 and PE32+ optional headers
+        self.optional_header_offset = self.file_header_offset + PE_FILE_HEADER.size
+        o = self.optional_header_offset
+        magic = struct.unpack_from('<H', header, o)[0]
+        if magic not in (0x10b, 0x20b):
+            raise PEError(f'{path}: unknown optional header magic {magic:#x}')
+        self.SizeOfInitializedData = struct.unpack_from('<I', header, o + 8)[0]
+        self.SectionAlignment, self.FileAlignment = struct.unpack_from('<II', header, o + 32)
+        self.SizeOfImage, self.SizeOfHeaders, self.CheckSum = struct.unpack_from('<III', header, o + 56)
+        ndirs_offset = o + (92 if magic == 0x10b else 108)
+        self.data_directory_offset = ndirs_offset + 4
+        self.NumberOfRvaAndSizes = struct.unpack_from('<I', header, ndirs_offset)[0]
+
+        self.section_table_offset = o + size_of_optional_header
+        self.sections = [PESection.unpack(header, self.section_table_offset + i * PE_SECTION_HEADER.size)
+                         for i in range(number_of_sections)]
+
+        # Only keep the headers themselves, anything after them is section data
+        self.header = header[:max(self.SizeOfHeaders, self.section_header_offset(number_of_sections))]
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> 'PEImage':
+        "Parse the headers of the PE file at path. The section contents are not read."
+        with open(path, 'rb') as f:
+            header = f.read(4096)
+
+            # The headers might extend past the first page: the DOS header can point to a PE header anywhere
+            # in the file, and the section table or SizeOfHeaders can be larger than a page.
+            if header[:2] == b'MZ' and len(header) >= 0x40:
+                end = struct.unpack_from('<I', header, 0x3c)[0] + 4 + PE_FILE_HEADER.size
+                header += f.read(max(end - len(header), 0))
+                if len(header) >= end:
+                    _, number_of_sections, *_, size_of_optional_header, _ = \
+                        PE_FILE_HEADER.unpack_from(header, end - PE_FILE_HEADER.size)
+                    end += size_of_optional_header + number_of_sections * PE_SECTION_HEADER.size
+                    header += f.read(max(end - len(header), 0))
+
+            try:
+                image = cls(path, header)
+            except struct.error as e:
+                raise PEError(f'{path} is not a PE file: truncated headers') from e
+
+            end = max(image.SizeOfHeaders, image.section_header_offset(len(image.sections)))
+            if end > len(header):
+                header += f.read(end - len(header))
+                if len(header) < end:
+                    raise PEError(f'{path} is not a PE file: truncated headers')
+                image = cls(path, header)
+
+        return image
+
+    def directory(self, index: int) -> tuple[int, int]:
+        "Return the (VirtualAddress, Size) of the data directory with the given index"
+        if index >= self.NumberOfRvaAndSizes:
+            return 0, 0
+        return struct.unpack_from('<II', self.header, self.data_directory_offset + index * 8)
+
+    def set_directory(self, index: int, address: int, size: int) -> None:
+        assert index < self.NumberOfRvaAndSizes
+        header = bytearray(self.header)
+        struct.pack_into('<II', header, self.data_directory_offset + index * 8, address, size)
+        self.header = bytes(header)
+
+    def section(self, name: str) -> Optional[PESection]:
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def section_header_offset(self, index: int) -> int:
+        return self.section_table_offset + index * PE_SECTION_HEADER.size
+
+    def read(self, offset: int, size: int) -> bytes:
+        if self.data is not None:
+            return self.data[offset:offset + size]
+        assert self.path
+        with open(self.path, 'rb') as f:
+            return os.pread(f.fileno(), size, offset)
+
+    def section_data(self, section: PESection) -> bytes:
+        return self.read(section.PointerToRawData, section.SizeOfRawData)
+
+    def headers(self) -> bytes:
+        "Serialize the headers, including any changes made"
+        header = bytearray(self.header)
+        end = self.section_header_offset(len(self.sections))
+        if len(header) < end:
+            header += bytes(end - len(header))
+
+        PE_FILE_HEADER.pack_into(header, self.file_header_offset,
+                                 self.Machine,
+                                 len(self.sections),
+                                 self.TimeDateStamp,
+                                 self.PointerToSymbolTable,
+                                 self.NumberOfSymbols,
+                                 PE_FILE_HEADER.unpack_from(self.header, self.file_header_offset)[5],
+                                 self.Characteristics)
+        o = self.optional_header_offset
+        struct.pack_into('<I', header, o + 8, self.SizeOfInitializedData)
+        struct.pack_into('<III', header, o + 56, self.SizeOfImage, self.SizeOfHeaders, self.CheckSum)
+
+        for i, section in enumerate(self.sections):
+            header[self.section_header_offset(i):self.section_header_offset(i + 1)] = section.pack()
+
+        return bytes(header)
+
+    def image(self) -> bytes:
+        "Serialize the whole image, which must be held in memory"
+        assert self.data is not None
+        header = self.headers()
+        return header + self.data[len(header):]
+
+
+def pe_fixup_stub(stub: PEImage) -> PEImage:
+    """Strip the symbol table and align raw data of the stub. Return the new image, held in memory."""
+    data = stub.path.read_bytes() if stub.data is None else stub.data
+    end = len(data)
+    stub = copy.deepcopy(stub)
 
     # Old stubs do not have the symbol/string table stripped, even though image files should not have one.
-    if symbol_table := pe.FILE_HEADER.PointerToSymbolTable:
-        symbol_table_size = 18 * pe.FILE_HEADER.NumberOfSymbols
-        if string_table_size := pe.get_dword_from_offset(symbol_table + symbol_table_size):
+    if symbol_table := stub.PointerToSymbolTable:
+        symbol_table_size = 18 * stub.NumberOfSymbols
+        string_table = data[symbol_table + symbol_table_size:symbol_table + symbol_table_size + 4]
+        if len(string_table) == 4 and (string_table_size := struct.unpack('<I', string_table)[0]):
             symbol_table_size += string_table_size
 
         # Let's be safe and only strip it if it's at the end of the file.
-        if symbol_table + symbol_table_size == len(pe.__data__):
-            pe.__data__ = pe.__data__[:symbol_table]
-            pe.FILE_HEADER.PointerToSymbolTable = 0
-            pe.FILE_HEADER.NumberOfSymbols = 0
-            pe.FILE_HEADER.IMAGE_FILE_LOCAL_SYMS_STRIPPED = True
+        if symbol_table + symbol_table_size == end:
+            end = symbol_table
+            stub.PointerToSymbolTable = 0
+            stub.NumberOfSymbols = 0
+            stub.Characteristics |= IMAGE_FILE_LOCAL_SYMS_STRIPPED
 
     # Old stubs might have been stripped, leading to unaligned raw data values, so let's fix them up here.
-    # pylint thinks that Structure doesn't have various members that it has…
-    # pylint: disable=no-member
+    # This is done in a single pass over the stub, carrying the accumulated shift over to later sections.
+    file_alignment = stub.FileAlignment
+    chunks = []
+    cursor = 0
+    shift = 0
 
-    for i, section in enumerate(pe.sections):
+    for section in stub.sections:
         oldp = section.PointerToRawData
         oldsz = section.SizeOfRawData
-        section.PointerToRawData = round_up(oldp, pe.OPTIONAL_HEADER.FileAlignment)
-        section.SizeOfRawData = round_up(oldsz, pe.OPTIONAL_HEADER.FileAlignment)
-        padp = section.PointerToRawData - oldp
+        if oldsz == 0:
+            continue
+
+        section.PointerToRawData = round_up(oldp + shift, file_alignment)
+        section.SizeOfRawData = round_up(oldsz, file_alignment)
+        padp = section.PointerToRawData - (oldp + shift)
         padsz = section.SizeOfRawData - oldsz
 
-        for later_section in pe.sections[i+1:]:
-            later_section.PointerToRawData += padp + padsz
+        chunks += [data[cursor:oldp], bytes(padp), data[oldp:oldp+oldsz], bytes(padsz)]
+        cursor = oldp + oldsz
+        shift += padp + padsz
 
-        pe.__data__ = pe.__data__[:oldp] + bytes(padp) + pe.__data__[oldp:oldp+oldsz] + bytes(padsz) + pe.__data__[oldp+oldsz:]
+    chunks += [data[cursor:end]]
 
     # We might not have any space to add new sections. Let's try our best to make some space by padding the
     # SizeOfHeaders to a multiple of the file alignment. This is safe because the first section's data starts
     # at a multiple of the file alignment, so all space before that is unused.
-    pe.OPTIONAL_HEADER.SizeOfHeaders = round_up(pe.OPTIONAL_HEADER.SizeOfHeaders, pe.OPTIONAL_HEADER.FileAlignment)
-    pe = pefile.PE(data=pe.write(), fast_load=True)
+    stub.SizeOfHeaders = round_up(stub.SizeOfHeaders, file_alignment)
+
+    stub.path = None
+    stub.data = b''.join(chunks)
+    return stub
+
 
-    warnings = pe.get_warnings()
-    if warnings:
-        raise PEError(f'pefile warnings treated as errors: {warnings}')
+def load_pe(path) -> PEImage:
+    "Return the parsed headers of a PE file, parsing every file only once per process"
+    path = pathlib.Path(path)
+    memo = file_identity(path)
+    if (image := _IMAGES.get(memo)) is None:
+        image = _IMAGES[memo] = PEImage.load(path)
+    return image
 
-    security = pe.OPTIONAL_HEADER.DATA_DIRECTORY[pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_SECURITY']]
-    if security.VirtualAddress != 0:
+
+def load_stub(path) -> PEImage:
+    "Return the fixed-up stub image, parsing every stub only once per process"
+    memo = file_identity(pathlib.Path(path))
+    if (stub := _STUBS.get(memo)) is None:
+        stub = _STUBS[memo] = pe_fixup_stub(load_pe(path))
+    return stub
+
+
+def pe_add_sections(uki: UKI, output: str):
+    # The memoized stub is shared, so make changes to a copy
+    pe = copy.deepcopy(load_stub(uki.executable))
+
+    if pe.directory(IMAGE_DIRECTORY_ENTRY_SECURITY)[0] != 0:
         # We could strip the signatures, but why would anyone sign the stub?
         raise PEError('Stub image is signed, refusing.')
 
-    for section in uki.sections:
-        new_section = pefile.SectionStructure(pe.__IMAGE_SECTION_HEADER_format__, pe=pe)
-        new_section.__unpack__(b'\0' * new_section.sizeof())
+    # First plan the complete section table, using only the sizes of the section contents. The payloads are
+    # then copied into place in the output file, so they never need to be loaded into memory.
+    file_end = len(pe.data)
+    placements = []
+    stub_sections = {s.name: s for s in pe.sections}
+    in_profile = False
 
-        offset = pe.sections[-1].get_file_offset() + new_section.sizeof()
-        if offset + new_section.sizeof() > pe.OPTIONAL_HEADER.SizeOfHeaders:
+    for section in uki.sections:
+        in_profile = in_profile or section.name == '.profile'
+        offset = pe.section_header_offset(len(pe.sections))
+        if offset + PE_SECTION_HEADER.size > pe.SizeOfHeaders:
             raise PEError(f'Not enough header space to add section {section.name}.')
 
         assert section.content
-        data = section.content.read_bytes()
-
-        new_section.set_file_offset(offset)
-        new_section.Name = section.name.encode()
-        new_section.Misc_VirtualSize = len(data)
-        # Non-stripped stubs might still have an unaligned symbol table at the end, making their size
-        # unaligned, so we make sure to explicitly pad the pointer to new sections to an aligned offset.
-        new_section.PointerToRawData = round_up(len(pe.__data__), pe.OPTIONAL_HEADER.FileAlignment)
-        new_section.SizeOfRawData = round_up(len(data), pe.OPTIONAL_HEADER.FileAlignment)
-        new_section.VirtualAddress = round_up(
-            pe.sections[-1].VirtualAddress + pe.sections[-1].Misc_VirtualSize,
-            pe.OPTIONAL_HEADER.SectionAlignment,
+        size = section.size()
+
+        new_section = PESection(
+            name=section.name,
+            VirtualSize=size,
+            # Non-stripped stubs might still have an unaligned symbol table at the end, making their size
+            # unaligned, so we make sure to explicitly pad the pointer to new sections to an aligned offset.
+            PointerToRawData=round_up(file_end, pe.FileAlignment),
+            SizeOfRawData=round_up(size, pe.FileAlignment),
+            VirtualAddress=round_up(
+                pe.sections[-1].VirtualAddress + pe.sections[-1].VirtualSize,
+                pe.SectionAlignment,
+            ),
+            Characteristics=IMAGE_SCN_MEM_READ | (
+                # Old kernels that use EFI handover protocol will be executed inline.
+                IMAGE_SCN_CNT_CODE if section.name == '.linux' else IMAGE_SCN_CNT_INITIALIZED_DATA
+            ),
         )
 
-        new_section.IMAGE_SCN_MEM_READ = True
-        if section.name == '.linux':
-            # Old kernels that use EFI handover protocol will be executed inline.
-            new_section.IMAGE_SCN_CNT_CODE = True
-        else:
-            new_section.IMAGE_SCN_CNT_INITIALIZED_DATA = True
-
         # Special case, mostly for .sbat: the stub will already have a .sbat section, but we want to append
         # the one from the kernel to it. It should be small enough to fit in the existing section, so just
-        # swap the data.
-        for i, s in enumerate(pe.sections):
-            if s.Name.rstrip(b"\x00").decode() == section.name:
-                if new_section.Misc_VirtualSize > s.SizeOfRawData:
-                    raise PEError(f'Not enough space in existing section {section.name} to append new data.')
-
-                padding = bytes(new_section.SizeOfRawData - new_section.Misc_VirtualSize)
-                pe.__data__ = pe.__data__[:s.PointerToRawData] + data + padding + pe.__data__[pe.sections[i+1].PointerToRawData:]
-                s.SizeOfRawData = new_section.SizeOfRawData
-                s.Misc_VirtualSize = new_section.Misc_VirtualSize
-                break
+        # swap the data. The sections of profiles are always added.
+        if not in_profile and (s := stub_sections.get(section.name)):
+            if new_section.VirtualSize > s.SizeOfRawData:
+                raise PEError(f'Not enough space in existing section {section.name} to append new data.')
+
+            s.VirtualSize = new_section.VirtualSize
+            placements += [(section, s.PointerToRawData, size, s.SizeOfRawData - size)]
         else:
-            pe.__data__ = pe.__data__[:] + bytes(new_section.PointerToRawData - len(pe.__data__)) + data + bytes(new_section.SizeOfRawData - len(data))
+            file_end = new_section.PointerToRawData + new_section.SizeOfRawData
 
-            pe.FILE_HEADER.NumberOfSections += 1
-            pe.OPTIONAL_HEADER.SizeOfInitializedData += new_section.Misc_VirtualSize
-            pe.__structures__.append(new_section)
+            pe.SizeOfInitializedData += new_section.VirtualSize
             pe.sections.append(new_section)
+            placements += [(section, new_section.PointerToRawData, size, 0)]
 
-    pe.OPTIONAL_HEADER.CheckSum = 0
-    pe.OPTIONAL_HEADER.SizeOfImage = round_up(
-        pe.sections[-1].VirtualAddress + pe.sections[-1].Misc_VirtualSize,
-        pe.OPTIONAL_HEADER.SectionAlignment,
+    pe.CheckSum = 0
+    pe.SizeOfImage = round_up(
+        pe.sections[-1].VirtualAddress + pe.sections[-1].VirtualSize,
+        pe.SectionAlignment,
     )
 
-    pe.write(output)
+    with open(output, 'wb') as f:
+        f.write(pe.image())
+        f.flush()
 
-def merge_sbat(input_pe: [pathlib.Path], input_text: [str]) -> str:
-    sbat = []
+        for section, offset, size, clear in placements:
+            section.copy_to_offset(f.fileno(), offset, size)
+            # Sections swapped into the stub need the rest of the old contents cleared. The padding of
+            # appended sections is zero-filled implicitly by extending the file below.
+            if clear:
+                os.pwrite(f.fileno(), bytes(clear), offset + size)
 
-    for f in input_pe:
+        os.ftruncate(f.fileno(), file_end)
+
+SBAT_HEADER = 'sbat,1,SBAT Version,sbat,1,https://github.com/rhboot/shim/blob/main/SBAT.md'
+
+
+@dataclasses.dataclass(frozen=True)
+class SbatEntry:
+    """One line of SBAT metadata, see https://github.com/rhboot/shim/blob/main/SBAT.md
+
+    The fields after the generation are the vendor name, the package name, the version and the URL.
+    shim does not support quoting, so neither do we.
+    """
+    component: str
+    generation: int
+    vendor: tuple[str, ...] = ()
+
+    @classmethod
+    def parse(cls, line: str, source) -> 'SbatEntry':
+        component, *fields = line.split(',')
+        if not re.fullmatch(r'[a-zA-Z0-9_.-]+', component) or not 1 <= len(fields) <= 5:
+            raise ValueError(f'{source}: invalid SBAT entry {line!r}')
+        if not fields[0].isdigit() or int(fields[0]) < 1:
+            raise ValueError(f'{source}: invalid generation in SBAT entry {line!r}')
+        return cls(component, int(fields[0]), tuple(fields[1:]))
+
+    def __str__(self):
+        return ','.join((self.component, str(self.generation), *self.vendor))
+
+
+def parse_sbat(text: str, source) -> list[SbatEntry]:
+    "Parse SBAT metadata, which must start with the sbat line. The sbat line is not returned."
+    lines = text.rstrip('\0').splitlines()
+    if not lines or not lines[0].startswith('sbat,'):
+        raise ValueError(f'{source} does not contain a valid SBAT section')
+    return [SbatEntry.parse(line, source) for line in lines[1:] if line.strip()]
+
+
+def dedup_sbat(entries: list[SbatEntry]) -> list[SbatEntry]:
+    """Keep one entry per component, in the order of the first appearance
+
+    shim refuses an image if any of its entries is revoked, so the lowest generation of a component is the
+    one that counts. Of the entries with that generation, the first one is kept.
+    """
+    kept: dict[str, SbatEntry] = {}
+    for entry in entries:
+        if entry.component not in kept or entry.generation < kept[entry.component].generation:
+            kept[entry.component] = entry
+    return list(kept.values())
+
+
+def pe_sbat(f: pathlib.Path, cache: Optional[BuildCache] = None) -> list[SbatEntry]:
+    """Return the SBAT entries from the .sbat section(s) of a PE file
+
+    Every file is parsed only once per process. With a cache, the entries are also stored by the digest
+    of the file, so that the PE file is not parsed again by later builds.
+    """
+    memo = file_identity(pathlib.Path(f))
+    if (sbat := _SBATS.get(memo)) is not None:
+        return sbat
+
+    def extract():
         try:
-            pe = pefile.PE(f, fast_load=True)
-        except pefile.PEFormatError:
+            pe = load_pe(f)
+        except PEError:
             print(f"{f} is not a valid PE file, not extracting SBAT section.")
-            continue
+            return ''
 
+        entries = []
         for section in pe.sections:
-            if section.Name.rstrip(b"\x00").decode() == ".sbat":
-                split = section.get_data().rstrip(b"\x00").decode().splitlines()
-                if not split[0].startswith('sbat,'):
-                    print(f"{f} does not contain a valid SBAT section, skipping.")
-                    continue
-                # Filter out the sbat line, we'll add it back later, there needs to be only one and it
-                # needs to be first.
-                sbat += split[1:]
+            if section.name == ".sbat":
+                try:
+                    entries += parse_sbat(pe.section_data(section).decode(), f)
+                except (ValueError, UnicodeDecodeError) as e:
+                    print(f"{e}, skipping.")
+        return ''.join(f'{entry}\n' for entry in entries)
+
+    text = cache.text('pe-sbat', [f], extract) if cache else extract()
+    sbat = _SBATS[memo] = [SbatEntry.parse(line, f) for line in text.splitlines()]
+    return sbat
+
+
+def merge_sbat(input_pe: [pathlib.Path], input_text: [str], cache: Optional[BuildCache] = None) -> str:
+    """Merge the SBAT metadata of the PE files and the SBAT texts into the contents of a .sbat section
+
+    The texts are either literal or @ followed by a path. Components which appear more than once are
+    listed once, see dedup_sbat().
+    """
+    sbat = []
+
+    for f in input_pe:
+        sbat += pe_sbat(f, cache=cache)
 
     for t in input_text:
+        source = 'SBAT'
         if t.startswith('@'):
-            t = pathlib.Path(t[1:]).read_text()
-        split = t.splitlines()
-        if not split[0].startswith('sbat,'):
-            print(f"{t} does not contain a valid SBAT section, skipping.")
-            continue
-        sbat += split[1:]
+            source = pathlib.Path(t[1:])
+            t = source.read_text()
+        sbat += parse_sbat(t, source)
 
-    return 'sbat,1,SBAT Version,sbat,1,https://github.com/rhboot/shim/blob/main/SBAT.md\n' + '\n'.join(sbat) + "\n\x00"
+    return SBAT_HEADER + '\n' + '\n'.join(map(str, dedup_sbat(sbat))) + "\n\x00"
 
 def signer_sign(cmd):
     print('+', shell_join(cmd))
-    subprocess.check_call(cmd)
+    with profile_command(cmd):
+        subprocess.check_call(cmd)
 
 def find_sbsign(opts=None):
     return find_tool('sbsign', opts=opts)
@@ -755,68 +1848,262 @@ def pesign_sign(pesign_tool, input_f, output_f, opts=None):
     ]
     signer_sign(sign_invocation)
 
-SBVERIFY = {
-    'name': 'sbverify',
-    'option': '--list',
-    'output': 'No signature table present',
-}
+OID_SHA256 = '2.16.840.1.101.3.4.2.1'
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+OID_PKCS7_SIGNED_DATA = '1.2.840.113549.1.7.2'
+OID_CONTENT_TYPE = '1.2.840.113549.1.9.3'
+OID_MESSAGE_DIGEST = '1.2.840.113549.1.9.4'
+OID_SPC_INDIRECT_DATA = '1.3.6.1.4.1.311.2.1.4'
+OID_SPC_SP_OPUS_INFO = '1.3.6.1.4.1.311.2.1.12'
+OID_SPC_PE_IMAGE_DATA = '1.3.6.1.4.1.311.2.1.15'
+
+WIN_CERTIFICATE = struct.Struct('<IHH')
+WIN_CERT_REVISION_2_0 = 0x0200
+WIN_CERT_TYPE_PKCS_SIGNED_DATA = 0x0002
+
+
+def der(tag: int, content: bytes) -> bytes:
+    "Encode a DER element with the given tag"
+    size = len(content)
+    if size < 0x80:
+        length = bytes([size])
+    else:
+        length = size.to_bytes((size.bit_length() + 7) // 8, 'big')
+        length = bytes([0x80 | len(length)]) + length
+    return bytes([tag]) + length + content
 
-PESIGCHECK = {
-    'name': 'pesign',
-    'option': '-i',
-    'output': 'No signatures found.',
-    'flags': '-S'
-}
 
-def verify(tool, opts):
-    verify_tool = find_tool(tool['name'], opts=opts)
-    cmd = [
-        verify_tool,
-        tool['option'],
-        opts.linux,
+def der_content(element: bytes) -> bytes:
+    "Return the contents of a DER element, without the tag and the length"
+    length = element[1]
+    return element[2 + (length & 0x7f if length & 0x80 else 0):]
+
+
+def der_sequence(*items: bytes) -> bytes:
+    return der(0x30, b''.join(items))
+
+
+def der_set(*items: bytes) -> bytes:
+    # The elements of a SET OF are sorted in DER
+    return der(0x31, b''.join(sorted(items)))
+
+
+def der_integer(value: int) -> bytes:
+    return der(0x02, value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True))
+
+
+def der_oid(oid: str) -> bytes:
+    first, second, *rest = (int(n) for n in oid.split('.'))
+    encoded = bytearray([40 * first + second])
+    for n in rest:
+        chunk = [n & 0x7f]
+        while n := n >> 7:
+            chunk.insert(0, 0x80 | (n & 0x7f))
+        encoded += bytes(chunk)
+    return der(0x06, bytes(encoded))
+
+
+def der_algorithm(oid: str) -> bytes:
+    return der_sequence(der_oid(oid), der(0x05, b''))
+
+
+def authenticode_ranges(pe: PEImage, file_size: int):
+    """Yield the (offset, size) ranges of a PE file that are covered by its Authenticode hash
+
+    Those are the headers without the checksum and the entry of the certificate table, the raw data
+    of the sections in the order of their file offsets, and any data after the sections, except for the
+    certificate table itself.
+    """
+    checksum = pe.optional_header_offset + 64
+    security = pe.data_directory_offset + IMAGE_DIRECTORY_ENTRY_SECURITY * 8
+    if pe.NumberOfRvaAndSizes <= IMAGE_DIRECTORY_ENTRY_SECURITY:
+        raise PEError(f'{pe.path}: no certificate table directory entry')
+
+    yield 0, checksum
+    yield checksum + 4, security - checksum - 4
+    yield security + 8, pe.SizeOfHeaders - security - 8
+
+    end = pe.SizeOfHeaders
+    for section in sorted(pe.sections, key=lambda s: s.PointerToRawData):
+        if section.SizeOfRawData:
+            yield section.PointerToRawData, section.SizeOfRawData
+            end = max(end, section.PointerToRawData + section.SizeOfRawData)
+
+    certificates = pe.directory(IMAGE_DIRECTORY_ENTRY_SECURITY)[0] or file_size
+    if certificates > end:
+        yield end, certificates - end
+
+
+def authenticode_digest(pe: PEImage, path: pathlib.Path, file_size: int, algorithm: str = 'sha256') -> bytes:
+    "Calculate the Authenticode hash of the PE file at path in a single pass"
+    hashes = [hashlib.new(algorithm)]
+    for offset, size in authenticode_ranges(pe, file_size):
+        update_hashes(hashes, FileSlice(path, offset, size))
+    return hashes[0].digest()
+
+
+def authenticode_signature(digest: bytes, key, cert) -> bytes:
+    """Return a PKCS#7 SignedData structure that signs the Authenticode hash digest with key
+
+    The structure is built by hand, because the PKCS#7 support of the cryptography module can only sign
+    plain data, while Authenticode signs an SpcIndirectDataContent structure.
+    """
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    # SpcPeImageData with the legacy "<<<Obsolete>>>" file link, like all signing tools use
+    pe_image_data = der_sequence(
+        der(0x03, b'\0'),
+        der(0xa0, der(0xa2, der(0x80, '<<<Obsolete>>>'.encode('utf-16-be')))),
+    )
+    indirect_data = der_sequence(
+        der_sequence(der_oid(OID_SPC_PE_IMAGE_DATA), pe_image_data),
+        der_sequence(der_algorithm(OID_SHA256), der(0x04, digest)),
+    )
+
+    # The message digest covers the contents of SpcIndirectDataContent, without its tag and length
+    message_digest = hashlib.sha256(der_content(indirect_data)).digest()
+
+    attributes = der_set(
+        der_sequence(der_oid(OID_CONTENT_TYPE), der_set(der_oid(OID_SPC_INDIRECT_DATA))),
+        der_sequence(der_oid(OID_SPC_SP_OPUS_INFO), der_set(der_sequence())),
+        der_sequence(der_oid(OID_MESSAGE_DIGEST), der_set(der(0x04, message_digest))),
+    )
+    signature = key.sign(attributes, padding.PKCS1v15(), hashes.SHA256())
+
+    signer_info = der_sequence(
+        der_integer(1),
+        der_sequence(cert.issuer.public_bytes(), der_integer(cert.serial_number)),
+        der_algorithm(OID_SHA256),
+        # The signed attributes are stored with an implicit [0] tag instead of the SET tag
+        b'\xa0' + attributes[1:],
+        der_algorithm(OID_RSA_ENCRYPTION),
+        der(0x04, signature),
+    )
+    signed_data = der_sequence(
+        der_integer(1),
+        der_set(der_algorithm(OID_SHA256)),
+        der_sequence(der_oid(OID_SPC_INDIRECT_DATA), der(0xa0, indirect_data)),
+        der(0xa0, cert.public_bytes(serialization.Encoding.DER)),
+        der_set(signer_info),
+    )
+    return der_sequence(der_oid(OID_PKCS7_SIGNED_DATA), der(0xa0, signed_data))
+
+
+def pe_is_signed(path: pathlib.Path) -> bool:
+    "Return whether the PE file at path has a certificate table, without running sbverify or pesign"
+    return PEImage.load(pathlib.Path(path)).directory(IMAGE_DIRECTORY_ENTRY_SECURITY)[1] != 0
+
+
+def builtin_sign(sign_tool, input_f, output_f, opts=None):
+    """Sign input_f for Secure Boot with a local key and certificate and write the result to output_f
+
+    Existing signatures are replaced. The hashing and signing is done in-process, using the cryptography
+    module, so sbsign or pesign are not needed.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = serialization.load_pem_private_key(pathlib.Path(opts.sb_key).read_bytes(), password=None)
+    if not isinstance(key, rsa.RSAPrivateKey):
+        raise ValueError(f'{opts.sb_key}: only RSA keys can be used for Secure Boot signing')
+    cert = x509.load_pem_x509_certificate(pathlib.Path(opts.sb_cert).read_bytes())
+
+    pe = PEImage.load(pathlib.Path(input_f))
+    signature, _ = pe.directory(IMAGE_DIRECTORY_ENTRY_SECURITY)
+    size = signature or os.stat(input_f).st_size
+    pe.set_directory(IMAGE_DIRECTORY_ENTRY_SECURITY, 0, 0)
+
+    with open(output_f, 'wb') as f:
+        copy_file_to_offset(input_f, f.fileno(), 0, size)
+        # The certificate table is aligned to 8 bytes, the padding is part of the hashed data
+        size = round_up(size, 8)
+        os.ftruncate(f.fileno(), size)
+        os.pwrite(f.fileno(), pe.headers(), 0)
+        f.flush()
+
+        pkcs7 = authenticode_signature(authenticode_digest(pe, pathlib.Path(output_f), size), key, cert)
+        table = WIN_CERTIFICATE.pack(WIN_CERTIFICATE.size + len(pkcs7),
+                                     WIN_CERT_REVISION_2_0,
+                                     WIN_CERT_TYPE_PKCS_SIGNED_DATA) + pkcs7
+        table += bytes(round_up(len(table), 8) - len(table))
+        os.pwrite(f.fileno(), table, size)
+
+        pe.set_directory(IMAGE_DIRECTORY_ENTRY_SECURITY, size, len(table))
+        os.pwrite(f.fileno(), pe.headers(), 0)
+
+
+def find_signer(opts):
+    "Return the SecureBoot signing tool and the function to sign with it"
+    if opts.signtool == 'builtin':
+        return 'builtin', builtin_sign
+
+    if opts.signtool == 'sbsign':
+        sign_tool = find_sbsign(opts=opts)
+        sign = sbsign_sign
+    else:
+        sign_tool = find_pesign(opts=opts)
+        sign = pesign_sign
+
+    if sign_tool is None:
+        raise ValueError(f'{opts.signtool}, required for signing, is not installed')
+
+    return sign_tool, sign
+
+
+def sign_kernel_payload(opts, cache, sign_tool, sign):
+    "Return the kernel to embed, signing it first if requested or if it is not signed yet"
+    sign_kernel = opts.sign_kernel
+
+    if sign_kernel is None:
+        # figure out if we should sign the kernel
+        sign_kernel = not pe_is_signed(opts.linux)
+
+    if not sign_kernel:
+        return opts.linux
+
+    sign_inputs = [
+        tool_path(sign_tool),
+        opts.signing_engine,
+        pathlib.Path(opts.sb_key) if opts.sb_key and opts.signing_engine is None else opts.sb_key,
+        pathlib.Path(opts.sb_cert) if opts.sb_cert and opts.signing_engine is None else opts.sb_cert,
+        opts.sb_certdir if opts.signtool == 'pesign' else None,
+        opts.sb_cert_name,
     ]
-    if 'flags' in tool:
-        cmd.append(tool['flags'])
 
-    print('+', shell_join(cmd))
-    info = subprocess.check_output(cmd, text=True)
+    def sign_linux(path):
+        print(f'Signing {opts.linux}')
+        sign(sign_tool, opts.linux, path, opts=opts)
+
+    return cache.file('linux-signed', [*sign_inputs, opts.linux], sign_linux)
 
-    return tool['output'] in info
 
-def make_uki(opts):
+def make_uki(opts, cache=None):
+    # If a cache is passed in, the caller is responsible for trimming it
+    evict = cache is None
+    if cache is None:
+        cache = BuildCache(opts.cache_dir, opts.cache_size)
+
     # kernel payload signing
 
     sign_tool = None
     sign_args_present = opts.sb_key or opts.sb_cert_name
-    sign_kernel = opts.sign_kernel
     sign = None
     linux = opts.linux
 
     if sign_args_present:
-        if opts.signtool == 'sbsign':
-            sign_tool = find_sbsign(opts=opts)
-            sign = sbsign_sign
-            verify_tool = SBVERIFY
-        else:
-            sign_tool = find_pesign(opts=opts)
-            sign = pesign_sign
-            verify_tool = PESIGCHECK
-
-        if sign_tool is None:
-            raise ValueError(f'{opts.signtool}, required for signing, is not installed')
+        sign_tool, sign = find_signer(opts)
 
-        if sign_kernel is None and opts.linux is not None:
-            # figure out if we should sign the kernel
-            sign_kernel = verify(verify_tool, opts)
-
-        if sign_kernel:
-            linux_signed = tempfile.NamedTemporaryFile(prefix='linux-signed')
-            linux = pathlib.Path(linux_signed.name)
-            sign(sign_tool, opts.linux, linux, opts=opts)
+        if opts.linux is not None:
+            with profile_phase('sign-kernel'):
+                linux = sign_kernel_payload(opts, cache, sign_tool, sign)
 
     if opts.uname is None and opts.linux is not None:
         print('Kernel version not specified, starting autodetection 😖.')
-        opts.uname = Uname.scrape(opts.linux, opts=opts)
+        with profile_phase('uname') as record:
+            record['processed_bytes'] = opts.linux.stat().st_size
+            opts.uname = cache.text('uname', [opts.linux], lambda: Uname.scrape(opts.linux, opts=opts))
 
     uki = UKI(opts.stub)
     initrd = join_initrds(opts.initrd)
@@ -884,39 +2171,394 @@ uki,1,UKI,uki,1,https://uapi-group.org/specifications/specs/unified_kernel_image
             opts.sbat = ["""sbat,1,SBAT Version,sbat,1,https://github.com/rhboot/shim/blob/main/SBAT.md
 uki-addon,1,UKI Addon,addon,1,https://www.freedesktop.org/software/systemd/man/latest/systemd-stub.html
 """]
-    uki.add_section(Section.create('.sbat', merge_sbat(input_pes, opts.sbat), measure=linux is not None))
+    sbat_inputs = [pathlib.Path(t[1:]) if t.startswith('@') else t for t in opts.sbat]
+    with profile_phase('sbat'):
+        sbat = cache.text('sbat', [input_pes, sbat_inputs], lambda: merge_sbat(input_pes, opts.sbat, cache=cache))
+    uki.add_section(Section.create('.sbat', sbat, measure=linux is not None))
 
     # PCR measurement and signing
 
     # We pass in the contents for .linux separately because we need them to do the measurement but can't add
     # the section yet because we want .linux to be the last section. Make sure any other sections are added
-    # before this function is called.
-    call_systemd_measure(uki, linux, opts=opts)
+    # before this function is called. Only the shared sections are measured and signed. A stub that does
+    # not know about profiles uses the first section of each name, i.e. the shared sections and their
+    # .pcrsig. Neither systemd-measure nor the stub measure .profile sections, so no signature could be
+    # made that matches a selected profile.
+    with profile_phase('measure') as record:
+        record['processed_bytes'] = (sum(s.size() for s in uki.sections if s.measure) +
+                                     (content_size(linux) if linux is not None else 0))
+        call_systemd_measure(uki, linux, opts=opts, cache=cache)
 
     # UKI creation
 
     if linux is not None:
         uki.add_section(Section.create('.linux', linux, measure=True))
 
-    if sign_args_present:
-        unsigned = tempfile.NamedTemporaryFile(prefix='uki')
-        unsigned_output = unsigned.name
-    else:
-        unsigned_output = opts.output
+    # The profiles follow the shared sections. All of them use the one copy of .linux and .initrd.
+    for sections in opts.profiles.values():
+        for section in sections:
+            uki.add_section(section)
+
+    # The image is written next to the output and renamed into place once complete. Signed images get
+    # executable bits, like the output of the signing tools.
+    with replace_atomically(opts.output, 0o777 if sign_args_present else 0o666) as output:
+        if sign_args_present:
+            assert sign
+            # The unsigned image is only input for the signing tool. sbsign and pesign cannot read it from a
+            # pipe and cannot sign a precomputed digest, so it is passed to them in a memfd, which never hits
+            # the disk. If that is not possible, it is kept on the file system of the output.
+            tmp, unsigned = scratch_file('uki', directory=output.parent)
+            with tmp:
+                with profile_phase('assemble') as record:
+                    pe_add_sections(uki, unsigned)
+                    record['processed_bytes'] = unsigned.stat().st_size
+
+                # UKI signing. The paths passed to the signing tool are temporary, name the actual output.
+                print(f'Signing {opts.output}')
+                with profile_phase('sign') as record:
+                    record['processed_bytes'] = unsigned.stat().st_size
+                    sign(sign_tool, unsigned, output, opts=opts)
+        else:
+            with profile_phase('assemble') as record:
+                pe_add_sections(uki, output)
+                record['processed_bytes'] = output.stat().st_size
+
+    print(f"Wrote {'signed' if sign_args_present else 'unsigned'} {opts.output}")
+
+    if evict:
+        cache.evict()
+
+
+def patch_sections(opts) -> UKI:
+    "Return the sections to replace or add in the UKI to patch"
+    changes = UKI(opts.uki)
+
+    sections = [
+        # name,      content
+        ('.osrel',   opts.os_release),
+        ('.cmdline', opts.cmdline   ),
+        ('.dtb',     opts.devicetree),
+        ('.uname',   opts.uname     ),
+        ('.splash',  opts.splash    ),
+        ('.pcrpkey', opts.pcrpkey   ),
+        ('.ucode',   opts.microcode ),
+    ]
+
+    for name, content in sections:
+        if content:
+            changes.add_section(Section.create(name, content, measure=True))
+
+    if opts.sbat:
+        # The new entries are added to the ones already in the image
+        changes.add_section(Section.create('.sbat', merge_sbat([opts.uki], opts.sbat), measure=True))
+
+    for section in opts.sections:
+        if section.name in ('.linux', '.initrd'):
+            raise ValueError(f'patch: the {section.name} section cannot be replaced, use build')
+        section.measure = section.name in UNIFIED_SECTIONS
+        changes.add_section(section)
+
+    if not changes.sections and not opts.pcr_private_keys and not opts.measure:
+        raise ValueError('patch: no sections to replace or add specified')
+
+    return changes
+
 
-    pe_add_sections(uki, unsigned_output)
+def measure_patched(pe: PEImage, changes: UKI, opts) -> None:
+    """Calculate the PCR values and signatures for the patched image
 
-    # UKI signing
+    The sections which are not changed are read from the original image, through FileSlice objects,
+    so that .linux and .initrd are never copied. A new .pcrsig section is added to changes.
+    """
+    assert pe.path
+
+    def existing(section):
+        return FileSlice(pe.path, section.PointerToRawData, min(section.VirtualSize, section.SizeOfRawData))
+
+    linux = pe.section('.linux')
+    if linux is None:
+        raise ValueError(f'{pe.path} has no .linux section, cannot calculate PCR values')
+
+    uki = UKI(pe.path)
+    replaced = {s.name: s for s in changes.sections}
+    for name in UNIFIED_SECTIONS:
+        if name in ('.linux', '.pcrsig'):
+            continue
+        if name in replaced:
+            uki.add_section(replaced[name])
+        elif section := pe.section(name):
+            uki.add_section(Section(name, existing(section), measure=True))
+
+    call_systemd_measure(uki, existing(linux), opts=opts)
+
+    for section in uki.sections:
+        if section.name == '.pcrsig':
+            changes.add_section(section)
+
+
+def patch_uki(opts):
+    """Replace or add sections of an existing UKI
+
+    Sections are rewritten in place where the new contents fit into the space of the old section. Other
+    sections are appended to the file, and placed before .linux in memory, so that .linux stays last.
+    The changes are made in a copy of the UKI, which replaces it once complete, unless --in-place is
+    used. Apart from that copy, the .linux and .initrd payloads are neither read nor written, unless
+    they need to be measured.
+    """
+    pe = PEImage.load(opts.uki)
+    # Each profile overrides sections of the base image and has its own .pcrsig, which would need to be
+    # patched and measured separately
+    if pe.section('.profile'):
+        raise ValueError(f'{opts.uki} contains profiles, patching them is not supported, use build')
+
+    changes = patch_sections(opts)
+    names = [s.name for s in changes.sections]
+
+    # A Secure Boot signature would not be valid anymore, so it is stripped and the image signed again
+    sign_args_present = opts.sb_key or opts.sb_cert_name
+    signature, signature_size = pe.directory(IMAGE_DIRECTORY_ENTRY_SECURITY)
+    file_size = opts.uki.stat().st_size
+    if signature:
+        if not sign_args_present:
+            raise ValueError(f'{opts.uki} is signed, --secureboot-private-key=/--secureboot-certificate= '
+                             'or --secureboot-certificate-name= must be specified to sign it again')
+        if round_up(signature + signature_size, 8) < file_size:
+            raise PEError(f'{opts.uki}: the signature is not at the end of the file, refusing.')
+        pe.set_directory(IMAGE_DIRECTORY_ENTRY_SECURITY, 0, 0)
+        file_size = signature
 
     if sign_args_present:
-        assert sign
-        sign(sign_tool, unsigned_output, opts.output, opts=opts)
+        sign_tool, sign = find_signer(opts)
+
+    # The existing PCR signature is only valid for the old contents of the measured sections
+    measured_changed = any(s.measure and s.name != '.pcrsig' for s in changes.sections)
+    if '.pcrsig' not in names:
+        if pe.section('.pcrsig') and measured_changed and not opts.pcr_private_keys:
+            raise ValueError(f'{opts.uki} has a .pcrsig section, --pcr-private-key= must be specified '
+                             'to sign the new PCR values')
+        if opts.pcr_private_keys or opts.measure:
+            with profile_phase('measure'):
+                measure_patched(pe, changes, opts)
+
+    # Plan the new layout
+
+    def next_address(section):
+        return min((s.VirtualAddress for s in pe.sections if s.VirtualAddress > section.VirtualAddress),
+                   default=None)
+
+    writes = []
+    clears = []
+    appended = []
+
+    for section in changes.sections:
+        size = section.size()
+
+        if s := pe.section(section.name):
+            limit = next_address(s)
+            if size <= s.SizeOfRawData and (limit is None or s.VirtualAddress + size <= limit):
+                if s.Characteristics & IMAGE_SCN_CNT_INITIALIZED_DATA:
+                    pe.SizeOfInitializedData += size - s.VirtualSize
+                s.VirtualSize = size
+                writes += [(section, s.PointerToRawData, size, s.SizeOfRawData - size)]
+                print(f'Replacing {section.name} in place')
+                continue
+
+            # Too large, the old contents are dropped and the section is appended instead
+            if s.Characteristics & IMAGE_SCN_CNT_INITIALIZED_DATA:
+                pe.SizeOfInitializedData -= s.VirtualSize
+            pe.sections.remove(s)
+            clears += [(s.PointerToRawData, s.SizeOfRawData)]
+            characteristics = s.Characteristics
+            print(f'Moving {section.name} to the end of the image')
+        else:
+            characteristics = IMAGE_SCN_MEM_READ | IMAGE_SCN_CNT_INITIALIZED_DATA
+            print(f'Adding {section.name}')
 
-        # We end up with no executable bits, let's reapply them
-        os.umask(umask := os.umask(0))
-        os.chmod(opts.output, 0o777 & ~umask)
+        appended += [(section, size, characteristics)]
 
-    print(f"Wrote {'signed' if sign_args_present else 'unsigned'} {opts.output}")
+    # .linux shall be last to leave breathing room for decompression. Its contents stay where they are in
+    # the file, only its address is moved up.
+    linux = pe.sections.pop() if appended and pe.sections[-1].name == '.linux' else None
+
+    address = round_up(max(s.VirtualAddress + s.VirtualSize for s in pe.sections), pe.SectionAlignment)
+    file_end = round_up(file_size, pe.FileAlignment)
+
+    for section, size, characteristics in appended:
+        if pe.section_header_offset(len(pe.sections) + 1 + bool(linux)) > pe.SizeOfHeaders:
+            raise PEError(f'Not enough header space to add section {section.name}.')
+
+        new_section = PESection(
+            name=section.name,
+            VirtualSize=size,
+            VirtualAddress=address,
+            SizeOfRawData=round_up(size, pe.FileAlignment),
+            PointerToRawData=file_end,
+            Characteristics=characteristics,
+        )
+
+        if characteristics & IMAGE_SCN_CNT_INITIALIZED_DATA:
+            pe.SizeOfInitializedData += size
+        pe.sections.append(new_section)
+        writes += [(section, file_end, size, 0)]
+        address = round_up(address + size, pe.SectionAlignment)
+        file_end += new_section.SizeOfRawData
+
+    if linux:
+        linux.VirtualAddress = max(linux.VirtualAddress, address)
+        pe.sections.append(linux)
+
+    pe.CheckSum = 0
+    pe.SizeOfImage = round_up(
+        max(s.VirtualAddress + s.VirtualSize for s in pe.sections),
+        pe.SectionAlignment,
+    )
+
+    # Write the changes. Only the contents of the changed sections and the headers are written.
+
+    output = opts.output or opts.uki
+    # By default the patched image is prepared in a copy, which replaces the original only once it is
+    # complete (and signed), so that the original is left untouched if anything fails on the way. Only
+    # if explicitly requested, the changes are written to the original, which saves copying it.
+    in_place = opts.in_place
+
+    with contextlib.ExitStack() as stack:
+        with profile_phase('assemble') as record:
+            if in_place:
+                target = output
+            else:
+                target = stack.enter_context(replace_atomically(output, opts.uki.stat().st_mode & 0o777))
+                with open(target, 'wb') as f:
+                    copy_file_to_offset(opts.uki, f.fileno(), 0, file_size)
+
+            patch_image(pe, target, file_size, file_end, writes=writes, clears=clears)
+            record['processed_bytes'] = sum(size for _, _, size, _ in writes)
+
+        if sign_args_present:
+            print(f'Signing {output}')
+            with profile_phase('sign') as record, \
+                 replace_atomically(target, 0o777) as signed:
+                record['processed_bytes'] = target.stat().st_size
+                sign(sign_tool, target, signed, opts=opts)
+
+    print(f"Wrote {'signed' if sign_args_present else 'unsigned'} {output}")
+
+
+def patch_image(pe: PEImage, path: pathlib.Path, file_size: int, file_end: int, *, writes, clears) -> None:
+    "Write the changed sections and headers of pe to path. Other contents of the file are not touched."
+    with open(path, 'r+b') as f:
+        os.ftruncate(f.fileno(), file_size)
+
+        for offset, size in clears:
+            os.pwrite(f.fileno(), bytes(size), offset)
+
+        for section, offset, size, clear in writes:
+            section.copy_to_offset(f.fileno(), offset, size)
+            if clear:
+                os.pwrite(f.fileno(), bytes(clear), offset + size)
+
+        # The padding of appended sections is zero-filled implicitly by extending the file
+        os.ftruncate(f.fileno(), max(file_size, file_end))
+        os.pwrite(f.fileno(), pe.headers(), 0)
+
+
+def share_build_inputs(images):
+    """Do the work several images of a build-many manifest have in common only once
+
+    The stubs and the SBAT sections are parsed into the per-process memos, which are inherited by the
+    worker processes. The kernel version and the signed kernel are filled into the options of each
+    image. Returns the build caches for the images, keyed by cache directory.
+    """
+    caches = {}
+    unames = {}
+    kernels = {}
+
+    for image in images:
+        cache = caches.setdefault(image.cache_dir, BuildCache(image.cache_dir, image.cache_size))
+
+        load_stub(image.stub)
+        pe_sbat(image.stub, cache=cache)
+
+        if image.linux is None:
+            continue
+
+        if image.uname is None:
+            if image.linux not in unames:
+                print(f'Kernel version of {image.linux} not specified, starting autodetection 😖.')
+                unames[image.linux] = cache.text('uname', [image.linux],
+                                                 lambda image=image: Uname.scrape(image.linux, opts=image))
+            image.uname = unames[image.linux]
+
+        if image.sb_key or image.sb_cert_name:
+            key = (image.linux, image.sign_kernel, image.signtool, image.signing_engine,
+                   image.sb_key, image.sb_cert, image.sb_certdir, image.sb_cert_name)
+            if key not in kernels:
+                kernels[key] = sign_kernel_payload(image, cache, *find_signer(image))
+            image.linux = kernels[key]
+            image.sign_kernel = False
+
+        pe_sbat(image.linux, cache=cache)
+
+    return caches
+
+
+def make_uki_in_worker(image, cache):
+    """Build one image of a build-many manifest in a worker process
+
+    If a profile is taken, the phases of the build are recorded in a new profile, and returned to be added
+    to the profile of the parent process.
+    """
+    global PROFILE  # pylint: disable=global-statement
+
+    if PROFILE is None:
+        make_uki(image, cache=cache)
+        return None
+
+    PROFILE = Profile()
+    with PROFILE.phase(image.image_name) as record:
+        make_uki(image, cache=cache)
+    return record
+
+
+def make_many_ukis(opts):
+    with profile_phase('share-inputs'):
+        caches = share_build_inputs(opts.images)
+    failed = []
+
+    if opts.jobs == 1 or len(opts.images) == 1:
+        for image in opts.images:
+            try:
+                with profile_phase(image.image_name):
+                    make_uki(image, cache=caches[image.cache_dir])
+            except Exception as e:  # pylint: disable=broad-except
+                print(f'{Style.red}Failed to build image {image.image_name!r}: {e}{Style.reset}', file=sys.stderr)
+                failed += [image.image_name]
+    else:
+        # Fork, so that the workers inherit the work done above
+        import concurrent.futures
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        # Unless requested otherwise, the images create their PCR signatures one at a time, so that no more
+        # than --jobs signing tools (and sessions of a signing engine) are running at once
+        for image in opts.images:
+            if image.signing_jobs is None:
+                image.signing_jobs = 1
+        with concurrent.futures.ProcessPoolExecutor(max_workers=opts.jobs, mp_context=context) as pool:
+            futures = [pool.submit(make_uki_in_worker, image, cache=caches[image.cache_dir])
+                       for image in opts.images]
+            for image, future in zip(opts.images, futures):
+                try:
+                    record = future.result()
+                    if record is not None:
+                        PROFILE.add(record)
+                except Exception as e:  # pylint: disable=broad-except
+                    print(f'{Style.red}Failed to build image {image.image_name!r}: {e}{Style.reset}', file=sys.stderr)
+                    failed += [image.image_name]
+
+    for cache in caches.values():
+        cache.evict()
+
+    if failed:
+        raise ValueError(f'Failed to build {len(failed)} of {len(opts.images)} images: {", ".join(failed)}')
 
 
 @contextlib.contextmanager
@@ -1010,6 +2652,7 @@ def generate_keys(opts):
     # This will generate keys and certificates and write them to the paths that
     # are specified as input paths.
     if opts.sb_key or opts.sb_cert:
+        import socket
         fqdn = socket.getfqdn()
         cn = f'SecureBoot signing key on host {fqdn}'
         key_pem, cert_pem = generate_key_cert_pair(
@@ -1052,46 +2695,90 @@ def inspect_section(opts, section):
         return name, None
 
     ttype = config.output_mode if config else DEFAULT_SECTIONS_TO_SHOW.get(name, 'binary')
+    if opts.digest_only:
+        ttype = 'binary'
 
     size = section.Misc_VirtualSize
+    # Equivalent to section.get_data(length=size), but without copying the data. pefile maps the file
+    # into memory, so the data is only read from disk as it is hashed.
     # TODO: Use ignore_padding once we can depend on a newer version of pefile
-    data = section.get_data(length=size)
-    digest = sha256(data).hexdigest()
+    offset = section.get_PointerToRawData_adj()
+    end = min(offset + size, section.PointerToRawData + section.SizeOfRawData)
+    with memoryview(section.pe.__data__)[offset:end] as data:
+        h = sha256()
+        for pos in range(0, len(data), HASH_CHUNK_SIZE):
+            h.update(data[pos:pos + HASH_CHUNK_SIZE])
+        digest = h.hexdigest()
+
+        struct = {
+            'size' : size,
+            'sha256' : digest,
+        }
 
-    struct = {
-        'size' : size,
-        'sha256' : digest,
-    }
+        if ttype == 'text':
+            try:
+                struct['text'] = str(data, 'utf-8')
+            except UnicodeDecodeError as e:
+                print(f"Section {name!r} is not valid text: {e}")
+                struct['text'] = '(not valid UTF-8)'
 
-    if ttype == 'text':
-        try:
-            struct['text'] = data.decode()
-        except UnicodeDecodeError as e:
-            print(f"Section {name!r} is not valid text: {e}")
-            struct['text'] = '(not valid UTF-8)'
+        if config and config.content:
+            assert isinstance(config.content, pathlib.Path)
+            config.content.write_bytes(data)
+
+    return name, struct
 
-    if config and config.content:
-        assert isinstance(config.content, pathlib.Path)
-        config.content.write_bytes(data)
 
-    if opts.json == 'off':
-        print(f"{name}:\n  size: {size} bytes\n  sha256: {digest}")
-        if ttype == 'text':
-            text = textwrap.indent(struct['text'].rstrip(), ' ' * 4)
-            print(f"  text:\n{text}")
+def format_section(name, desc):
+    text = f"{name}:\n  size: {desc['size']} bytes\n  sha256: {desc['sha256']}\n"
+    if 'text' in desc:
+        text += '  text:\n' + textwrap.indent(desc['text'].rstrip(), ' ' * 4) + '\n'
+    return text
 
-    return name, struct
+
+def inspect_file(opts, file):
+    import pefile  # type: ignore
+
+    pe = pefile.PE(file, fast_load=True)
+    try:
+        descs = {}
+        profile = None
+        for section in pe.sections:
+            name, desc = inspect_section(opts, section)
+            if name == '.profile':
+                profile = 0 if profile is None else profile + 1
+            if desc:
+                # The sections of profiles are suffixed with the number of the profile
+                descs[name if profile is None else f'{name}@{profile}'] = desc
+        return descs
+    finally:
+        pe.close()
 
 
 def inspect_sections(opts):
     indent = 4 if opts.json == 'pretty' else None
 
-    for file in opts.files:
-        pe = pefile.PE(file, fast_load=True)
-        gen = (inspect_section(opts, section) for section in pe.sections)
-        descs = {key:val for (key, val) in gen if val}
-        if opts.json != 'off':
+    def output(file, descs):
+        if opts.json == 'off':
+            print(''.join(format_section(name, desc) for name, desc in descs.items()), end='')
+        elif len(opts.files) > 1:
+            # One object per line, so that the output can be processed as a stream
+            print(json.dumps({'file': str(file), 'sections': descs}))
+        else:
             json.dump(descs, sys.stdout, indent=indent)
+        sys.stdout.flush()
+
+    if opts.jobs == 1 or len(opts.files) == 1:
+        for file in opts.files:
+            output(file, inspect_file(opts, file))
+        return
+
+    # Parsing is cheap, most of the time is spent hashing, which is done without holding the GIL.
+    # The results are printed in the order of the files, as soon as they are available.
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opts.jobs or os.cpu_count()) as pool:
+        for file, descs in zip(opts.files, pool.map(functools.partial(inspect_file, opts), opts.files)):
+            output(file, descs)
 
 
 @dataclasses.dataclass(frozen=True)
@@ -1159,6 +2846,23 @@ class ConfigItem:
         setattr(namespace, dest,
                 old + ([None] * (idx - len(old))) + [value])
 
+    @staticmethod
+    def config_append_group(
+            namespace: argparse.Namespace,
+            group: Optional[str],
+            dest: str,
+            value: Any,
+    ) -> None:
+        "Append each line of value to namespace.<dest>, prefixed with the group name"
+
+        assert group
+
+        old = getattr(namespace, dest, None)
+        if old is None:
+            old = []
+        setattr(namespace, dest,
+                old + [f'{group}:{line.strip()}' for line in value.splitlines() if line.strip()])
+
     @staticmethod
     def parse_boolean(s: str) -> bool:
         "Parse 1/true/yes/y/t/on as true and 0/false/no/n/f/off/None as false"
@@ -1208,6 +2912,10 @@ class ConfigItem:
         assert f'{section}/{key}' == self.config_key
         dest = self.argparse_dest()
 
+        self.config_push(namespace, group, dest, self.convert(value))
+
+    def convert(self, value: Union[str, list[str]]) -> Any:
+        "Convert a value from a config file or a manifest to the type used by argparse"
         conv: Callable[[str], Any]
         if self.action == argparse.BooleanOptionalAction:
             # We need to handle this case separately: the options are called
@@ -1223,11 +2931,11 @@ class ConfigItem:
         # with multiple args on the command line and a space-separated list in the
         # config file.
         if self.name == '--initrd':
-            value = [conv(v) for v in value.split()]
-        else:
-            value = conv(value)
+            if isinstance(value, str):
+                value = value.split()
+            return [conv(v) for v in value]
 
-        self.config_push(namespace, group, dest, value)
+        return conv(value)
 
     def config_example(self) -> tuple[Optional[str], Optional[str], Optional[str]]:
         if not self.config_key:
@@ -1239,10 +2947,13 @@ class ConfigItem:
             value = '|'.join(self.choices)
         else:
             value = self.metavar or self.argparse_dest().upper()
+        if self.config_push is ConfigItem.config_append_group:
+            # The group is specified by the section name instead of a prefix of the value
+            value = value.split(':', 1)[1]
         return (section_name, key, value)
 
 
-VERBS = ('build', 'genkey', 'inspect')
+VERBS = ('build', 'build-many', 'genkey', 'inspect', 'patch')
 
 CONFIG_ITEMS = [
     ConfigItem(
@@ -1370,6 +3081,16 @@ CONFIG_ITEMS = [
         default = [],
         help = 'section as name and contents [NAME section] or section to print',
     ),
+    ConfigItem(
+        '--profile-section',
+        dest = 'profile_sections',
+        metavar = 'ID:NAME:TEXT|@PATH',
+        action = 'append',
+        default = [],
+        help = 'section of profile ID, which shares the other sections with the other profiles. Selecting a profile needs a stub with support for .profile sections',
+        config_key = 'Profile:/Section',
+        config_push = ConfigItem.config_append_group,
+    ),
 
     ConfigItem(
         '--pcr-banks',
@@ -1386,9 +3107,9 @@ CONFIG_ITEMS = [
     ),
     ConfigItem(
         '--signtool',
-        choices = ('sbsign', 'pesign'),
+        choices = ('sbsign', 'pesign', 'builtin'),
         dest = 'signtool',
-        help = 'whether to use sbsign or pesign. It will also be inferred by the other \
+        help = 'whether to use sbsign, pesign, or the builtin signer. It will also be inferred by the other \
         parameters given: when using --secureboot-{private-key/certificate}, sbsign \
         will be used, otherwise pesign will be used',
         config_key = 'UKI/SecureBootSigningTool',
@@ -1466,6 +3187,23 @@ CONFIG_ITEMS = [
         config_push = ConfigItem.config_set_group,
     ),
 
+    ConfigItem(
+        '--cache-dir',
+        metavar = 'PATH',
+        type = pathlib.Path,
+        help = 'directory to cache intermediate build results in',
+        config_key = 'UKI/CacheDirectory',
+    ),
+    ConfigItem(
+        '--cache-size',
+        metavar = 'BYTES',
+        type = parse_size,
+        default = 1024**3,
+        help = 'maximum total size of the build cache',
+        config_key = 'UKI/CacheSize',
+        config_push = ConfigItem.config_set,
+    ),
+
     ConfigItem(
         '--tools',
         type = pathlib.Path,
@@ -1473,16 +3211,36 @@ CONFIG_ITEMS = [
         help = 'Directories to search for tools (systemd-measure, …)',
     ),
 
+    ConfigItem(
+        '--jobs',
+        metavar = 'N',
+        type = parse_jobs,
+        help = 'number of images to build or files to inspect in parallel',
+    ),
+
+    ConfigItem(
+        '--signing-jobs',
+        metavar = 'N',
+        type = parse_jobs,
+        help = 'number of PCR signatures to create in parallel for each image',
+    ),
+
     ConfigItem(
         ('--output', '-o'),
         type = pathlib.Path,
         help = 'output file path',
     ),
 
+    ConfigItem(
+        '--in-place',
+        help = 'patch: write the changes into the UKI directly, instead of into a copy that replaces it',
+        action = 'store_true',
+    ),
+
     ConfigItem(
         '--measure',
         action = argparse.BooleanOptionalAction,
-        help = 'print systemd-measure output for the UKI',
+        help = 'print pre-calculated PCR values for the UKI, like systemd-measure calculate',
     ),
 
     ConfigItem(
@@ -1499,11 +3257,24 @@ CONFIG_ITEMS = [
         help='equivalent to --json=pretty',
     ),
 
+    ConfigItem(
+        '--profile',
+        choices = ('json', 'off'),
+        default = 'off',
+        help = 'print the time, I/O and memory use of each phase to standard error when done',
+    ),
+
     ConfigItem(
         '--all',
         help = 'print all sections',
         action = 'store_true',
     ),
+
+    ConfigItem(
+        '--digest-only',
+        help = 'print only the size and digest of sections, not their contents',
+        action = 'store_true',
+    ),
 ]
 
 CONFIGFILE_ITEMS = { item.config_key:item
@@ -1566,6 +3337,104 @@ def apply_config(namespace, filename=None):
                 print(f'Unknown config setting [{section_name}] {key}=')
 
 
+# Settings that can be specified per image in a build-many manifest
+MANIFEST_ITEMS = { key.removeprefix('UKI/'):item
+                   for key, item in CONFIGFILE_ITEMS.items()
+                   if key.startswith('UKI/') }
+
+
+def parse_manifest(filename: pathlib.Path) -> list[tuple[str, dict[str, Any]]]:
+    """Return a list of (name, settings) for the images listed in a build-many manifest
+
+    The manifest is either JSON (a list of objects, or an object mapping image names to objects), or
+    uses the config file syntax with one [Image:NAME] section per image. The settings use the keys
+    of the [UKI] config file section, plus Output= for the path of the image.
+    """
+    text = filename.read_text()
+
+    try:
+        manifest = json.loads(text)
+    except json.JSONDecodeError:
+        cp = configparser.ConfigParser(
+            comment_prefixes='#',
+            inline_comment_prefixes='#',
+            delimiters='=',
+            empty_lines_in_values=False,
+            interpolation=None,
+            strict=False)
+        # Do not make keys lowercase
+        cp.optionxform = lambda option: option
+        cp.read_string(text, source=str(filename))
+
+        images = []
+        for section_name in cp.sections():
+            kind, _, name = section_name.partition(':')
+            if kind != 'Image' or not name:
+                raise ValueError(f'{filename}: unknown manifest section [{section_name}]') from None
+            images += [(name, dict(cp[section_name]))]
+    else:
+        if isinstance(manifest, list):
+            images = [(str(i), entry) for i, entry in enumerate(manifest)]
+        elif isinstance(manifest, dict):
+            images = list(manifest.items())
+        else:
+            raise ValueError(f'{filename}: manifest must be a JSON list or object')
+
+        for name, entry in images:
+            if not isinstance(entry, dict):
+                raise ValueError(f'{filename}: image {name!r} must be a JSON object')
+            for key, value in entry.items():
+                if isinstance(value, bool):
+                    entry[key] = 'yes' if value else 'no'
+                elif not isinstance(value, (str, list)):
+                    entry[key] = str(value)
+
+    if not images:
+        raise ValueError(f'{filename}: no images specified')
+
+    return images
+
+
+def finalize_manifest(opts):
+    if len(opts.positional) != 2:
+        raise ValueError('build-many: exactly one manifest file must be specified')
+
+    base = copy.deepcopy(vars(opts))
+    opts.verb = 'build-many'
+    opts.manifest = pathlib.Path(opts.positional[1])
+    opts.images = []
+
+    for name, settings in parse_manifest(opts.manifest):
+        image = argparse.Namespace(**copy.deepcopy(base))
+        image.positional = ['build']
+        image.summary = False
+
+        for key, value in settings.items():
+            if key == 'Output':
+                image.output = pathlib.Path(value)
+            elif item := MANIFEST_ITEMS.get(key):
+                value = item.convert(value)
+                if item.action == 'append' and not isinstance(value, list):
+                    value = [value]
+                setattr(image, item.argparse_dest(), value)
+            else:
+                raise ValueError(f'{opts.manifest}: unknown setting {key}= for image {name!r}')
+
+        finalize_options(image)
+        image.image_name = name
+        opts.images += [image]
+
+    outputs = [image.output for image in opts.images]
+    if duplicates := {str(o) for o in outputs if outputs.count(o) > 1}:
+        raise ValueError(f'{opts.manifest}: multiple images with the same output: {", ".join(sorted(duplicates))}')
+
+    if opts.summary:
+        import pprint
+        for image in opts.images:
+            pprint.pprint(vars(image))
+        sys.exit()
+
+
 def config_example():
     prev_section = None
     for item in CONFIG_ITEMS:
@@ -1596,8 +3465,10 @@ def create_parser():
         description='Build and sign Unified Kernel Images',
         usage='\n  ' + textwrap.dedent('''\
           ukify {b}build{e} [--linux=LINUX] [--initrd=INITRD] [options…]
+            ukify {b}build-many{e} MANIFEST [options…]
             ukify {b}genkey{e} [options…]
             ukify {b}inspect{e} FILE… [options…]
+            ukify {b}patch{e} UKI [--cmdline=CMDLINE] [--os-release=OSREL] [options…]
         ''').format(b=Style.bold, e=Style.reset),
         allow_abbrev=False,
         add_help=False,
@@ -1625,14 +3496,31 @@ def finalize_options(opts):
     # Figure out which syntax is being used, one of:
     # ukify verb --arg --arg --arg
     # ukify linux initrd…
+    if len(opts.positional) >= 1 and opts.positional[0] == 'build-many':
+        # The options serve as defaults for the images listed in the manifest, which are finalized
+        # separately.
+        finalize_manifest(opts)
+        return
+
     if len(opts.positional) >= 1 and opts.positional[0] == 'inspect':
         opts.verb = opts.positional[0]
         opts.files = opts.positional[1:]
         if not opts.files:
             raise ValueError('file(s) to inspect must be specified')
-        if len(opts.files) > 1 and opts.json != 'off':
-            # We could allow this in the future, but we need to figure out the right structure
-            raise ValueError('JSON output is not allowed with multiple files')
+        if len(opts.files) > 1 and opts.json == 'pretty':
+            # With multiple files, one object per line is printed
+            raise ValueError('Pretty JSON output is not allowed with multiple files, use --json=short')
+    elif len(opts.positional) >= 1 and opts.positional[0] == 'patch':
+        opts.verb = opts.positional[0]
+        if len(opts.positional) != 2:
+            raise ValueError('patch: exactly one UKI must be specified')
+        opts.uki = pathlib.Path(opts.positional[1])
+        if opts.linux or opts.initrd:
+            raise ValueError('patch: the .linux and .initrd sections cannot be replaced, use build')
+        if opts.profile_sections:
+            raise ValueError('patch: profiles cannot be added, use build')
+        if opts.in_place and (opts.output or opts.sb_key or opts.sb_cert_name):
+            raise ValueError('patch: --in-place cannot be used with --output= or when signing')
     elif len(opts.positional) == 1 and opts.positional[0] in VERBS:
         opts.verb = opts.positional[0]
     elif opts.linux or opts.initrd:
@@ -1674,7 +3562,8 @@ def finalize_options(opts):
     if opts.efi_arch is None:
         opts.efi_arch = guess_efi_arch()
 
-    if opts.stub is None:
+    # The stub of an image being patched is already part of it
+    if opts.stub is None and opts.verb != 'patch':
         if opts.linux is not None:
             opts.stub = pathlib.Path(f'/usr/lib/systemd/boot/efi/linux{opts.efi_arch}.efi.stub')
         else:
@@ -1690,10 +3579,12 @@ def finalize_options(opts):
         # one param only given, sbsign needs both
         raise ValueError('--secureboot-private-key= and --secureboot-certificate= must be specified together')
     elif bool(opts.sb_key) and bool(opts.sb_cert):
-        # both param given, infer sbsign and in case it was given, ensure signtool=sbsign
-        if opts.signtool and opts.signtool != 'sbsign':
+        # both param given, infer sbsign and in case it was given, ensure signtool=sbsign or builtin
+        if opts.signtool and opts.signtool not in ('sbsign', 'builtin'):
             raise ValueError(f'Cannot provide --signtool={opts.signtool} with --secureboot-private-key= and --secureboot-certificate=')
-        opts.signtool = 'sbsign'
+        if opts.signtool == 'builtin' and opts.signing_engine is not None:
+            raise ValueError('Cannot provide --signing-engine= with --signtool=builtin')
+        opts.signtool = opts.signtool or 'sbsign'
     elif bool(opts.sb_cert_name):
         # sb_cert_name given, infer pesign and in case it was given, ensure signtool=pesign
         if opts.signtool and opts.signtool != 'pesign':
@@ -1714,33 +3605,60 @@ def finalize_options(opts):
     opts.sections = [f(s) for s in opts.sections]
     # A convenience dictionary to make it easy to look up sections
     opts.sections_by_name = {s.name:s for s in opts.sections}
+    opts.profiles = parse_profile_sections(opts.profile_sections)
+    if opts.profiles:
+        print(f'{Style.yellow}Warning: profiles can only be selected with a stub which supports .profile '
+              f'sections, other stubs always boot the shared sections. Profiles are not measured or '
+              f'signed.{Style.reset}', file=sys.stderr)
 
     if opts.summary:
         # TODO: replace pprint() with some fancy formatting.
+        import pprint
         pprint.pprint(vars(opts))
         sys.exit()
 
 
 def parse_args(args=None):
     opts = create_parser().parse_args(args)
-    apply_config(opts)
+    # The default config file has no settings for inspect, so don't look for it. For patch, the settings of
+    # the image being built would be applied to an existing image. So for those verbs, only a config file
+    # given explicitly is used.
+    if opts.config or opts.positional[:1] not in (['inspect'], ['patch']):
+        apply_config(opts)
     finalize_options(opts)
     return opts
 
 
 def main():
+    global PROFILE  # pylint: disable=global-statement
+
     opts = parse_args()
+    if opts.profile == 'json':
+        PROFILE = Profile()
+
     if opts.verb == 'build':
         check_inputs(opts)
         make_uki(opts)
+    elif opts.verb == 'build-many':
+        for image in opts.images:
+            check_inputs(image)
+        make_many_ukis(opts)
     elif opts.verb == 'genkey':
         check_cert_and_keys_nonexistent(opts)
         generate_keys(opts)
     elif opts.verb == 'inspect':
         inspect_sections(opts)
+    elif opts.verb == 'patch':
+        check_inputs(opts)
+        patch_uki(opts)
     else:
         assert False
 
+    if PROFILE:
+        # A single document, so that it can be consumed directly
+        json.dump(PROFILE.report(opts.verb), sys.stderr)
+        print(file=sys.stderr)
+
 
 if __name__ == '__main__':
     main()
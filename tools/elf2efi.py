@@ -22,10 +22,20 @@
 # pylint: disable=attribute-defined-outside-init
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import hashlib
-import io
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
 import pathlib
+import shlex
+import struct
 import sys
 import time
 import typing
@@ -40,6 +50,7 @@ from ctypes import (
 )
 
 from elftools.elf.constants import SH_FLAGS
+from elftools.elf.dynamic import DynamicSection
 from elftools.elf.elffile import ELFFile
 from elftools.elf.enums import (
     ENUM_DT_FLAGS_1,
@@ -48,10 +59,7 @@ from elftools.elf.enums import (
     ENUM_RELOC_TYPE_i386,
     ENUM_RELOC_TYPE_x64,
 )
-from elftools.elf.relocation import (
-    Relocation as ElfRelocation,
-    RelocationTable as ElfRelocationTable,
-)
+from elftools.elf.sections import Section as ElfSection
 
 
 class PeCoffHeader(LittleEndianStructure):
@@ -79,10 +87,6 @@ class PeRelocationBlock(LittleEndianStructure):
         ("BlockSize", c_uint32),
     )
 
-    def __init__(self, PageRVA: int):
-        super().__init__(PageRVA)
-        self.entries: typing.List[PeRelocationEntry] = []
-
 
 class PeRelocationEntry(LittleEndianStructure):
     _fields_ = (
@@ -179,6 +183,13 @@ class PeOptionalHeader32Plus(PeOptionalHeader):
     )
 
 
+class Extent(typing.NamedTuple):
+    "A range of the input ELF file, or zero fill if offset is None"
+
+    offset: typing.Optional[int]
+    size: int
+
+
 class PeSection(LittleEndianStructure):
     _fields_ = (
         ("Name",                 c_char * 8),
@@ -196,6 +207,15 @@ class PeSection(LittleEndianStructure):
     def __init__(self):
         super().__init__()
         self.data = bytearray()
+        self.extents: typing.List[Extent] = []
+        # Bytes taken from ELF sections and zero fill inserted for alignment, for --report.
+        self.input_size = 0
+        self.padding_size = 0
+
+    def add_extent(self, extent: Extent):
+        if extent.size > 0:
+            self.extents.append(extent)
+            self.VirtualSize += extent.size
 
 
 N_DATA_DIRECTORY_ENTRIES = 16
@@ -238,6 +258,9 @@ FILE_ALIGNMENT = 512
 PE_OFFSET = 64
 PE_MAGIC = b"PE\0\0"
 
+# Limit the number of buffers passed to a single writev() call.
+IOV_MAX = 1024
+
 
 def align_to(x: int, align: int) -> int:
     return (x + align - 1) & ~(align - 1)
@@ -247,15 +270,76 @@ def align_down(x: int, align: int) -> int:
     return x & ~(align - 1)
 
 
-def next_section_address(sections: typing.List[PeSection]) -> int:
-    return align_to(sections[-1].VirtualAddress + sections[-1].VirtualSize,
-                    SECTION_ALIGNMENT)
-
-
 class BadSectionError(ValueError):
     "One of the sections is in a bad state"
 
 
+class SectionDiagnostic(typing.NamedTuple):
+    "An overlap or gap between two neighbouring sections, in address order"
+
+    kind: str  # "overlap" or "gap"
+    previous: PeSection
+    section: PeSection
+    size: int
+
+
+class SectionMap:
+    "PE sections sorted by VirtualAddress, for O(log n) address lookups"
+
+    def __init__(self, sections: typing.Iterable[PeSection] = ()):
+        self.sections: typing.List[PeSection] = []
+        self.starts: typing.List[int] = []
+        for pe_s in sections:
+            self.add(pe_s)
+
+    def __iter__(self) -> typing.Iterator[PeSection]:
+        return iter(self.sections)
+
+    def __len__(self) -> int:
+        return len(self.sections)
+
+    def __getitem__(self, i: int) -> PeSection:
+        return self.sections[i]
+
+    def add(self, pe_s: PeSection):
+        i = bisect.bisect_right(self.starts, pe_s.VirtualAddress)
+        self.starts.insert(i, pe_s.VirtualAddress)
+        self.sections.insert(i, pe_s)
+
+    def move(self, offset: int):
+        for pe_s in self.sections:
+            pe_s.VirtualAddress += offset
+        self.starts = [start + offset for start in self.starts]
+
+    def find(self, address: int, size: int = 1) -> typing.Optional[PeSection]:
+        "Returns the section containing [address, address + size), if any"
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i < 0 or address + size > self.starts[i] + self.sections[i].VirtualSize:
+            return None
+        return self.sections[i]
+
+    def next_address(self) -> int:
+        last = self.sections[-1]
+        return align_to(last.VirtualAddress + last.VirtualSize, SECTION_ALIGNMENT)
+
+    def diagnostics(self) -> typing.List[SectionDiagnostic]:
+        diagnostics = []
+        for previous, pe_s in zip(self.sections, self.sections[1:]):
+            end = previous.VirtualAddress + previous.VirtualSize
+            if pe_s.VirtualAddress < end:
+                diagnostics += [SectionDiagnostic("overlap", previous, pe_s, end - pe_s.VirtualAddress)]
+            elif pe_s.VirtualAddress > align_to(end, SECTION_ALIGNMENT):
+                diagnostics += [SectionDiagnostic("gap", previous, pe_s,
+                                                  pe_s.VirtualAddress - align_to(end, SECTION_ALIGNMENT))]
+        return diagnostics
+
+
+def elf_section_extent(elf_s: ElfSection) -> Extent:
+    if elf_s["sh_type"] == "SHT_NOBITS":
+        return Extent(None, elf_s["sh_size"])
+    return Extent(elf_s["sh_offset"], elf_s["sh_size"])
+
+
 def iter_copy_sections(elf: ELFFile) -> typing.Iterator[PeSection]:
     pe_s = None
 
@@ -302,21 +386,25 @@ def iter_copy_sections(elf: ELFFile) -> typing.Iterator[PeSection]:
 
         if pe_s:
             # Insert padding to properly align the section.
-            pad_len = elf_s["sh_addr"] - pe_s.VirtualAddress - len(pe_s.data)
-            pe_s.data += bytearray(pad_len) + elf_s.data()
+            pad_len = elf_s["sh_addr"] - pe_s.VirtualAddress - pe_s.VirtualSize
+            if pad_len < 0:
+                raise BadSectionError(f"ELF section {elf_s.name} overlaps the previous section")
+            pe_s.add_extent(Extent(None, pad_len))
+            pe_s.padding_size += pad_len
         else:
             pe_s = PeSection()
             pe_s.VirtualAddress = elf_s["sh_addr"]
             pe_s.Characteristics = rwx
-            pe_s.data = elf_s.data()
+
+        pe_s.add_extent(elf_section_extent(elf_s))
+        pe_s.input_size += elf_s["sh_size"]
 
     if pe_s:
         yield pe_s
 
 
-def convert_sections(elf: ELFFile, opt: PeOptionalHeader) -> typing.List[PeSection]:
-    last_vma = (0, 0)
-    sections = []
+def convert_sections(elf: ELFFile, opt: PeOptionalHeader) -> SectionMap:
+    sections = SectionMap()
 
     for pe_s in iter_copy_sections(elf):
         # Truncate the VMA to the nearest page and insert appropriate padding. This should not
@@ -325,22 +413,18 @@ def convert_sections(elf: ELFFile, opt: PeOptionalHeader) -> typing.List[PeSecti
         # for the PE image.
         vma = pe_s.VirtualAddress
         pe_s.VirtualAddress = align_down(vma, SECTION_ALIGNMENT)
-        pe_s.data = bytearray(vma - pe_s.VirtualAddress) + pe_s.data
+        if vma > pe_s.VirtualAddress:
+            pe_s.extents.insert(0, Extent(None, vma - pe_s.VirtualAddress))
+            pe_s.VirtualSize += vma - pe_s.VirtualAddress
+            pe_s.padding_size += vma - pe_s.VirtualAddress
 
-        pe_s.VirtualSize = len(pe_s.data)
-        pe_s.SizeOfRawData = align_to(len(pe_s.data), FILE_ALIGNMENT)
+        pe_s.SizeOfRawData = align_to(pe_s.VirtualSize, FILE_ALIGNMENT)
         pe_s.Name = {
             PE_CHARACTERISTICS_RX: b".text",
             PE_CHARACTERISTICS_RW: b".data",
             PE_CHARACTERISTICS_R: b".rodata",
         }[pe_s.Characteristics]
 
-        # This can happen if not building with '-z separate-code'.
-        if pe_s.VirtualAddress < sum(last_vma):
-            raise BadSectionError(f"Section {pe_s.Name.decode()!r} @0x{pe_s.VirtualAddress:x} overlaps"
-                                  f" previous section @0x{last_vma[0]:x}+0x{last_vma[1]:x}=@0x{sum(last_vma):x}")
-        last_vma = (pe_s.VirtualAddress, pe_s.VirtualSize)
-
         if pe_s.Name == b".text":
             opt.BaseOfCode = pe_s.VirtualAddress
             opt.SizeOfCode += pe_s.VirtualSize
@@ -350,7 +434,16 @@ def convert_sections(elf: ELFFile, opt: PeOptionalHeader) -> typing.List[PeSecti
         if pe_s.Name == b".data" and isinstance(opt, PeOptionalHeader32):
             opt.BaseOfData = pe_s.VirtualAddress
 
-        sections.append(pe_s)
+        sections.add(pe_s)
+
+    # This can happen if not building with '-z separate-code'.
+    for diag in sections.diagnostics():
+        if diag.kind == "overlap":
+            prev, pe_s = diag.previous, diag.section
+            prev_end = prev.VirtualAddress + prev.VirtualSize
+            raise BadSectionError(f"Section {pe_s.Name.decode()!r} @0x{pe_s.VirtualAddress:x} overlaps"
+                                  f" previous section @0x{prev.VirtualAddress:x}+0x{prev.VirtualSize:x}"
+                                  f"=@0x{prev_end:x}")
 
     return sections
 
@@ -359,9 +452,10 @@ def copy_sections(
     elf: ELFFile,
     opt: PeOptionalHeader,
     input_names: str,
-    sections: typing.List[PeSection],
+    sections: SectionMap,
 ):
-    for name in input_names.split(","):
+    # Without --copy-sections the list is empty, and "" would match the ELF NULL section.
+    for name in filter(None, input_names.split(",")):
         elf_s = elf.get_section_by_name(name)
         if not elf_s:
             continue
@@ -372,92 +466,173 @@ def copy_sections(
 
         pe_s = PeSection()
         pe_s.Name = name.encode()
-        pe_s.data = elf_s.data()
-        pe_s.VirtualAddress = next_section_address(sections)
-        pe_s.VirtualSize = len(elf_s.data())
-        pe_s.SizeOfRawData = align_to(len(elf_s.data()), FILE_ALIGNMENT)
+        pe_s.VirtualAddress = sections.next_address()
+        pe_s.add_extent(elf_section_extent(elf_s))
+        pe_s.input_size = elf_s["sh_size"]
+        pe_s.SizeOfRawData = align_to(pe_s.VirtualSize, FILE_ALIGNMENT)
         pe_s.Characteristics = PE_CHARACTERISTICS_R
         opt.SizeOfInitializedData += pe_s.VirtualSize
-        sections.append(pe_s)
+        sections.add(pe_s)
+
+
+# Packed Elf_Rel/Elf_Rela entries: (r_offset, r_info) or (r_offset, r_info, r_addend).
+ELF_RELOC_FORMATS = {
+    (32, "REL"): "<II",
+    (32, "RELA"): "<IIi",
+    (64, "REL"): "<QQ",
+    (64, "RELA"): "<QQq",
+}
+
+# Mask to extract the relocation type from r_info.
+ELF_RELOC_TYPE_MASK = {
+    32: 0xFF,
+    64: 0xFFFFFFFF,
+}
+
+# The NONE and RELATIVE relocation types of each supported architecture.
+ELF_RELOC_TYPES = {
+    "EM_386": (ENUM_RELOC_TYPE_i386["R_386_NONE"], ENUM_RELOC_TYPE_i386["R_386_RELATIVE"]),
+    "EM_AARCH64": (ENUM_RELOC_TYPE_AARCH64["R_AARCH64_NONE"], ENUM_RELOC_TYPE_AARCH64["R_AARCH64_RELATIVE"]),
+    "EM_ARM": (ENUM_RELOC_TYPE_ARM["R_ARM_NONE"], ENUM_RELOC_TYPE_ARM["R_ARM_RELATIVE"]),
+    "EM_LOONGARCH": (0, 3),
+    "EM_RISCV": (0, 3),
+    "EM_X86_64": (ENUM_RELOC_TYPE_x64["R_X86_64_NONE"], ENUM_RELOC_TYPE_x64["R_X86_64_RELATIVE"]),
+}
+
+
+class RelocMetadata(typing.NamedTuple):
+    none: int
+    relative: int
+    type_mask: int
+    addend_format: str
+    pe_type: int
+
+
+@functools.lru_cache(maxsize=None)
+def reloc_metadata(machine: str, elfclass: int) -> RelocMetadata:
+    none, relative = ELF_RELOC_TYPES[machine]
+    return RelocMetadata(
+        none=none,
+        relative=relative,
+        type_mask=ELF_RELOC_TYPE_MASK[elfclass],
+        addend_format="<I" if elfclass == 32 else "<Q",
+        # REL_BASED_HIGHLOW or REL_BASED_DIR64
+        pe_type=3 if elfclass == 32 else 10,
+    )
 
 
-def apply_elf_relative_relocation(
-    reloc: ElfRelocation,
+def read_elf_reloc_table(
+    elf: ELFFile,
+    dynamic: DynamicSection,
+    reloc_type: str,
+) -> typing.List[typing.Tuple[int, ...]]:
+    _, offset = dynamic.get_table_offset(f"DT_{reloc_type}")
+    [size] = dynamic.iter_tags(f"DT_{reloc_type}SZ")
+    fmt = ELF_RELOC_FORMATS[(elf.elfclass, reloc_type)]
+
+    if offset is None or size["d_val"] % struct.calcsize(fmt) != 0:
+        raise BadSectionError(f"ELF {reloc_type} relocation table is malformed")
+
+    elf.stream.seek(offset)
+    data = elf.stream.read(size["d_val"])
+    if len(data) != size["d_val"]:
+        raise BadSectionError(f"ELF {reloc_type} relocation table is truncated")
+
+    return list(struct.iter_unpack(fmt, data))
+
+
+def assemble_sections(file, sections: SectionMap):
+    # All sections share one preallocated buffer that the ELF contents are copied into exactly once
+    # from a mapping of the input. Relocations are then applied in place through the views. The
+    # buffer starts zeroed, so zero fill extents need no work.
+    image = memoryview(bytearray(sum(pe_s.VirtualSize for pe_s in sections)))
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping, memoryview(mapping) as elf_data:
+        pos = 0
+        for pe_s in sections:
+            pe_s.data = image[pos : pos + pe_s.VirtualSize]
+            for extent in pe_s.extents:
+                if extent.offset is not None:
+                    if extent.offset + extent.size > len(elf_data):
+                        raise BadSectionError(f"Section {pe_s.Name.decode()!r} extends past the end"
+                                              " of the ELF file")
+                    image[pos : pos + extent.size] = elf_data[extent.offset : extent.offset + extent.size]
+                pos += extent.size
+
+
+def apply_elf_relative_relocations(
+    relocs: typing.List[typing.Tuple[int, ...]],
     image_base: int,
-    sections: typing.List[PeSection],
-    addend_size: int,
+    sections: SectionMap,
+    fmt: str,
 ):
-    [target] = [pe_s for pe_s in sections
-                if pe_s.VirtualAddress <= reloc["r_offset"] < pe_s.VirtualAddress + len(pe_s.data)]
+    addend_size = struct.calcsize(fmt)
 
-    addend_offset = reloc["r_offset"] - target.VirtualAddress
+    for reloc in relocs:
+        r_offset = reloc[0]
+        pe_s = sections.find(r_offset, addend_size)
+        if pe_s is None:
+            raise BadSectionError(f"Relocation at 0x{r_offset:x} does not target any section")
 
-    if reloc.is_RELA():
-        addend = reloc["r_addend"]
-    else:
-        addend = target.data[addend_offset : addend_offset + addend_size]
-        addend = int.from_bytes(addend, byteorder="little")
+        target = pe_s.data
+        addend_offset = r_offset - pe_s.VirtualAddress
+
+        if len(reloc) == 3:
+            addend = reloc[2]
+        else:
+            [addend] = struct.unpack_from(fmt, target, addend_offset)
 
-    value = (image_base + addend).to_bytes(addend_size, byteorder="little")
-    target.data[addend_offset : addend_offset + addend_size] = value
+        struct.pack_into(fmt, target, addend_offset, image_base + addend)
 
 
 def convert_elf_reloc_table(
     elf: ELFFile,
-    elf_reloc_table: ElfRelocationTable,
+    relocs: typing.List[typing.Tuple[int, ...]],
     elf_image_base: int,
-    sections: typing.List[PeSection],
-    pe_reloc_blocks: typing.Dict[int, PeRelocationBlock],
-):
-    NONE_RELOC = {
-        "EM_386": ENUM_RELOC_TYPE_i386["R_386_NONE"],
-        "EM_AARCH64": ENUM_RELOC_TYPE_AARCH64["R_AARCH64_NONE"],
-        "EM_ARM": ENUM_RELOC_TYPE_ARM["R_ARM_NONE"],
-        "EM_LOONGARCH": 0,
-        "EM_RISCV": 0,
-        "EM_X86_64": ENUM_RELOC_TYPE_x64["R_X86_64_NONE"],
-    }[elf["e_machine"]]
-
-    RELATIVE_RELOC = {
-        "EM_386": ENUM_RELOC_TYPE_i386["R_386_RELATIVE"],
-        "EM_AARCH64": ENUM_RELOC_TYPE_AARCH64["R_AARCH64_RELATIVE"],
-        "EM_ARM": ENUM_RELOC_TYPE_ARM["R_ARM_RELATIVE"],
-        "EM_LOONGARCH": 3,
-        "EM_RISCV": 3,
-        "EM_X86_64": ENUM_RELOC_TYPE_x64["R_X86_64_RELATIVE"],
-    }[elf["e_machine"]]
-
-    for reloc in elf_reloc_table.iter_relocations():
-        if reloc["r_info_type"] == NONE_RELOC:
-            continue
+    sections: SectionMap,
+) -> typing.List[int]:
+    meta = reloc_metadata(elf["e_machine"], elf.elfclass)
+    relative = [reloc for reloc in relocs if reloc[1] & meta.type_mask == meta.relative]
 
-        if reloc["r_info_type"] == RELATIVE_RELOC:
-            apply_elf_relative_relocation(reloc,
-                                          elf_image_base,
-                                          sections,
-                                          elf.elfclass // 8)
+    if len(relative) != len(relocs):
+        for reloc in relocs:
+            if reloc[1] & meta.type_mask not in (meta.none, meta.relative):
+                raise BadSectionError(f"Unsupported relocation type {reloc[1] & meta.type_mask}"
+                                      f" at 0x{reloc[0]:x}")
 
-            # Now that the ELF relocation has been applied, we can create a PE relocation.
-            block_rva = reloc["r_offset"] & ~0xFFF
-            if block_rva not in pe_reloc_blocks:
-                pe_reloc_blocks[block_rva] = PeRelocationBlock(block_rva)
+    apply_elf_relative_relocations(relative, elf_image_base, sections, meta.addend_format)
 
-            entry = PeRelocationEntry()
-            entry.Offset = reloc["r_offset"] & 0xFFF
-            # REL_BASED_HIGHLOW or REL_BASED_DIR64
-            entry.Type = 3 if elf.elfclass == 32 else 10
-            pe_reloc_blocks[block_rva].entries.append(entry)
+    # Now that the ELF relocations have been applied, the PE relocations only need their offsets.
+    return [reloc[0] for reloc in relative]
 
-            continue
 
-        raise BadSectionError(f"Unsupported relocation {reloc}")
+def build_pe_reloc_data(offsets: typing.List[int], entry_type: int, segment_offset: int) -> bytearray:
+    data = bytearray()
+    offsets = sorted(offsets)
+
+    for block_rva, page in itertools.groupby(offsets, key=lambda offset: offset & ~0xFFF):
+        entries = [entry_type << 12 | offset & 0xFFF for offset in page]
+
+        # Each block must start on a 32-bit boundary. Because each entry is 16 bits
+        # the len has to be even. We pad by adding a none relocation, which goes after any
+        # entries at page offset 0.
+        if len(entries) % 2 != 0:
+            entries.insert(bisect.bisect_right(entries, entry_type << 12), 0)
+
+        block = PeRelocationBlock(block_rva + segment_offset)
+        block.BlockSize = sizeof(PeRelocationBlock) + sizeof(PeRelocationEntry) * len(entries)
+        data += block
+        data += struct.pack(f"<{len(entries)}H", *entries)
+
+    return data
 
 
 def convert_elf_relocations(
     elf: ELFFile,
     opt: PeOptionalHeader,
-    sections: typing.List[PeSection],
+    sections: SectionMap,
     minimum_sections: int,
+    counts: typing.Optional[typing.Counter[str]] = None,
 ) -> typing.Optional[PeSection]:
     dynamic = elf.get_section_by_name(".dynamic")
     if dynamic is None:
@@ -496,92 +671,183 @@ def convert_elf_relocations(
     if isinstance(opt, PeOptionalHeader32):
         opt.BaseOfData += segment_offset
 
-    pe_reloc_blocks: typing.Dict[int, PeRelocationBlock] = {}
-    for reloc_type, reloc_table in dynamic.get_relocation_tables().items():
+    reloc_offsets: typing.List[int] = []
+    for reloc_type in dynamic.get_relocation_tables():
         if reloc_type not in ["REL", "RELA"]:
             raise BadSectionError(f"Unsupported relocation type {reloc_type}")
-        convert_elf_reloc_table(elf,
-                                reloc_table,
-                                opt.ImageBase + segment_offset,
-                                sections,
-                                pe_reloc_blocks)
-
-    for pe_s in sections:
-        pe_s.VirtualAddress += segment_offset
-
-    if len(pe_reloc_blocks) == 0:
+        relocs = read_elf_reloc_table(elf, dynamic, reloc_type)
+        offsets = convert_elf_reloc_table(elf,
+                                          relocs,
+                                          opt.ImageBase + segment_offset,
+                                          sections)
+        if counts is not None:
+            counts["elf"] += len(relocs)
+            counts["relative"] += len(offsets)
+
+        # Applying a RELA relocation twice stores the same value, but the PE loader would add the
+        # load offset twice, so only keep one PE relocation per address. REL relocations add to the
+        # stored value, so duplicates are kept as they are.
+        if reloc_type == "RELA":
+            offsets = list(dict.fromkeys(offsets))
+        reloc_offsets += offsets
+
+    if counts is not None:
+        counts["pe"] += len(reloc_offsets)
+
+    sections.move(segment_offset)
+
+    if len(reloc_offsets) == 0:
         return None
 
-    data = bytearray()
-    for rva in sorted(pe_reloc_blocks):
-        block = pe_reloc_blocks[rva]
-        n_relocs = len(block.entries)
-
-        # Each block must start on a 32-bit boundary. Because each entry is 16 bits
-        # the len has to be even. We pad by adding a none relocation.
-        if n_relocs % 2 != 0:
-            n_relocs += 1
-            block.entries.append(PeRelocationEntry())
-
-        block.PageRVA += segment_offset
-        block.BlockSize = sizeof(PeRelocationBlock) + sizeof(PeRelocationEntry) * n_relocs
-        data += block
-        for entry in sorted(block.entries, key=lambda e: e.Offset):
-            data += entry
+    meta = reloc_metadata(elf["e_machine"], elf.elfclass)
+    data = build_pe_reloc_data(reloc_offsets, meta.pe_type, segment_offset)
 
     pe_reloc_s = PeSection()
     pe_reloc_s.Name = b".reloc"
     pe_reloc_s.data = data
-    pe_reloc_s.VirtualAddress = next_section_address(sections)
+    pe_reloc_s.VirtualAddress = sections.next_address()
     pe_reloc_s.VirtualSize = len(data)
     pe_reloc_s.SizeOfRawData = align_to(len(data), FILE_ALIGNMENT)
     # CNT_INITIALIZED_DATA|MEM_READ|MEM_DISCARDABLE
     pe_reloc_s.Characteristics = 0x42000040
 
-    sections.append(pe_reloc_s)
+    sections.add(pe_reloc_s)
     opt.SizeOfInitializedData += pe_reloc_s.VirtualSize
     return pe_reloc_s
 
 
+def stripped_size(data) -> int:
+    "Returns the size of data without its trailing zeros"
+    # The data is scanned backwards through the view a page at a time, so that only the last page
+    # with data is ever copied.
+    view = memoryview(data).cast("B")
+    zeros = memoryview(bytes(SECTION_ALIGNMENT))
+    end = len(view)
+    while end > 0:
+        start = align_down(end - 1, SECTION_ALIGNMENT)
+        if view[start:end] != zeros[: end - start]:
+            return start + len(view[start:end].tobytes().rstrip(b"\0"))
+        end = start
+    return 0
+
+
+def trim_sections(sections: typing.Iterable[PeSection]):
+    # The loader zero fills everything between SizeOfRawData and VirtualSize, so trailing zeros
+    # (mostly .bss and alignment padding) do not need to be stored in the image.
+    for pe_s in sections:
+        size = stripped_size(pe_s.data)
+        pe_s.data = pe_s.data[:size]
+        pe_s.SizeOfRawData = align_to(size, FILE_ALIGNMENT)
+
+
+def reloc_density(reloc_data: typing.Union[bytes, bytearray]) -> typing.Dict[int, int]:
+    "Returns the number of base relocations per page, not counting padding entries"
+    density = {}
+    pos = 0
+    while pos < len(reloc_data):
+        page_rva, block_size = struct.unpack_from("<II", reloc_data, pos)
+        entries = struct.unpack_from(f"<{(block_size - 8) // 2}H", reloc_data, pos + 8)
+        density[page_rva] = sum(1 for entry in entries if entry >> 12 != 0)
+        pos += block_size
+    return density
+
+
+def print_reloc_density(name: str, pe_reloc_s: typing.Optional[PeSection], addend_size: int):
+    if pe_reloc_s is None:
+        print(f"{name}: no relocations", file=sys.stderr)
+        return
+
+    counts = sorted(reloc_density(pe_reloc_s.data).values())
+    # Pages that hold nothing but relocated pointers.
+    full = sum(1 for count in counts if count * addend_size >= SECTION_ALIGNMENT)
+    print(f"{name}: {sum(counts)} relocations in {len(counts)} pages, {len(pe_reloc_s.data)} bytes of .reloc"
+          f" (per page: min {counts[0]}, median {counts[len(counts) // 2]}, max {counts[-1]};"
+          f" {full} pages of pointers only)",
+          file=sys.stderr)
+
+
+def write_buffers(file, buffers: typing.List[typing.Any]):
+    file.flush()
+    views = [memoryview(b).cast("B") for b in buffers if len(b) > 0]
+
+    # Hand all buffers to the kernel at once instead of copying them through the file object.
+    while views:
+        n = os.writev(file.fileno(), views[:IOV_MAX])
+        while views and n >= len(views[0]):
+            n -= len(views.pop(0))
+        if views and n > 0:
+            views[0] = views[0][n:]
+
+
 def write_pe(
     file,
     coff: PeCoffHeader,
     opt: PeOptionalHeader,
-    sections: typing.List[PeSection],
+    sections: SectionMap,
 ):
-    file.write(b"MZ")
-    file.seek(0x3C, io.SEEK_SET)
-    file.write(PE_OFFSET.to_bytes(2, byteorder="little"))
-    file.seek(PE_OFFSET, io.SEEK_SET)
-    file.write(PE_MAGIC)
-    file.write(coff)
-    file.write(opt)
+    headers = bytearray(opt.SizeOfHeaders)
+    headers[0:2] = b"MZ"
+    headers[0x3C:0x3E] = PE_OFFSET.to_bytes(2, byteorder="little")
+
+    pos = PE_OFFSET
+    for header in [PE_MAGIC, bytes(coff), bytes(opt)]:
+        headers[pos : pos + len(header)] = header
+        pos += len(header)
 
+    buffers: typing.List[typing.Any] = [headers]
     offset = opt.SizeOfHeaders
-    for pe_s in sorted(sections, key=lambda s: s.VirtualAddress):
+    for pe_s in sections:
         if pe_s.VirtualAddress < opt.SizeOfHeaders:
             raise BadSectionError(f"Section {pe_s.Name} @0x{pe_s.VirtualAddress:x} overlaps"
                                   " PE headers ending at 0x{opt.SizeOfHeaders:x}")
 
-        pe_s.PointerToRawData = offset
-        file.write(pe_s)
-        offset = align_to(offset + len(pe_s.data), FILE_ALIGNMENT)
-
-    assert file.tell() <= opt.SizeOfHeaders
-
-    for pe_s in sections:
-        file.seek(pe_s.PointerToRawData, io.SEEK_SET)
-        file.write(pe_s.data)
-
-    file.truncate(offset)
-
-
-def elf2efi(args: argparse.Namespace):
-    elf = ELFFile(args.ELF)
-    if not elf.little_endian:
-        raise ValueError("ELF file is not little-endian")
-    if elf["e_type"] not in ["ET_DYN", "ET_EXEC"]:
-        raise ValueError(f"Unsupported ELF type {elf['e_type']}")
+        # The PE format wants no file offset for sections without raw data, e.g. .bss with --optimize.
+        pe_s.PointerToRawData = offset if len(pe_s.data) > 0 else 0
+        if pos + sizeof(pe_s) > opt.SizeOfHeaders:
+            raise BadSectionError(f"Section table does not fit in PE headers of size 0x{opt.SizeOfHeaders:x}")
+        headers[pos : pos + sizeof(pe_s)] = bytes(pe_s)
+        pos += sizeof(pe_s)
+
+        end = align_to(offset + len(pe_s.data), FILE_ALIGNMENT)
+        buffers += [pe_s.data, bytes(end - offset - len(pe_s.data))]
+        offset = end
+
+    write_buffers(file, buffers)
+    file.seek(offset)
+    file.truncate()
+
+
+@contextlib.contextmanager
+def timed(timings: typing.Dict[str, float], name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def section_report(pe_s: PeSection) -> typing.Dict[str, typing.Any]:
+    return {
+        "name": pe_s.Name.decode(),
+        "virtual_address": pe_s.VirtualAddress,
+        "virtual_size": pe_s.VirtualSize,
+        "input_bytes": pe_s.input_size,
+        "output_bytes": pe_s.SizeOfRawData,
+        # Zero fill inserted to align the ELF sections plus the file alignment of the raw data.
+        "padding_bytes": pe_s.padding_size + pe_s.SizeOfRawData - len(pe_s.data),
+    }
+
+
+def elf2efi(args: argparse.Namespace) -> typing.Dict[str, typing.Any]:
+    timings: typing.Dict[str, float] = {}
+    counts: typing.Counter[str] = collections.Counter(elf=0, relative=0, pe=0)
+
+    with timed(timings, "parse"):
+        elf = ELFFile(args.ELF)
+        if not elf.little_endian:
+            raise ValueError("ELF file is not little-endian")
+        if elf["e_type"] not in ["ET_DYN", "ET_EXEC"]:
+            raise ValueError(f"Unsupported ELF type {elf['e_type']}")
 
     pe_arch = {
         "EM_386": 0x014C,
@@ -597,17 +863,26 @@ def elf2efi(args: argparse.Namespace):
     coff = PeCoffHeader()
     opt = PeOptionalHeader32() if elf.elfclass == 32 else PeOptionalHeader32Plus()
 
-    # We relocate to a unique image base to reduce the chances for runtime relocation to occur.
-    base_name = pathlib.Path(args.PE.name).name.encode()
-    opt.ImageBase = int(hashlib.sha1(base_name).hexdigest()[0:8], 16)
-    if elf.elfclass == 32:
-        opt.ImageBase = (0x400000 + opt.ImageBase) & 0xFFFF0000
+    if args.image_base is not None:
+        if args.image_base % 0x10000 != 0 or args.image_base >= 1 << elf.elfclass:
+            raise ValueError(f"Image base 0x{args.image_base:x} is not 64KiB aligned or out of range")
+        opt.ImageBase = args.image_base
     else:
-        opt.ImageBase = (0x100000000 + opt.ImageBase) & 0x1FFFF0000
+        # We relocate to a unique image base to reduce the chances for runtime relocation to occur.
+        base_name = pathlib.Path(args.PE.name).name.encode()
+        opt.ImageBase = int(hashlib.sha1(base_name).hexdigest()[0:8], 16)
+        if elf.elfclass == 32:
+            opt.ImageBase = (0x400000 + opt.ImageBase) & 0xFFFF0000
+        else:
+            opt.ImageBase = (0x100000000 + opt.ImageBase) & 0x1FFFF0000
+
+    with timed(timings, "sections"):
+        sections = convert_sections(elf, opt)
+        copy_sections(elf, opt, args.copy_sections, sections)
+        assemble_sections(args.ELF, sections)
 
-    sections = convert_sections(elf, opt)
-    copy_sections(elf, opt, args.copy_sections, sections)
-    pe_reloc_s = convert_elf_relocations(elf, opt, sections, args.minimum_sections)
+    with timed(timings, "relocations"):
+        pe_reloc_s = convert_elf_relocations(elf, opt, sections, args.minimum_sections, counts)
 
     coff.Machine = pe_arch
     coff.NumberOfSections = len(sections)
@@ -625,7 +900,7 @@ def elf2efi(args: argparse.Namespace):
     opt.MinorSubsystemVersion = args.efi_minor
     opt.Subsystem = args.subsystem
     opt.Magic = 0x10B if elf.elfclass == 32 else 0x20B
-    opt.SizeOfImage = next_section_address(sections)
+    opt.SizeOfImage = sections.next_address()
 
     # DYNAMIC_BASE|NX_COMPAT|HIGH_ENTROPY_VA or DYNAMIC_BASE|NX_COMPAT
     opt.DllCharacteristics = 0x160 if elf.elfclass == 64 else 0x140
@@ -642,7 +917,41 @@ def elf2efi(args: argparse.Namespace):
             pe_reloc_s.VirtualAddress, pe_reloc_s.VirtualSize
         )
 
-    write_pe(args.PE, coff, opt, sections)
+    if args.optimize:
+        print_reloc_density(pathlib.Path(args.PE.name).name, pe_reloc_s, elf.elfclass // 8)
+        trim_sections(pe_s for pe_s in sections if pe_s is not pe_reloc_s)
+
+    with timed(timings, "write"):
+        write_pe(args.PE, coff, opt, sections)
+
+    return {
+        "input": args.ELF.name,
+        "output": args.PE.name,
+        "machine": elf["e_machine"],
+        "input_bytes": os.fstat(args.ELF.fileno()).st_size,
+        "output_bytes": args.PE.tell(),
+        "phases": timings,
+        "sections": [section_report(pe_s) for pe_s in sections],
+        # Address ranges between sections that are not part of any section, e.g. left behind by
+        # discarded ELF sections.
+        "gaps": [
+            {
+                "after": diag.previous.Name.decode(),
+                "before": diag.section.Name.decode(),
+                "virtual_address": diag.section.VirtualAddress - diag.size,
+                "size": diag.size,
+            }
+            for diag in sections.diagnostics() if diag.kind == "gap"
+        ],
+        "relocations": dict(counts),
+    }
+
+
+def positive_int(s: str) -> int:
+    value = int(s)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be positive: {s}")
+    return value
 
 
 def create_parser() -> argparse.ArgumentParser:
@@ -680,11 +989,13 @@ def create_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "ELF",
         type=argparse.FileType("rb"),
+        nargs="?",
         help="Input ELF file",
     )
     parser.add_argument(
         "PE",
         type=argparse.FileType("wb"),
+        nargs="?",
         help="Output PE/EFI file",
     )
     parser.add_argument(
@@ -699,12 +1010,175 @@ def create_parser() -> argparse.ArgumentParser:
         default="",
         help="Copy these sections if found",
     )
+    parser.add_argument(
+        "--image-base",
+        type=lambda x: int(x, 0),
+        help="Preferred PE image base (default: derived from the PE file name)",
+    )
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="Do not store trailing zeros of sections and report the relocation density per page",
+    )
+    parser.add_argument(
+        "--report",
+        choices=("json", "off"),
+        default="off",
+        help="Print the time spent in each phase, the section sizes and relocation counts"
+             " to standard error when done",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=positive_int,
+        metavar="N",
+        help="Convert the file N times and print the minimum, median and maximum time of each phase",
+    )
+    parser.add_argument(
+        "--batch",
+        nargs=2,
+        metavar=("ELF", "PE"),
+        action="append",
+        default=[],
+        help="Convert ELF to PE in a worker process, may be specified multiple times",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=argparse.FileType("r"),
+        help="Convert the files listed in this file in worker processes, one line per"
+             " conversion consisting of options followed by ELF and PE",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        help="Number of worker processes for --batch and --manifest (default: number of CPUs)",
+    )
     return parser
 
 
+def read_manifest(file) -> typing.List[typing.List[str]]:
+    entries = []
+    for line in file:
+        argv = shlex.split(line, comments=True)
+        if argv:
+            entries += [argv]
+    return entries
+
+
+def elf2efi_in_worker(
+    defaults: typing.Dict[str, typing.Any],
+    argv: typing.List[str],
+) -> typing.Dict[str, typing.Any]:
+    parser = create_parser()
+
+    def error(message: str):
+        raise ValueError(message)
+
+    parser.error = error  # type: ignore
+
+    # Options given on the command line apply to every conversion, unless overridden per entry.
+    args = parser.parse_args(argv, namespace=argparse.Namespace(**defaults))
+    if args.ELF is None or args.PE is None:
+        raise ValueError("ELF and PE are required")
+    if args.batch or args.manifest:
+        raise ValueError("--batch and --manifest cannot be nested")
+
+    with args.ELF, args.PE:
+        return elf2efi(args)
+
+
+def elf2efi_batch(
+    args: argparse.Namespace,
+    entries: typing.List[typing.List[str]],
+) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], typing.List[typing.List[str]]]:
+    defaults = {
+        key: value for key, value in vars(args).items()
+        if key not in ["ELF", "PE", "batch", "manifest"]
+    }
+    reports = []
+    failed = []
+
+    if args.jobs == 1 or len(entries) == 1:
+        for argv in entries:
+            try:
+                reports += [elf2efi_in_worker(defaults, argv)]
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Failed to convert {shlex.join(argv)!r}: {e}", file=sys.stderr)
+                failed += [argv]
+    else:
+        # Fork, so that the workers inherit the imported modules and the relocation metadata, which is
+        # computed here for every supported architecture, as it is cheap to do so.
+        for machine, elfclass in itertools.product(ELF_RELOC_TYPES, ELF_RELOC_TYPE_MASK):
+            reloc_metadata(machine, elfclass)
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=context) as pool:
+            futures = [pool.submit(elf2efi_in_worker, defaults, argv) for argv in entries]
+            for argv, future in zip(entries, futures):
+                try:
+                    reports += [future.result()]
+                except Exception as e:  # pylint: disable=broad-except
+                    print(f"Failed to convert {shlex.join(argv)!r}: {e}", file=sys.stderr)
+                    failed += [argv]
+
+    return reports, failed
+
+
+def combine_reports(reports: typing.List[typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
+    relocations: typing.Dict[str, typing.Counter[str]] = {}
+    for report in reports:
+        relocations.setdefault(report["machine"], collections.Counter()).update(report["relocations"])
+
+    return {
+        "conversions": reports,
+        "relocations": {machine: dict(counts) for machine, counts in relocations.items()},
+    }
+
+
+def print_benchmark(reports: typing.List[typing.Dict[str, typing.Any]]):
+    print(f"{len(reports)} runs, times in ms")
+    print(f"{'phase':<12} {'min':>9} {'median':>9} {'max':>9}")
+    for phase in [*reports[0]["phases"], "total"]:
+        if phase == "total":
+            times = sorted(sum(report["phases"].values()) for report in reports)
+        else:
+            times = sorted(report["phases"][phase] for report in reports)
+        low, median, high = (t * 1000 for t in (times[0], times[len(times) // 2], times[-1]))
+        print(f"{phase:<12} {low:9.3f} {median:9.3f} {high:9.3f}")
+
+
 def main():
     parser = create_parser()
-    elf2efi(parser.parse_args())
+    args = parser.parse_args()
+
+    # The pairs are parsed again in the workers, where a file name starting with "-" is not an option
+    entries = [["--", *pair] for pair in args.batch]
+    if args.manifest:
+        with args.manifest:
+            entries += read_manifest(args.manifest)
+
+    failed = []
+    if entries:
+        if args.ELF or args.PE:
+            parser.error("ELF and PE cannot be combined with --batch or --manifest")
+        if args.benchmark:
+            parser.error("--benchmark cannot be combined with --batch or --manifest")
+        reports, failed = elf2efi_batch(args, entries)
+    elif args.ELF is None or args.PE is None:
+        parser.error("ELF and PE are required")
+    elif args.benchmark:
+        reports = []
+        for _ in range(args.benchmark):
+            args.PE.seek(0)
+            reports += [elf2efi(args)]
+        print_benchmark(reports)
+    else:
+        reports = [elf2efi(args)]
+
+    # The reports of the successful conversions are printed even if others failed
+    if args.report == "json":
+        json.dump(combine_reports(reports), sys.stderr)
+
+    if failed:
+        sys.exit(f"Failed to convert {len(failed)} of {len(entries)} files")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+# pylint: disable=wrong-import-position,redefined-outer-name,no-member
+
+import json
+import os
+import pathlib
+import shutil
+import struct
+import subprocess
+import sys
+
+try:
+    import pytest
+except ImportError as e:
+    print(str(e), file=sys.stderr)
+    sys.exit(77)
+
+try:
+    # pyflakes: noqa
+    import pefile  # noqa
+    from elftools.elf.elffile import ELFFile
+except ImportError as e:
+    print(str(e), file=sys.stderr)
+    sys.exit(77)
+
+sys.path.append(os.path.dirname(__file__))
+import elf2efi
+
+# The flags the EFI binaries are linked with, see src/boot/efi/meson.build
+CFLAGS = [
+    '-O2',
+    '-fpie',
+    '-fno-asynchronous-unwind-tables',
+    '-fno-stack-protector',
+    '-nostdlib',
+    '-static-pie',
+    '-Wl,--entry=efi_main',
+    '-Wl,-static,-pie,--no-dynamic-linker,-z,text',
+    '-Wl,-z,common-page-size=4096,-z,max-page-size=4096',
+    '-Wl,-z,noexecstack,-z,relro,-z,separate-code',
+    '-Wl,-z,nopack-relative-relocs',
+]
+
+# A static PIE with pointers spanning several pages, zeros at the end of its data and an .sbat section
+SOURCE = '''
+static int values[16];
+char zeros[3 * 4096];
+int *pointers[] = { %s };
+const char sbat[] __attribute__((section(".sbat"), used)) = "sbat,1,SBAT Version\\n";
+
+long efi_main(void *handle, void *table) {
+        zeros[(long) handle] = 1;
+        return *pointers[(long) table];
+}
+''' % ', '.join(f'&values[{i % 16}]' for i in range(1100))
+
+COPY_SECTIONS = '.sbat,.sdmagic,.osrel'
+
+
+def build_pie(directory: pathlib.Path, *flags) -> pathlib.Path:
+    cc = shutil.which(os.getenv('CC', 'cc'))
+    if cc is None:
+        pytest.skip('no C compiler found')
+
+    source = directory / 'pie.c'
+    source.write_text(SOURCE)
+    output = directory / 'pie.elf'
+    try:
+        subprocess.run([cc, *CFLAGS, *flags, str(source), '-o', str(output)],
+                       check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        pytest.skip(f'cannot build a static PIE: {e.stderr.decode()}')
+    return output
+
+
+@pytest.fixture(scope='session')
+def pie(tmp_path_factory):
+    return build_pie(tmp_path_factory.mktemp('pie'))
+
+
+@pytest.fixture(scope='session')
+def pie32(tmp_path_factory):
+    return build_pie(tmp_path_factory.mktemp('pie32'), '-m32')
+
+
+def convert(elf: pathlib.Path, pe: pathlib.Path, *argv) -> dict:
+    args = elf2efi.create_parser().parse_args([*argv, str(elf), str(pe)])
+    with args.ELF, args.PE:
+        return elf2efi.elf2efi(args)
+
+
+def elf_relative_relocations(elf_path: pathlib.Path) -> list:
+    "Returns (offset, addend) of the RELATIVE relocations, using pyelftools to decode them"
+    with elf_path.open('rb') as f:
+        elf = ELFFile(f)
+        relative = elf2efi.reloc_metadata(elf['e_machine'], elf.elfclass).relative
+        relocs = []
+        for section in elf.iter_sections():
+            if section['sh_type'] in ('SHT_REL', 'SHT_RELA'):
+                for reloc in section.iter_relocations():
+                    if reloc['r_info_type'] == relative:
+                        relocs += [(reloc['r_offset'], reloc['r_addend'] if reloc.is_RELA() else None)]
+        return relocs
+
+
+def test_reloc_table_reader(pie, pie32):
+    for path in (pie, pie32):
+        with path.open('rb') as f:
+            elf = ELFFile(f)
+            dynamic = elf.get_section_by_name('.dynamic')
+            [reloc_type] = dynamic.get_relocation_tables()
+            relocs = elf2efi.read_elf_reloc_table(elf, dynamic, reloc_type)
+
+            section = elf.get_section_by_name(f'.{reloc_type.lower()}.dyn')
+            expected = [(r['r_offset'], r['r_info']) + ((r['r_addend'],) if r.is_RELA() else ())
+                        for r in section.iter_relocations()]
+
+        assert relocs == expected
+        assert len(relocs) >= 1100
+
+
+def test_build_pe_reloc_data():
+    # An odd number of entries is padded after the entries at page offset 0, the blocks are sorted
+    data = elf2efi.build_pe_reloc_data([0x2010, 0x1008, 0x2000, 0x2008, 0x1000], 10, 0x3000)
+    assert data == (struct.pack('<II2H', 0x4000, 12, 0xA000, 0xA008) +
+                    struct.pack('<II4H', 0x5000, 16, 0xA000, 0x0000, 0xA008, 0xA010))
+
+    assert elf2efi.reloc_density(data) == {0x4000: 2, 0x5000: 3}
+    assert elf2efi.build_pe_reloc_data([], 10, 0) == b''
+
+
+def test_section_map():
+    def section(address, size):
+        pe_s = elf2efi.PeSection()
+        pe_s.VirtualAddress = address
+        pe_s.VirtualSize = size
+        return pe_s
+
+    text, data, gapped, overlapping = section(0x1000, 0x1800), section(0x3000, 0x100), \
+        section(0x6000, 0x10), section(0x6008, 0x10)
+    sections = elf2efi.SectionMap([data, text, gapped])
+
+    assert list(sections) == [text, data, gapped]
+    assert sections.find(0x1000) is text
+    assert sections.find(0x27F8, 8) is text
+    assert sections.find(0x27F9, 8) is None
+    assert sections.find(0x2800) is None
+    assert sections.find(0x30FF) is data
+    assert sections.find(0xFFF) is None
+    assert sections.find(0x7000) is None
+    assert sections.next_address() == 0x7000
+
+    # .text ends at 0x2800, which is page aligned to 0x3000, so only the space before gapped is a gap
+    assert [(d.kind, d.previous, d.section, d.size) for d in sections.diagnostics()] == [
+        ('gap', data, gapped, 0x2000),
+    ]
+
+    sections.add(overlapping)
+    assert sections.diagnostics()[-1] == ('overlap', gapped, overlapping, 8)
+
+    sections.move(0x1000)
+    assert sections.find(0x2000) is text
+    assert sections.find(0x1000) is None
+
+
+def test_assemble_sections(tmp_path):
+    elf = tmp_path / 'elf'
+    elf.write_bytes(b'0123456789')
+
+    first, second = elf2efi.PeSection(), elf2efi.PeSection()
+    for extent in (elf2efi.Extent(2, 3), elf2efi.Extent(None, 4), elf2efi.Extent(0, 2)):
+        first.add_extent(extent)
+    second.add_extent(elf2efi.Extent(8, 2))
+    second.add_extent(elf2efi.Extent(None, 2))
+
+    with elf.open('rb') as f:
+        elf2efi.assemble_sections(f, [first, second])
+    assert bytes(first.data) == b'234' + bytes(4) + b'01'
+    assert bytes(second.data) == b'89\0\0'
+
+    # Both sections are views of the same buffer
+    assert first.data.obj is second.data.obj
+
+    broken = elf2efi.PeSection()
+    broken.Name = b'.data'
+    broken.add_extent(elf2efi.Extent(8, 3))
+    with elf.open('rb') as f, pytest.raises(elf2efi.BadSectionError, match='past the end'):
+        elf2efi.assemble_sections(f, [broken])
+
+
+def test_write_buffers(tmp_path, monkeypatch):
+    buffers = [b'header', bytearray(b''), memoryview(b'first section'), b'\0' * 3, b'second']
+
+    # The kernel may write less than asked for, ending in the middle of a buffer or at the end of one
+    writev = os.writev
+
+    def short_writev(fd, views):
+        return writev(fd, [b''.join(bytes(view) for view in views)[:6]])
+
+    monkeypatch.setattr(elf2efi.os, 'writev', short_writev)
+    output = tmp_path / 'output'
+    with output.open('wb') as f:
+        elf2efi.write_buffers(f, buffers)
+    assert output.read_bytes() == b''.join(bytes(b) for b in buffers)
+
+
+def test_stripped_size():
+    for data in (b'', bytes(5000), b'a' + bytes(9000), bytes(8191) + b'x', bytes(4096) + b'y' + bytes(4095)):
+        assert elf2efi.stripped_size(bytearray(data)) == len(data.rstrip(b'\0'))
+
+
+def test_convert(pie, tmp_path):
+    output = tmp_path / 'pie.efi'
+    report = convert(pie, output, f'--copy-sections={COPY_SECTIONS}', '--minimum-sections=15')
+
+    pe = pefile.PE(output)
+    names = [s.Name.rstrip(b'\0') for s in pe.sections]
+    assert names == [b'.text', b'.rodata', b'.data', b'.sbat', b'.reloc']
+    assert pe.sections[3].get_data().rstrip(b'\0') == b'sbat,1,SBAT Version\n'
+
+    # The PE relocations are the ELF RELATIVE relocations, moved by the offset that makes room for the
+    # headers. Each relocated pointer holds the preferred address of its target.
+    with pie.open('rb') as f:
+        segment_offset = pe.OPTIONAL_HEADER.AddressOfEntryPoint - ELFFile(f)['e_entry']
+    relocs = elf_relative_relocations(pie)
+    entries = [entry for block in pe.DIRECTORY_ENTRY_BASERELOC for entry in block.entries]
+    assert sorted(e.rva for e in entries if e.type == 10) == sorted(offset + segment_offset
+                                                                    for offset, _ in relocs)
+    for offset, addend in relocs:
+        assert pe.get_qword_at_rva(offset + segment_offset) == \
+            pe.OPTIONAL_HEADER.ImageBase + addend + segment_offset
+
+    # Each block is padded to an even number of entries
+    for block in pe.DIRECTORY_ENTRY_BASERELOC:
+        assert len(block.entries) % 2 == 0
+        assert sum(1 for e in block.entries if e.type == 0) <= 1
+
+    assert report['relocations'] == {'elf': len(relocs), 'relative': len(relocs), 'pe': len(relocs)}
+    assert [s['name'] for s in report['sections']] == [n.decode() for n in names]
+    assert report['output_bytes'] == output.stat().st_size
+    assert set(report['phases']) == {'parse', 'sections', 'relocations', 'write'}
+    for gap in report['gaps']:
+        assert gap['size'] > 0
+
+    # Without --copy-sections no nameless section is added for the ELF NULL section
+    convert(pie, output)
+    assert [s.Name.rstrip(b'\0') for s in pefile.PE(output).sections] == [b'.text', b'.rodata', b'.data',
+                                                                         b'.reloc']
+
+
+def read_at_address(elf: ELFFile, address: int, size: int) -> bytes:
+    for segment in elf.iter_segments():
+        if segment['p_type'] == 'PT_LOAD' and \
+           segment['p_vaddr'] <= address < segment['p_vaddr'] + segment['p_filesz']:
+            start = address - segment['p_vaddr']
+            return segment.data()[start : start + size]
+    raise ValueError(f'0x{address:x} is not in a segment')
+
+
+def test_convert_32(pie32, tmp_path):
+    output = tmp_path / 'pie.efi'
+    convert(pie32, output, f'--copy-sections={COPY_SECTIONS}')
+
+    # REL relocations take the addend from the relocated location
+    pe = pefile.PE(output)
+    relocs = elf_relative_relocations(pie32)
+    entries = [entry for block in pe.DIRECTORY_ENTRY_BASERELOC for entry in block.entries if entry.type == 3]
+    assert len(entries) == len(relocs)
+    with pie32.open('rb') as f:
+        elf = ELFFile(f)
+        segment_offset = pe.OPTIONAL_HEADER.AddressOfEntryPoint - elf['e_entry']
+        for offset, _ in relocs:
+            [addend] = struct.unpack('<I', read_at_address(elf, offset, 4))
+            assert pe.get_dword_at_rva(offset + segment_offset) == \
+                pe.OPTIONAL_HEADER.ImageBase + addend + segment_offset
+
+
+def test_duplicate_rela(pie, tmp_path, monkeypatch):
+    # A RELA relocation applied twice stores the same value, so it needs only one PE relocation
+    read = elf2efi.read_elf_reloc_table
+    monkeypatch.setattr(elf2efi, 'read_elf_reloc_table', lambda *args: read(*args) * 2)
+
+    output = tmp_path / 'pie.efi'
+    report = convert(pie, output)
+    relocs = elf_relative_relocations(pie)
+    assert report['relocations'] == {'elf': 2 * len(relocs), 'relative': 2 * len(relocs), 'pe': len(relocs)}
+
+    entries = [e for block in pefile.PE(output).DIRECTORY_ENTRY_BASERELOC for e in block.entries if e.type]
+    assert len(entries) == len(relocs)
+
+
+def test_optimize(pie, tmp_path, capsys):
+    plain, optimized = tmp_path / 'plain' / 'pie.efi', tmp_path / 'optimized' / 'pie.efi'
+    plain.parent.mkdir()
+    optimized.parent.mkdir()
+    convert(pie, plain)
+    convert(pie, optimized, '--optimize')
+    assert 'relocations in' in capsys.readouterr().err
+
+    # The trailing zeros of .data are not stored, but the image is the same once loaded
+    assert optimized.stat().st_size < plain.stat().st_size
+    pe, opt = pefile.PE(plain), pefile.PE(optimized)
+    data = next(s for s in opt.sections if s.Name.rstrip(b'\0') == b'.data')
+    assert data.SizeOfRawData < data.Misc_VirtualSize
+    start = pe.sections[0].VirtualAddress
+    assert pe.get_memory_mapped_image()[start:] == opt.get_memory_mapped_image()[start:]
+
+
+def test_image_base(pie, tmp_path):
+    output = tmp_path / 'pie.efi'
+    convert(pie, output, '--image-base=0x20000000')
+    assert pefile.PE(output).OPTIONAL_HEADER.ImageBase == 0x20000000
+
+    for base in ('0x20001000', '0x10000000000000000'):
+        with pytest.raises(ValueError, match='Image base'):
+            convert(pie, output, f'--image-base={base}')
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['elf2efi.py', *map(str, argv)])
+    elf2efi.main()
+
+
+def test_batch(pie, tmp_path, monkeypatch, capsys):
+    single, batch, manifest_dir = tmp_path / 'single', tmp_path / 'batch', tmp_path / 'manifest'
+    for d in (single, batch, manifest_dir):
+        d.mkdir()
+
+    for name in ('a.efi', 'b.efi', '-5'):
+        convert(pie, single / name, f'--copy-sections={COPY_SECTIONS}')
+
+    # The options given on the command line apply to every conversion. File names that look like options
+    # are not taken for options.
+    monkeypatch.chdir(batch)
+    run_main(monkeypatch, f'--copy-sections={COPY_SECTIONS}', '--jobs=2',
+             '--batch', pie, 'a.efi', '--batch', pie, 'b.efi', '--batch', pie, '-5')
+
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text('\n'.join([
+        '# comment',
+        f'--copy-sections={COPY_SECTIONS} {pie} {manifest_dir / "a.efi"}',
+        '',
+        f'--copy-sections={COPY_SECTIONS} --image-base=0x10000000 {pie} {manifest_dir / "b.efi"}',
+    ]))
+    run_main(monkeypatch, '--jobs=1', '--report=json', '--manifest', manifest)
+    report = json.loads(capsys.readouterr().err)
+    assert [c['output'] for c in report['conversions']] == [str(manifest_dir / 'a.efi'), str(manifest_dir / 'b.efi')]
+    assert report['relocations']['EM_X86_64']['pe'] == 2 * len(elf_relative_relocations(pie))
+
+    for name in ('a.efi', 'b.efi', '-5'):
+        assert (batch / name).read_bytes() == (single / name).read_bytes()
+    assert (manifest_dir / 'a.efi').read_bytes() == (single / 'a.efi').read_bytes()
+    assert pefile.PE(manifest_dir / 'b.efi').OPTIONAL_HEADER.ImageBase == 0x10000000
+
+
+def test_batch_failure(pie, tmp_path, monkeypatch, capsys):
+    output = tmp_path / 'a.efi'
+
+    # The report of the successful conversions is printed before exiting with an error
+    with pytest.raises(SystemExit, match='Failed to convert 1 of 2 files'):
+        run_main(monkeypatch, '--report=json', '--batch', tmp_path / 'missing.elf', tmp_path / 'x.efi',
+                 '--batch', pie, output)
+    err = capsys.readouterr().err
+    assert 'missing.elf' in err
+    report = json.loads(err[err.index('{'):])
+    assert [c['output'] for c in report['conversions']] == [str(output)]
+
+    for argv in (['--jobs=0', '--batch', pie, output],
+                 ['--batch', pie, output, pie, output],
+                 ['--benchmark=2', '--batch', pie, output]):
+        with pytest.raises(SystemExit):
+            run_main(monkeypatch, *argv)
+
+
+def test_benchmark(pie, tmp_path, monkeypatch, capsys):
+    run_main(monkeypatch, '--benchmark=3', pie, tmp_path / 'pie.efi')
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == '3 runs, times in ms'
+    assert [line.split()[0] for line in lines[2:]] == ['parse', 'sections', 'relocations', 'write', 'total']
+
+    for count in ('0', '-1'):
+        with pytest.raises(SystemExit):
+            run_main(monkeypatch, f'--benchmark={count}', pie, tmp_path / 'pie.efi')
+
+
+if __name__ == '__main__':
+    sys.exit(pytest.main(sys.argv))